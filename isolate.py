@@ -23,6 +23,7 @@ import os
 import re
 import subprocess
 import sys
+import tempfile
 
 import auth
 import isolate_format
@@ -567,7 +568,7 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, read_only, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir, collapse_symlinks):
+  def files_to_metadata(self, subdir, collapse_symlinks, hash_cache=None):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
@@ -575,24 +576,37 @@ class CompleteState(object):
 
     See isolated_format.file_to_metadata() for more information.
     """
-    for infile in sorted(self.saved_state.files):
-      if subdir and not infile.startswith(subdir):
-        self.saved_state.files.pop(infile)
-      else:
-        filepath = os.path.join(self.root_dir, infile)
-        self.saved_state.files[infile] = isolated_format.file_to_metadata(
-            filepath,
-            self.saved_state.files[infile],
-            self.saved_state.read_only,
-            self.saved_state.algo,
-            collapse_symlinks)
-
-  def save_files(self):
-    """Saves self.saved_state and creates a .isolated file."""
+    files = self.saved_state.files
+    if subdir:
+      for infile in [f for f in files if not f.startswith(subdir)]:
+        files.pop(infile)
+    infiles = sorted(files)
+    # The files are hashed in parallel.
+    results = isolated_format.iter_file_to_metadata(
+        ((os.path.join(self.root_dir, infile), files[infile])
+         for infile in infiles),
+        self.saved_state.read_only,
+        self.saved_state.algo,
+        collapse_symlinks,
+        hash_cache=hash_cache)
+    for infile, (_, metadata) in zip(infiles, results):
+      files[infile] = metadata
+
+  def save_files(self, bundles_dir=None):
+    """Saves self.saved_state and creates a .isolated file.
+
+    If bundles_dir is set, the small files are bundled in this directory, see
+    isolateserver.bundle_small_files(), and the bundles are returned.
+    """
     logging.debug('Dumping to %s' % self.isolated_filepath)
+    data = self.saved_state.to_isolated()
+    bundles = []
+    if bundles_dir:
+      bundles = isolateserver.bundle_small_files(
+          self.root_dir, data['files'], self.saved_state.algo, bundles_dir)
     self.saved_state.child_isolated_files = chromium_save_isolated(
         self.isolated_filepath,
-        self.saved_state.to_isolated(),
+        data,
         self.saved_state.path_variables,
         self.saved_state.algo)
     total_bytes = sum(
@@ -603,6 +617,7 @@ class CompleteState(object):
     saved_state_file = isolatedfile_to_state(self.isolated_filepath)
     logging.debug('Dumping to %s' % saved_state_file)
     tools.write_json(saved_state_file, self.saved_state.flatten(), True)
+    return bundles
 
   @property
   def root_dir(self):
@@ -695,7 +710,9 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir, options.collapse_symlinks)
+    with isolateserver.open_hash_cache(options.hash_cache) as hash_cache:
+      complete_state.files_to_metadata(
+          subdir, options.collapse_symlinks, hash_cache)
   return complete_state
 
 
@@ -731,16 +748,26 @@ def create_isolate_tree(outdir, root_dir, files, relative_cwd, read_only):
 
 
 @tools.profile
-def prepare_for_archival(options, cwd):
-  """Loads the isolated file and create 'infiles' for archival."""
+def prepare_for_archival(options, cwd, bundles_dir=None):
+  """Loads the isolated file and create 'infiles' for archival.
+
+  If bundles_dir is set, the small files are replaced in 'infiles' by the
+  bundles written in this directory.
+  """
   complete_state = load_complete_state(
       options, cwd, options.subdir, False)
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
-  complete_state.save_files()
+  bundles = complete_state.save_files(bundles_dir)
 
   infiles = complete_state.saved_state.files
+  if bundles:
+    infiles = infiles.copy()
+    for path, metadata, relpaths in bundles:
+      for relpath in relpaths:
+        del infiles[relpath]
+      infiles[path] = metadata
   # Add all the .isolated files.
   isolated_hash = []
   isolated_files = [
@@ -764,7 +791,8 @@ def prepare_for_archival(options, cwd):
   return complete_state, infiles, isolated_hash
 
 
-def isolate_and_archive(trees, isolate_server, namespace):
+def isolate_and_archive(
+    trees, isolate_server, namespace, presence_cache=None, bundle=False):
   """Isolates and uploads a bunch of isolated trees.
 
   Args:
@@ -772,6 +800,11 @@ def isolate_and_archive(trees, isolate_server, namespace):
         to isolate. Options are processed by 'process_isolate_options'.
     isolate_server: URL of Isolate Server to upload to.
     namespace: namespace to upload to.
+    presence_cache: optional isolateserver.PresenceCache. The files of the trees
+        it knows were fully uploaded recently are not looked up at all.
+    bundle: if True, the small files of all the trees are uploaded in bundles,
+        see isolateserver.bundle_small_files(). Each tree can also enable it
+        with its own --bundle-small-files.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -785,6 +818,21 @@ def isolate_and_archive(trees, isolate_server, namespace):
   if not trees:
     return {}
 
+  # The bundles are kept until they are uploaded.
+  bundles_dir = None
+  if bundle or any(opts.bundle_small_files for opts, _ in trees):
+    bundles_dir = tempfile.mkdtemp(prefix=u'isolate')
+  try:
+    return _isolate_and_archive(
+        trees, isolate_server, namespace, presence_cache, bundle, bundles_dir)
+  finally:
+    if bundles_dir:
+      file_path.rmtree(bundles_dir)
+
+
+def _isolate_and_archive(
+    trees, isolate_server, namespace, presence_cache, bundle, bundles_dir):
+  """Implements isolate_and_archive() once the bundles directory is created."""
   # Helper generator to avoid materializing the full (huge) list of files until
   # the very end (in upload_tree).
   def emit_files(root_dir, files):
@@ -797,12 +845,22 @@ def isolate_and_archive(trees, isolate_server, namespace):
   # this function.
   files_generators = []
   isolated_hashes = {}
+  # Trees whose files are checked against the server in this run. The trees
+  # found in |presence_cache| are not, their timestamp must not be refreshed.
+  checked_trees = []
   with tools.Profiler('Isolate'):
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
-        files_generators.append(emit_files(complete_state.root_dir, files))
+        complete_state, files, isolated_hash = prepare_for_archival(
+            opts, cwd,
+            bundles_dir if bundle or opts.bundle_small_files else None)
+        if presence_cache and presence_cache.contains_tree(
+            isolate_server, namespace, isolated_hash[0]):
+          logging.info('%s was recently uploaded', target_name)
+        else:
+          files_generators.append(emit_files(complete_state.root_dir, files))
+          checked_trees.append(isolated_hash[0])
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
       except Exception:
@@ -819,11 +877,16 @@ def isolate_and_archive(trees, isolate_server, namespace):
       isolateserver.upload_tree(
           base_url=isolate_server,
           infiles=itertools.chain(*files_generators),
-          namespace=namespace)
+          namespace=namespace,
+          presence_cache=presence_cache)
     except Exception:
       logging.exception('Exception while uploading files')
       return None
 
+  if presence_cache:
+    for isolated_hash in checked_trees:
+      presence_cache.add_tree(isolate_server, namespace, isolated_hash)
+
   return isolated_hashes
 
 
@@ -861,10 +924,13 @@ def CMDarchive(parser, args):
   process_isolate_options(parser, options)
   auth.process_auth_options(parser, options)
   isolateserver.process_isolate_server_options(parser, options, True, True)
-  result = isolate_and_archive(
-      [(options, unicode(os.getcwd()))],
-      options.isolate_server,
-      options.namespace)
+  with isolateserver.open_presence_cache(
+      options.presence_cache) as presence_cache:
+    result = isolate_and_archive(
+        [(options, unicode(os.getcwd()))],
+        options.isolate_server,
+        options.namespace,
+        presence_cache)
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -923,8 +989,11 @@ def CMDbatcharchive(parser, args):
     work_units.append((parse_archive_command_line(args, cwd), cwd))
 
   # Perform the archival, all at once.
-  isolated_hashes = isolate_and_archive(
-      work_units, options.isolate_server, options.namespace)
+  with isolateserver.open_presence_cache(
+      options.presence_cache) as presence_cache:
+    isolated_hashes = isolate_and_archive(
+        work_units, options.isolate_server, options.namespace, presence_cache,
+        options.bundle_small_files)
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
@@ -12,12 +12,12 @@ import os
 import re
 import sys
 import threading
-import time
 import types
 import uuid
 
 from utils import file_path
 from utils import net
+from utils import threading_utils
 
 import isolated_format
 
@@ -25,21 +25,50 @@ try:
   import grpc # for error codes
   from utils import grpc_proxy
   from proto import bytestream_pb2
+  from proto import cas_pb2
+  from proto import cas_pb2_grpc
 except ImportError as err:
   grpc = None
   grpc_proxy = None
   bytestream_pb2 = None
+  cas_pb2 = None
+  cas_pb2_grpc = None
 
 
 # Chunk size to use when reading from network stream.
 NET_IO_FILE_CHUNK = 16 * 1024
 
 
+# Maximum number of bytes buffered in memory by a single streamed upload. It is
+# one chunk read from disk (and its compressed counterpart).
+UPLOAD_BUFFER_SIZE = isolated_format.DISK_FILE_CHUNK
+
+
+# Default maximum number of megabytes held in memory by all the pushes at once,
+# see set_memory_budget().
+DEFAULT_MEMORY_BUDGET_MB = 512 if sys.maxsize <= 2**32 else 2048
+
+
+# Number of times a broken gRPC Read stream is resumed, and the gRPC status
+# codes worth resuming it for.
+GRPC_READ_ATTEMPTS = 5
+GRPC_RESUMABLE_CODES = (
+    'ABORTED',
+    'DEADLINE_EXCEEDED',
+    'UNAVAILABLE',
+)
+
+
 # Read timeout in seconds for downloads from isolate storage. If there's no
 # response from the server within this timeout whole download will be aborted.
 DOWNLOAD_READ_TIMEOUT = 60
 
 
+# Memory used by the pushes of all the StorageApi instances.
+_memory_budget = threading_utils.MemoryBudget(
+    DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024)
+
+
 # Stores the gRPC proxy address. Must be set if the storage API class is
 # IsolateServerGrpc (call 'set_grpc_proxy').
 _grpc_proxy = None
@@ -67,6 +96,14 @@ class Item(object):
     """Iterable with content of this item as byte string (str) chunks."""
     raise NotImplementedError()
 
+  def content_at(self, offset):
+    """Iterable with content of this item starting at byte |offset|.
+
+    The default implementation reads and discards the first |offset| bytes of
+    content(). Subclasses that can seek in their data should override it.
+    """
+    return skip_bytes(self.content(), offset)
+
   def prepare(self, hash_algo):
     """Ensures self.digest and self.size are set.
 
@@ -86,6 +123,54 @@ class Item(object):
       self.size = total
 
 
+class RestartableContent(object):
+  """Data of an Item to push, that can be read again from any offset.
+
+  Iterating over it yields the whole data. A StorageApi implementation that
+  knows how many bytes the server already committed can call iter_from() to
+  resume a failed push without rereading from the start or keeping the data in
+  memory.
+  """
+
+  def __init__(self, item, transform=None):
+    """Arguments:
+      item: Item which data is pushed.
+      transform: optional function applied to item.content(), e.g. zip
+          compression. A transformed stream can't be seeked into, so it is
+          regenerated from the beginning and the already pushed prefix is
+          skipped.
+    """
+    self.item = item
+    self._transform = transform
+
+  def __iter__(self):
+    return self.iter_from(0)
+
+  def iter_from(self, offset):
+    """Generator that yields the data starting at byte |offset|."""
+    assert offset >= 0, offset
+    if self._transform:
+      source = skip_bytes(self._transform(self.item.content()), offset)
+    elif offset:
+      source = self.item.content_at(offset)
+    else:
+      source = self.item.content()
+    for chunk in source:
+      yield chunk
+
+
+def skip_bytes(content, offset):
+  """Yields chunks of |content| without its first |offset| bytes."""
+  for chunk in content:
+    if offset >= len(chunk):
+      offset -= len(chunk)
+      continue
+    if offset:
+      chunk = chunk[offset:]
+      offset = 0
+    yield chunk
+
+
 class StorageApi(object):
   """Interface for classes that implement low-level storage operations.
 
@@ -118,12 +203,23 @@ class StorageApi(object):
     """
     return False
 
-  def fetch(self, digest, offset=0):
+  @property
+  def batch_limits(self):
+    """Limits of fetch_batch() and push_batch(), None if not supported.
+
+    Returns:
+      tuple(maximum number of items, maximum total size of the items in bytes).
+    """
+    return None
+
+  def fetch(self, digest, offset=0, length=None):
     """Fetches an object and yields its content.
 
     Arguments:
       digest: hash digest of item to download.
       offset: offset (in bytes) from the start of the file to resume fetch from.
+      length: number of bytes to fetch starting at |offset|, or None to fetch
+          up to the end of the file.
 
     Yields:
       Chunks of downloaded item (as str objects).
@@ -147,10 +243,47 @@ class StorageApi(object):
     a source of original uncompressed data). This is implemented by Storage
     class.
 
+    |content| is usually a RestartableContent, so a retried push can restart
+    from where the server stopped instead of rereading the whole data.
+
     Arguments:
       item: Item object that holds information about an item being pushed.
       push_state: push state object as returned by 'contains' call.
-      content: a generator that yields chunks to push, item.content() if None.
+      content: a RestartableContent, list or generator that yields chunks to
+          push, item.content() if None.
+
+    Returns:
+      None.
+    """
+    raise NotImplementedError()
+
+  def fetch_batch(self, digests):
+    """Fetches small objects in a single round-trip.
+
+    Only supported if batch_limits is not None. The objects that can't be
+    fetched this way, e.g. because they are too large, are left out and must
+    be fetched with fetch().
+
+    Arguments:
+      digests: list of hash digests of the items to download.
+
+    Returns:
+      A dict digest -> content of the items fetched.
+    """
+    raise NotImplementedError()
+
+  def can_push_in_batch(self, item, push_state):
+    """Returns True if |item| can be pushed with push_batch()."""
+    return False
+
+  def push_batch(self, pushes):
+    """Uploads small items in a single round-trip.
+
+    Only supported if batch_limits is not None and for items accepted by
+    can_push_in_batch(). It either uploads all the items or none.
+
+    Arguments:
+      pushes: list of tuple(item, push_state, content), see push().
 
     Returns:
       None.
@@ -190,54 +323,24 @@ class _IsolateServerPushState(object):
     self.size = size
 
 
-def guard_memory_use(server, content, size):
-  """Guards a server against using excessive memory while uploading.
+def guard_memory_use(content, size):
+  """Holds the memory used to push |content| in the memory budget.
 
-  The server needs to contain a _memory_use int and a _lock mutex
-  (both IsolateServer and IsolateServerGrpc qualify); this function
-  then uses those values to track memory usage in a thread-safe way.
+  |content| that is already in memory (str or list) is accounted for its full
+  |size| without waiting, it's too late. A generator is streamed and only ever
+  holds UPLOAD_BUFFER_SIZE bytes at once, so this is what is waited for.
 
-  If a request would cause the memory usage to exceed a safe maximum,
-  this function sleeps in 0.1s increments until memory usage falls
-  below the maximum.
+  Returns:
+    The number of bytes held, to be released by the caller with
+    get_memory_budget().release().
   """
   if isinstance(content, (basestring, list)):
-    # Memory is already used, too late.
-    with server._lock:
-      server._memory_use += size
-  else:
-    # TODO(vadimsh): Do not read from |content| generator when retrying push.
-    # If |content| is indeed a generator, it can not be re-winded back to the
-    # beginning of the stream. A retry will find it exhausted. A possible
-    # solution is to wrap |content| generator with some sort of caching
-    # restartable generator. It should be done alongside streaming support
-    # implementation.
-    #
-    # In theory, we should keep the generator, so that it is not serialized in
-    # memory. Sadly net.HttpService.request() requires the body to be
-    # serialized.
-    assert isinstance(content, types.GeneratorType), repr(content)
-    slept = False
-    # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-    # One byte less than 512mb. This is to cope with incompressible content.
-    max_size = int(sys.maxsize * 0.25)
-    while True:
-      with server._lock:
-        # This is due to 32 bits python when uploading very large files. The
-        # problem is that it's comparing uncompressed sizes, while we care
-        # about compressed sizes since it's what is serialized in memory.
-        # The first check assumes large files are compressible and that by
-        # throttling one upload at once, we can survive. Otherwise, kaboom.
-        memory_use = server._memory_use
-        if ((size >= max_size and not memory_use) or
-            (memory_use + size <= max_size)):
-          server._memory_use += size
-          memory_use = server._memory_use
-          break
-      time.sleep(0.1)
-      slept = True
-    if slept:
-      logging.info('Unblocked: %d %d', memory_use, size)
+    _memory_budget.acquire(size, wait=False)
+    return size
+  assert isinstance(content, types.GeneratorType), repr(content)
+  size = min(size, UPLOAD_BUFFER_SIZE)
+  _memory_budget.acquire(size)
+  return size
 
 
 class IsolateServer(StorageApi):
@@ -260,7 +363,6 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
 
   @property
   def _server_capabilities(self):
@@ -290,8 +392,16 @@ class IsolateServer(StorageApi):
   def namespace(self):
     return self._namespace
 
-  def fetch(self, digest, offset=0):
+  @property
+  def batch_limits(self):
+    batch = (self._server_capabilities or {}).get('batch')
+    if not batch:
+      return None
+    return int(batch['max_items']), int(batch['max_size'])
+
+  def fetch(self, digest, offset=0, length=None):
     assert offset >= 0
+    assert length is None or length > 0
     source_url = '%s/api/isolateservice/v1/retrieve' % (
         self._base_url)
     logging.debug('download_file(%s, %d)', source_url, offset)
@@ -305,16 +415,23 @@ class IsolateServer(StorageApi):
     # for DB uploads
     content = response.get('content')
     if content is not None:
-      yield base64.b64decode(content)
+      content = base64.b64decode(content)
+      yield content[:length] if length is not None else content
       return
 
     # for GS entities
-    connection = net.url_open(response['url'])
+    headers = None
+    if length is not None:
+      headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    elif offset:
+      headers = {'Range': 'bytes=%d-' % offset}
+    connection = net.url_open(response['url'], headers=headers)
     if not connection:
       raise IOError('Failed to download %s / %s' % (self._namespace, digest))
 
-    # If |offset|, verify server respects it by checking Content-Range.
-    if offset:
+    # If a range was requested, verify server respects it by checking
+    # Content-Range.
+    if headers:
       content_range = connection.get_header('Content-Range')
       if not content_range:
         raise IOError('Missing Content-Range header')
@@ -337,8 +454,12 @@ class IsolateServer(StorageApi):
         raise IOError('Expecting offset %d, got %d (Content-Range is %s)' % (
             offset, content_offset, content_range))
 
-      # Ensure entire tail of the file is returned.
-      if size is not None and last_byte_index + 1 != size:
+      # Ensure the entire requested range is returned, it can only be cut
+      # short by the end of the file.
+      end = None if length is None else offset + length
+      if size is not None:
+        end = size if end is None else min(end, size)
+      if end is not None and last_byte_index + 1 != end:
         raise IOError('Incomplete response. Content-Range: %s' % content_range)
 
     for data in connection.iter_content(NET_IO_FILE_CHUNK):
@@ -353,8 +474,14 @@ class IsolateServer(StorageApi):
 
     # Default to item.content().
     content = item.content() if content is None else content
+    if isinstance(content, RestartableContent):
+      # Signed GS URLs do not support resuming an upload, always start over.
+      content = content.iter_from(0)
     logging.info('Push state size: %d', push_state.size)
-    guard_memory_use(self, content, push_state.size)
+    if not push_state.finalize_url and not isinstance(content, list):
+      # DB uploads are not streamed, they are base64 encoded in a JSON body.
+      content = list(content)
+    memory_use = guard_memory_use(content, push_state.size)
 
     try:
       # This push operation may be a retry after failed finalization call below,
@@ -388,8 +515,61 @@ class IsolateServer(StorageApi):
           raise IOError('Failed to finalize file with hash %s.' % item.digest)
       push_state.finalized = True
     finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+      _memory_budget.release(memory_use)
+
+  def fetch_batch(self, digests):
+    response = net.url_read_json(
+        url='%s/api/isolateservice/v1/retrieve_batch' % self._base_url,
+        data={
+            'digests': [d.encode('utf-8') for d in digests],
+            'namespace': self._namespace_dict,
+        },
+        read_timeout=DOWNLOAD_READ_TIMEOUT)
+    if not response:
+      raise IOError('Failed to fetch a batch of %d items' % len(digests))
+    # Items stored in GS have no 'content'.
+    try:
+      return {
+        i['digest']: base64.b64decode(i['content'])
+        for i in response.get('items', []) if i.get('content') is not None
+      }
+    except (AttributeError, KeyError, TypeError) as e:
+      # The items are then fetched one by one.
+      raise IOError('Invalid response to a batch fetch: %s' % e)
+
+  def can_push_in_batch(self, item, push_state):
+    # Only DB uploads, GS ones are uploaded directly to their signed URL.
+    return not push_state.finalize_url
+
+  def push_batch(self, pushes):
+    contents = []
+    for item, push_state, content in pushes:
+      assert item.digest is not None and item.size is not None
+      assert self.can_push_in_batch(item, push_state)
+      assert not push_state.finalized
+      content = item.content() if content is None else content
+      if isinstance(content, RestartableContent):
+        content = content.iter_from(0)
+      contents.append(''.join(content))
+    memory_use = guard_memory_use(contents, sum(len(c) for c in contents))
+    try:
+      response = net.url_read_json(
+          url='%s/api/isolateservice/v1/store_inline_batch' % self._base_url,
+          data={
+            'items': [
+              {
+                'content': base64.b64encode(data),
+                'upload_ticket': state.preupload_status['upload_ticket'],
+              } for (_, state, _), data in zip(pushes, contents)
+            ],
+          })
+      if not response or not response['ok']:
+        raise IOError('Failed to upload a batch of %d items' % len(pushes))
+      for _, push_state, _ in pushes:
+        push_state.uploaded = True
+        push_state.finalized = True
+    finally:
+      _memory_budget.release(memory_use)
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -465,17 +645,13 @@ class IsolateServer(StorageApi):
     subclasses.
 
     Args:
-      url: URL to upload the data to.
       push_state: an _IsolateServicePushState instance
-      item: the original Item to be uploaded
-      content: an iterable that yields 'str' chunks.
+      content: a list of 'str' chunks already in memory or a generator that
+          yields 'str' chunks to stream to GS.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
+    if isinstance(content, list):
+      # A cheezy way to avoid memcpy of (possibly huge) file.
+      content = content[0] if len(content) == 1 else ''.join(content)
 
     # DB upload
     if not push_state.finalize_url:
@@ -488,7 +664,7 @@ class IsolateServer(StorageApi):
       response = net.url_read_json(url=url, data=data)
       return response is not None and response['ok']
 
-    # upload to GS
+    # upload to GS; a generator is streamed with chunked transfer encoding.
     url = push_state.upload_url
     response = net.url_read(
         content_type='application/octet-stream',
@@ -500,17 +676,28 @@ class IsolateServer(StorageApi):
 
 
 class _IsolateServerGrpcPushState(object):
-  """Empty class, just to present same interface as IsolateServer  """
+  """Per-item state passed from IsolateServerGrpc.contains to push.
+
+  Keeps the resource name of the upload, so a retried push resumes it after the
+  bytes already committed.
+  """
 
   def __init__(self):
-    pass
+    self.resource_name = None
+
+
+def _grpc_code(error):
+  """Returns the grpc.StatusCode of a grpc.RpcError, None if it has none."""
+  return error.code() if hasattr(error, 'code') else None
 
 
 class IsolateServerGrpc(StorageApi):
   """StorageApi implementation that downloads and uploads to a gRPC service.
 
-  Limitations: only works for the default-gzip namespace, and with zero offsets
-  while fetching.
+  Limitations: only works for the default-gzip namespace.
+
+  Broken Read streams are resumed after the last byte received, and retried
+  pushes resume the upload after the bytes the server committed.
   """
 
   def __init__(self, server, namespace, proxy):
@@ -521,10 +708,11 @@ class IsolateServerGrpc(StorageApi):
     assert namespace == 'default-gzip'
     self._server = server
     self._lock = threading.Lock()
-    self._memory_use = 0
-    self._num_pushes = 0
-    self._already_exists = 0
     self._proxy = grpc_proxy.Proxy(proxy, bytestream_pb2.ByteStreamStub)
+    self._cas_proxy = grpc_proxy.Proxy(
+        proxy, cas_pb2_grpc.ContentAddressableStorageStub)
+    # Set to False if the proxy doesn't implement FindMissingBlobs.
+    self._find_missing_supported = True
     self._namespace = namespace
 
 
@@ -541,19 +729,34 @@ class IsolateServerGrpc(StorageApi):
     # gRPC natively compresses all messages before transmission.
     return True
 
-  def fetch(self, digest, offset=0):
-    # The gRPC APIs only work with an offset of 0
-    assert offset == 0
+  def fetch(self, digest, offset=0, length=None):
     request = bytestream_pb2.ReadRequest()
     #TODO(aludwin): send the expected size of the item
     request.resource_name = '%s/blobs/%s/0' % (
         self._proxy.prefix, digest)
-    try:
-      for response in self._proxy.get_stream('Read', request):
-        yield response.data
-    except grpc.RpcError as g:
-      logging.error('gRPC error during fetch: re-throwing as IOError (%s)' % g)
-      raise IOError(g)
+    end = None if length is None else offset + length
+    attempt = 0
+    while True:
+      # A broken stream is resumed after the last byte received.
+      request.read_offset = offset
+      # A read_limit of 0 means no limit.
+      request.read_limit = 0 if end is None else end - offset
+      try:
+        for response in self._proxy.get_stream('Read', request):
+          offset += len(response.data)
+          yield response.data
+        return
+      except grpc.RpcError as g:
+        attempt += 1
+        code = _grpc_code(g)
+        if (attempt >= GRPC_READ_ATTEMPTS or code is None or
+            code.name not in GRPC_RESUMABLE_CODES):
+          logging.error(
+              'gRPC error during fetch: re-throwing as IOError (%s)' % g)
+          raise IOError(g)
+        logging.warning(
+            'gRPC error during fetch of %s, resuming at offset %d (%s)',
+            digest, offset, g)
 
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
@@ -561,10 +764,25 @@ class IsolateServerGrpc(StorageApi):
     assert item.size is not None
     assert isinstance(push_state, _IsolateServerGrpcPushState)
 
+    # A retried push resumes the upload where the server stopped.
+    offset = 0
+    if push_state.resource_name:
+      offset, complete = self._query_write_status(push_state.resource_name)
+      if complete:
+        return
+      logging.info('Resuming push of %s at offset %d', item.digest, offset)
+    else:
+      push_state.resource_name = '%s/uploads/%s/blobs/%s/%d' % (
+          self._proxy.prefix, uuid.uuid4(), item.digest, item.size)
+
     # Default to item.content().
     content = item.content() if content is None else content
-    guard_memory_use(self, content, item.size)
-    self._num_pushes += 1
+    if isinstance(content, RestartableContent):
+      content = content.iter_from(offset)
+    elif offset:
+      content = skip_bytes(
+          [content] if isinstance(content, str) else content, offset)
+    memory_use = guard_memory_use(content, item.size - offset)
 
     try:
       def chunker():
@@ -577,37 +795,38 @@ class IsolateServerGrpc(StorageApi):
             yield chunk
       def slicer():
         # Ensures every bit of content is under the gRPC max size; yields
-        # proto messages to send via gRPC.
+        # proto messages to send via gRPC. The chunks are sliced at increasing
+        # positions instead of being cut down, so each byte is copied once.
         request = bytestream_pb2.WriteRequest()
-        u = uuid.uuid4()
-        request.resource_name = '%s/uploads/%s/blobs/%s/%d' % (
-            self._proxy.prefix, u, item.digest, item.size)
-        request.write_offset = 0
+        request.resource_name = push_state.resource_name
+        request.write_offset = offset
+        sent = False
         for chunk in chunker():
-          # Make sure we send at least one chunk for zero-length blobs
-          has_sent_anything = False
-          while chunk or not has_sent_anything:
-            has_sent_anything = True
-            slice_len = min(len(chunk), NET_IO_FILE_CHUNK)
-            request.data = chunk[:slice_len]
-            if request.write_offset + slice_len == item.size:
-              request.finish_write = True
+          view = memoryview(chunk)
+          pos = 0
+          while pos < len(chunk):
+            slice_len = min(len(chunk) - pos, NET_IO_FILE_CHUNK)
+            request.data = view[pos:pos+slice_len].tobytes()
+            request.finish_write = (
+                request.write_offset + slice_len == item.size)
             yield request
+            sent = True
             request.write_offset += slice_len
-            chunk = chunk[slice_len:]
+            pos += slice_len
+        if not sent:
+          # Make sure we send at least one chunk for zero-length blobs, or when
+          # only the finalization was missing.
+          request.data = ''
+          request.finish_write = True
+          yield request
 
       response = None
       try:
         response = self._proxy.call_no_retries('Write', slicer())
       except grpc.RpcError as r:
-        if r.code() == grpc.StatusCode.ALREADY_EXISTS:
-          # This is legit - we didn't check before we pushed so no problem if
-          # it's already there.
-          self._already_exists += 1
-          if self._already_exists % 100 == 0:
-            logging.info('unnecessarily pushed %d/%d blobs (%.1f%%)' % (
-                self._already_exists, self._num_pushes,
-                100.0 * self._already_exists / self._num_pushes))
+        if _grpc_code(r) == grpc.StatusCode.ALREADY_EXISTS:
+          # This is legit - another client pushed it since it was checked.
+          logging.info('%s was already pushed', item.digest)
         else:
           logging.error('gRPC error during push: throwing as IOError (%s)' % r)
           raise IOError(r)
@@ -620,23 +839,75 @@ class IsolateServerGrpc(StorageApi):
             item.digest, item.size, response.committed_size))
 
     finally:
-      with self._lock:
-        self._memory_use -= item.size
+      _memory_budget.release(memory_use)
+
+  def _query_write_status(self, resource_name):
+    """Returns tuple(committed size, complete) of an upload.
+
+    An upload unknown to the server has nothing committed.
+    """
+    request = bytestream_pb2.QueryWriteStatusRequest()
+    request.resource_name = resource_name
+    try:
+      response = self._proxy.call_unary('QueryWriteStatus', request)
+    except grpc.RpcError as g:
+      if _grpc_code(g) == grpc.StatusCode.NOT_FOUND:
+        return 0, False
+      logging.error(
+          'gRPC error during QueryWriteStatus: throwing as IOError (%s)' % g)
+      raise IOError(g)
+    return response.committed_size, response.complete
 
   def contains(self, items):
-    """Returns the set of all missing items."""
-    # TODO(aludwin): this isn't supported directly in Bytestream, so for now
-    # assume that nothing is present in the cache.
     # Ensure all items were initialized with 'prepare' call. Storage does that.
     assert all(i.digest is not None and i.size is not None for i in items)
-    # Assume all Items are missing, and attach _PushState to them. The gRPC
-    # implementation doesn't actually have a push state, we just attach empty
-    # objects to satisfy the StorageApi interface.
+    missing = items
+    if self._find_missing_supported:
+      missing = self._find_missing(items)
+    # The gRPC implementation doesn't actually have a push state, we just
+    # attach empty objects to satisfy the StorageApi interface.
     missing_items = {}
-    for item in items:
+    for item in missing:
       missing_items[item] = _IsolateServerGrpcPushState()
+    logging.info('Queried %d files, %d cache hit',
+        len(items), len(items) - len(missing_items))
     return missing_items
 
+  def _find_missing(self, items):
+    """Returns the |items| missing on the server, with one FindMissingBlobs.
+
+    If the proxy doesn't implement it, all the items are assumed missing from
+    then on.
+    """
+    request = cas_pb2.FindMissingBlobsRequest()
+    request.instance_name = self._proxy.prefix
+    for item in items:
+      digest = request.blob_digests.add()
+      digest.hash = item.digest
+      digest.size_bytes = item.size
+    try:
+      response = self._cas_proxy.call_unary('FindMissingBlobs', request)
+    except grpc.RpcError as g:
+      if _grpc_code(g) == grpc.StatusCode.UNIMPLEMENTED:
+        logging.warning(
+            'FindMissingBlobs is not supported, pushing all the items')
+        self._find_missing_supported = False
+        return items
+      logging.error('gRPC error during contains: throwing as IOError (%s)' % g)
+      raise IOError(g)
+    missing = set(d.hash for d in response.missing_blob_digests)
+    return [i for i in items if i.digest in missing]
+
+
+def get_memory_budget():
+  """Returns the threading_utils.MemoryBudget shared by all the pushes."""
+  return _memory_budget
+
+
+def set_memory_budget(megabytes):
+  """Sets the maximum number of megabytes held by all the pushes at once."""
+  _memory_budget.max_size = megabytes * 1024 * 1024
+
 
 def set_grpc_proxy(proxy):
   """Sets the StorageApi to use the specified proxy."""
@@ -14,6 +14,7 @@ import sys
 
 from utils import file_path
 from utils import fs
+from utils import threading_utils
 from utils import tools
 
 
@@ -25,6 +26,17 @@ ISOLATED_FILE_VERSION = '1.6'
 DISK_FILE_CHUNK = 1024 * 1024
 
 
+# Chunk size to use when hashing a file. Large sequential reads are faster and
+# hashlib releases the GIL while hashing each of them, so files hashed on
+# parallel threads use all the cores.
+HASH_FILE_CHUNK = 4 * 1024 * 1024
+
+
+# Maximum number of files queued for hashing per hashing thread. It keeps the
+# threads busy without holding all the files of a large tree in memory.
+HASH_FILES_PER_THREAD = 4
+
+
 # Sadly, hashlib uses 'sha1' instead of the standard 'sha-1' so explicitly
 # specify the names here.
 SUPPORTED_ALGOS = {
@@ -75,7 +87,7 @@ def hash_file(filepath, algo):
   digest = algo()
   with fs.open(filepath, 'rb') as f:
     while True:
-      chunk = f.read(DISK_FILE_CHUNK)
+      chunk = f.read(HASH_FILE_CHUNK)
       if not chunk:
         break
       digest.update(chunk)
@@ -213,6 +225,14 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
   with:
     ln -s .. foo
   """
+  return list(iter_directory_and_symlink(
+      indir, relfile, blacklist, follow_symlinks))
+
+
+def iter_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
+  """Same as expand_directory_and_symlink() but yields the outputs as the
+  directories are walked.
+  """
   if os.path.isabs(relfile):
     raise MappingError('Can\'t map absolute path %s' % relfile)
 
@@ -261,21 +281,22 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
     # Special case './'.
     if relfile.startswith('.' + os.path.sep):
       relfile = relfile[2:]
-    outfiles = symlinks
+    for symlink in symlinks:
+      yield symlink
     try:
-      for filename in fs.listdir(infile):
-        inner_relfile = os.path.join(relfile, filename)
-        if blacklist and blacklist(inner_relfile):
-          continue
-        if os.path.isdir(os.path.join(indir, inner_relfile)):
-          inner_relfile += os.path.sep
-        outfiles.extend(
-            expand_directory_and_symlink(indir, inner_relfile, blacklist,
-                                         follow_symlinks))
-      return outfiles
+      filenames = fs.listdir(infile)
     except OSError as e:
       raise MappingError(
           'Unable to iterate over directory %s.\n%s' % (infile, e))
+    for filename in filenames:
+      inner_relfile = os.path.join(relfile, filename)
+      if blacklist and blacklist(inner_relfile):
+        continue
+      if os.path.isdir(os.path.join(indir, inner_relfile)):
+        inner_relfile += os.path.sep
+      for outfile in iter_directory_and_symlink(
+          indir, inner_relfile, blacklist, follow_symlinks):
+        yield outfile
   else:
     # Always add individual files even if they were blacklisted.
     if os.path.isdir(infile):
@@ -285,7 +306,9 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
     if not os.path.isfile(infile):
       raise MappingError('Input file %s doesn\'t exist' % infile)
 
-    return symlinks + [relfile]
+    for symlink in symlinks:
+      yield symlink
+    yield relfile
 
 
 def expand_directories_and_symlinks(
@@ -309,7 +332,8 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
+def file_to_metadata(
+    filepath, prevdict, read_only, algo, collapse_symlinks, hash_cache=None):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -328,6 +352,8 @@ def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
     algo:      Hashing algorithm used.
     collapse_symlinks: True if symlinked files should be treated like they were
                        the normal underlying file.
+    hash_cache: optional hash_cache.HashCache to look up and save the digest
+                of the file when it is not in |prevdict|.
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
@@ -380,8 +406,12 @@ def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
         prevdict.get('s') == out['s']):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
+    if not out.get('h') and hash_cache:
+      out['h'] = hash_cache.get(algo, filestats)
     if not out.get('h'):
       out['h'] = hash_file(filepath, algo)
+      if hash_cache:
+        hash_cache.add(algo, filepath, filestats, out['h'])
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -400,6 +430,64 @@ def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
   return out
 
 
+def iter_file_to_metadata(
+    files, read_only, algo, collapse_symlinks, ordered=True, threads=None,
+    hash_cache=None):
+  """Runs file_to_metadata() on many files in parallel.
+
+  Arguments:
+    files: iterable of tuple(filepath, prevdict). It is consumed as the files
+        are processed, so it can be a generator walking a directory.
+    read_only, algo, collapse_symlinks: see file_to_metadata().
+    ordered: if True, the results are yielded in the order of |files|.
+        Otherwise each result is yielded as soon as it is ready.
+    threads: number of hashing threads, defaults to the number of cores.
+    hash_cache: optional hash_cache.HashCache, see file_to_metadata().
+
+  Yields:
+    tuple(filepath, metadata) for each file.
+  """
+  threads = threads or max(threading_utils.num_processors(), 2)
+  channel = threading_utils.TaskChannel()
+
+  @channel.wrap_task
+  def to_metadata(index, filepath, prevdict):
+    return index, filepath, file_to_metadata(
+        filepath, prevdict, read_only, algo, collapse_symlinks, hash_cache)
+
+  files = iter(files)
+  exhausted = False
+  # Number of files added to the pool and not yet pulled from |channel|.
+  pending = 0
+  index = 0
+  # Results waiting for the previous ones to be yielded, when |ordered|.
+  ready = {}
+  next_index = 0
+  with threading_utils.ThreadPool(1, threads, 0, 'hash') as pool:
+    while True:
+      while not exhausted and pending < threads * HASH_FILES_PER_THREAD:
+        try:
+          filepath, prevdict = next(files)
+        except StopIteration:
+          exhausted = True
+          break
+        pool.add_task(threading_utils.PRIORITY_MED, to_metadata, index,
+                      filepath, prevdict)
+        index += 1
+        pending += 1
+      if not pending:
+        break
+      i, filepath, metadata = channel.pull()
+      pending -= 1
+      if not ordered:
+        yield filepath, metadata
+        continue
+      ready[i] = (filepath, metadata)
+      while next_index in ready:
+        yield ready.pop(next_index)
+        next_index += 1
+
+
 def save_isolated(isolated, data):
   """Writes one or multiple .isolated files.
 
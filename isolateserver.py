@@ -7,19 +7,26 @@
 
 __version__ = '0.8.0'
 
+import collections
+import contextlib
 import errno
 import functools
+import hashlib
 import io
+import json
 import logging
 import optparse
 import os
 import re
 import signal
 import stat
+import struct
 import sys
 import tarfile
 import tempfile
+import threading
 import time
+import types
 import zlib
 
 from third_party import colorama
@@ -27,12 +34,15 @@ from third_party.depot_tools import fix_encoding
 from third_party.depot_tools import subcommand
 
 from libs import arfile
+from utils import file_lock
 from utils import file_path
 from utils import fs
+from utils import hash_cache as hash_cache_module
 from utils import logging_utils
 from utils import lru
 from utils import net
 from utils import on_error
+from utils import shared_lru
 from utils import subprocess42
 from utils import threading_utils
 from utils import tools
@@ -72,6 +82,70 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# The batch size and the number of concurrent /pre-upload queries are then
+# adapted to the server's response time, see ContainsController. They grow
+# additively while the queries take less than CONTAINS_TARGET_LATENCY seconds.
+# The batch size is halved when a query is slower, both are halved when a query
+# fails.
+CONTAINS_TARGET_LATENCY = 3.
+CONTAINS_MAX_BATCH_SIZE = 500
+CONTAINS_BATCH_SIZE_STEP = 20
+CONTAINS_INITIAL_CONCURRENCY = 4
+CONTAINS_MAX_CONCURRENCY = 16
+
+
+# Number of seconds a digest confirmed present on the server is assumed to
+# still be there, when a PresenceCache is used. Entries are evicted from the
+# server only after days without being referenced.
+PRESENCE_CACHE_TTL = 60 * 60
+
+# Maximum number of digests kept in a PresenceCache file.
+PRESENCE_CACHE_MAX_ITEMS = 100000
+
+
+# Items at least this large are fetched through a partial file in the cache, so
+# an interrupted fetch can be resumed instead of restarted. This costs an extra
+# read of the fetched data, which is not worth it for smaller items.
+RESUMABLE_FETCH_MIN_SIZE = 64 * 1024 * 1024
+
+
+# Items with at least this many bytes left to fetch are downloaded over
+# PARALLEL_FETCH_CONNECTIONS connections, each one fetching ranges of
+# PARALLEL_FETCH_RANGE_SIZE bytes. Only done when the data is not compressed, so
+# each range can be written at its offset in the partial file.
+PARALLEL_FETCH_MIN_SIZE = 128 * 1024 * 1024
+PARALLEL_FETCH_RANGE_SIZE = 16 * 1024 * 1024
+PARALLEL_FETCH_CONNECTIONS = 4
+
+
+# The data fetched goes through three stages: the network, the decompression
+# and verification, and the write to the cache. Each one runs in its own thread
+# pool, see Storage.async_fetch(). The stages are connected by pipes of at most
+# FETCH_NETWORK_PIPE_SIZE network chunks and FETCH_DISK_PIPE_SIZE decompressed
+# chunks, so a slow disk only stalls the network once the pipes are full.
+FETCH_INFLATE_THREADS = 16
+FETCH_DISK_THREADS = 16
+FETCH_NETWORK_PIPE_SIZE = 64
+FETCH_DISK_PIPE_SIZE = 4
+
+# Number of threads creating the files of an isolated tree as their content
+# arrives in the cache, see fetch_isolated().
+MATERIALIZE_THREADS = 8
+
+# Items of at most this size are fetched in batches, in a single request, when
+# the server supports it. The server only returns inline the ones it stores in
+# its database, the others are fetched one by one.
+BATCH_FETCH_MAX_ITEM_SIZE = 64 * 1024
+
+
+# When bundling is enabled, the files up to BUNDLE_MAX_FILE_SIZE bytes are
+# packed in ar bundles of up to BUNDLE_MAX_SIZE bytes, see bundle_small_files().
+# On average a bundle is cut every BUNDLE_AVG_FILES files.
+BUNDLE_MAX_FILE_SIZE = 64 * 1024
+BUNDLE_MAX_SIZE = 4 * 1024 * 1024
+BUNDLE_AVG_FILES = 64
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -80,6 +154,30 @@ ALREADY_COMPRESSED_TYPES = [
 ]
 
 
+# The zlib levels used for the items to compress, see CompressionPolicy.
+COMPRESSION_LEVELS = {'store': 0, 'fast': 1, 'high': 9}
+
+# CompressionPolicy compresses COMPRESSION_SAMPLES blocks of
+# COMPRESSION_SAMPLE_SIZE bytes spread over an item at the fastest level. Items
+# whose samples shrink less than COMPRESSION_STORE_RATIO are stored as is, and
+# the ones that shrink to less than COMPRESSION_HIGH_RATIO get the highest
+# level. Smaller items keep their default level.
+COMPRESSION_SAMPLES = 3
+COMPRESSION_SAMPLE_SIZE = 16 * 1024
+COMPRESSION_STORE_RATIO = 0.9
+COMPRESSION_HIGH_RATIO = 0.5
+
+# Items of at least PARALLEL_COMPRESSION_MIN_SIZE bytes are compressed in
+# blocks of PARALLEL_COMPRESSION_BLOCK_SIZE bytes in parallel, see
+# parallel_zip_compress().
+PARALLEL_COMPRESSION_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+# Seconds spent compressing per Storage after which the items that would get
+# the highest compression level get the fast one instead.
+COMPRESSION_CPU_BUDGET = 300.
+
+
 # The delay (in seconds) to wait between logging statements when retrieving
 # the required files. This is intended to let the user (or buildbot) know that
 # the program is still running.
@@ -104,6 +202,44 @@ class Aborted(Error):
   pass
 
 
+class _StageFailed(Exception):
+  """Raised to a fetch stage when the previous one failed and reports it."""
+
+
+class _ErrorsChannel(object):
+  """Passed as a TaskChannel, forwards only the exceptions to |channel|."""
+
+  def __init__(self, channel):
+    self._channel = channel
+
+  def send_result(self, _result):
+    pass
+
+  def send_exception(self, exc_info=None):
+    self._channel.send_exception(exc_info or sys.exc_info())
+
+
+class _ClaimChannel(object):
+  """Passed as a TaskChannel, releases the claim of |digest| in |cache| when
+  its fetch fails, so another process can fetch it.
+  """
+
+  def __init__(self, channel, cache, digest):
+    self._channel = channel
+    self._cache = cache
+    self._digest = digest
+
+  def send_result(self, result):
+    self._channel.send_result(result)
+
+  def send_exception(self, exc_info=None):
+    exc_info = exc_info or sys.exc_info()
+    try:
+      self._cache.release_claim(self._digest)
+    finally:
+      self._channel.send_exception(exc_info)
+
+
 class AlreadyExists(Error):
   """File already exists."""
 
@@ -231,26 +367,40 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
   """
   srcpath = fileobj_path(srcfileobj)
   if srcpath and size == -1:
-    readonly = file_mode is None or (
-        file_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    putfile_from_path(srcpath, dstpath, file_mode, use_symlink)
+    return
+
+  # Need to write out the file
+  with fs.open(dstpath, 'wb') as dstfileobj:
+    fileobj_copy(dstfileobj, srcfileobj, size)
+
+  assert fs.exists(dstpath)
+
+  # file_mode of 0 is actually valid, so need explicit check.
+  if file_mode is not None:
+    fs.chmod(dstpath, file_mode)
 
-    if readonly:
-      # If the file is read only we can link the file
-      if use_symlink:
-        link_mode = file_path.SYMLINK_WITH_FALLBACK
-      else:
-        link_mode = file_path.HARDLINK_WITH_FALLBACK
-    else:
-      # If not read only, we must copy the file
-      link_mode = file_path.COPY
 
-    file_path.link_file(dstpath, srcpath, link_mode)
+def putfile_from_path(srcpath, dstpath, file_mode=None, use_symlink=False):
+  """Like putfile() for a file on disk, without opening it.
+
+  The file is linked unless |file_mode| makes it writable.
+  """
+  readonly = file_mode is None or (
+      file_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+  if readonly:
+    # If the file is read only we can link the file
+    if use_symlink:
+      link_mode = file_path.SYMLINK_WITH_FALLBACK
+    else:
+      link_mode = file_path.HARDLINK_WITH_FALLBACK
   else:
-    # Need to write out the file
-    with fs.open(dstpath, 'wb') as dstfileobj:
-      fileobj_copy(dstfileobj, srcfileobj, size)
+    # If not read only, we must copy the file. A copy-on-write clone is as
+    # good and much cheaper where the filesystem supports it.
+    link_mode = file_path.REFLINK_WITH_FALLBACK
 
-  assert fs.exists(dstpath)
+  file_path.link_file(dstpath, srcpath, link_mode)
 
   # file_mode of 0 is actually valid, so need explicit check.
   if file_mode is not None:
@@ -269,6 +419,89 @@ def zip_compress(content_generator, level=7):
     yield tail
 
 
+def _deflate_block(level, data, last):
+  """Returns tuple(raw deflate data, duration) of a parallel_zip_compress()
+  block.
+  """
+  start = time.time()
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  out = compressor.compress(data) + compressor.flush(
+      zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+  return out, time.time() - start
+
+
+def parallel_zip_compress(
+    content_generator, level, thread_pool, block_size=None, window=None,
+    durations=None):
+  """Same as zip_compress() but compresses blocks of data in |thread_pool|.
+
+  Like pigz, each block is compressed on its own as raw deflate data. A sync
+  flush ends each block on a byte boundary, and the last block has the final
+  bit set. Between a zlib header and the adler32 of the whole data, they form a
+  single zlib stream that zip_decompress() and the server read as usual.
+
+  The blocks don't share their dictionary, so the output is slightly larger
+  than with zip_compress(). It only depends on the data, not on how
+  |content_generator| chunks it, so it can be regenerated to resume a push.
+
+  Arguments:
+    content_generator: yields the data to compress.
+    level: zlib compression level.
+    thread_pool: ThreadPool to compress the blocks in.
+    block_size: size of the blocks, PARALLEL_COMPRESSION_BLOCK_SIZE by default.
+    window: maximum number of blocks being compressed at once, twice the number
+        of processors by default.
+    durations: optional list that receives the seconds spent compressing each
+        block.
+  """
+  block_size = block_size or PARALLEL_COMPRESSION_BLOCK_SIZE
+  window = window or 2 * threading_utils.num_processors()
+  # The TaskChannel of each block being compressed, in order.
+  pending = collections.deque()
+
+  def submit(data, last):
+    channel = threading_utils.TaskChannel()
+    thread_pool.add_task(
+        threading_utils.PRIORITY_MED, channel.wrap_task(_deflate_block), level,
+        data, last)
+    pending.append(channel)
+
+  def pull():
+    out, duration = pending.popleft().pull()
+    if durations is not None:
+      durations.append(duration)
+    return out
+
+  # The same header as zlib.compressobj(level).
+  yield zlib.compress('', level)[:2]
+  adler = zlib.adler32('')
+  buf = []
+  buffered = 0
+  for chunk in content_generator:
+    adler = zlib.adler32(chunk, adler)
+    buf.append(chunk)
+    buffered += len(chunk)
+    if buffered < block_size:
+      continue
+    data = ''.join(buf)
+    offset = 0
+    while len(data) - offset >= block_size:
+      submit(data[offset:offset+block_size], False)
+      offset += block_size
+      while len(pending) >= window:
+        out = pull()
+        if out:
+          yield out
+    buf = [data[offset:]]
+    buffered = len(buf[0])
+  submit(''.join(buf), True)
+  while pending:
+    out = pull()
+    if out:
+      yield out
+  yield struct.pack('>I', adler & 0xffffffff)
+
+
 def zip_decompress(
     content_generator, chunk_size=isolated_format.DISK_FILE_CHUNK):
   """Reads zipped data from |content_generator| and yields decompressed data.
@@ -308,6 +541,118 @@ def get_zip_compression_level(filename):
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
 
+class CompressionPolicy(object):
+  """Chooses the zlib compression level of each item to upload.
+
+  Items with an already compressed extension are stored. For the others, a few
+  samples of their content are compressed at the fastest level to estimate how
+  compressible they are: dense data is stored, highly compressible data gets
+  the highest level and everything in between the fast one. Once |cpu_budget|
+  seconds were spent compressing, the highest level is not used anymore.
+
+  Thread safe. Keeps the number of items, and the original and compressed sizes
+  per decision in |stats|.
+  """
+
+  def __init__(self, cpu_budget=None):
+    self.cpu_budget = (
+        COMPRESSION_CPU_BUDGET if cpu_budget is None else cpu_budget)
+    self._lock = threading.Lock()
+    # Seconds spent in zlib compressing items.
+    self.cpu_time = 0.
+    # Maps a decision to [number of items, size, compressed size].
+    self.stats = {}
+
+  def choose(self, item):
+    """Returns tuple(decision, zlib level) for |item|."""
+    if not item.compression_level:
+      return 'store', 0
+    if item.size < COMPRESSION_SAMPLES * COMPRESSION_SAMPLE_SIZE:
+      return 'default', item.compression_level
+    ratio = self.sample(item)
+    if ratio > COMPRESSION_STORE_RATIO:
+      decision = 'store'
+    elif ratio < COMPRESSION_HIGH_RATIO and self.cpu_time < self.cpu_budget:
+      decision = 'high'
+    else:
+      decision = 'fast'
+    logging.debug('%s: %.2f compression ratio, %s', item.digest, ratio, decision)
+    return decision, COMPRESSION_LEVELS[decision]
+
+  @staticmethod
+  def sample(item):
+    """Returns the compressed / original size ratio of samples of |item|."""
+    step = (item.size - COMPRESSION_SAMPLE_SIZE) / (COMPRESSION_SAMPLES - 1)
+    size = 0
+    compressed = 0
+    for i in xrange(COMPRESSION_SAMPLES):
+      data = []
+      missing = COMPRESSION_SAMPLE_SIZE
+      for chunk in item.content_at(i * step):
+        data.append(chunk[:missing])
+        missing -= len(data[-1])
+        if not missing:
+          break
+      data = ''.join(data)
+      size += len(data)
+      compressed += len(zlib.compress(data, 1))
+    return float(compressed) / size if size else 1.
+
+  def compress(self, decision, level, content_generator, thread_pool=None):
+    """Same as zip_compress() but accounts for the time and sizes.
+
+    If |thread_pool| is set, the data is compressed in parallel with
+    parallel_zip_compress().
+    """
+    size = 0
+    compressed = 0
+    duration = 0.
+    if thread_pool:
+      sizes = []
+      durations = []
+      def count():
+        for chunk in content_generator:
+          sizes.append(len(chunk))
+          yield chunk
+      for out in parallel_zip_compress(
+          count(), level, thread_pool, durations=durations):
+        compressed += len(out)
+        yield out
+      size = sum(sizes)
+      duration = sum(durations)
+    else:
+      compressor = zlib.compressobj(level)
+      for chunk in content_generator:
+        size += len(chunk)
+        start = time.time()
+        out = compressor.compress(chunk)
+        duration += time.time() - start
+        if out:
+          compressed += len(out)
+          yield out
+      out = compressor.flush(zlib.Z_FINISH)
+      compressed += len(out)
+      if out:
+        yield out
+    with self._lock:
+      self.cpu_time += duration
+      stats = self.stats.setdefault(decision, [0, 0, 0])
+      stats[0] += 1
+      stats[1] += size
+      stats[2] += compressed
+
+  def log_stats(self):
+    with self._lock:
+      for decision, (count, size, compressed) in sorted(
+          self.stats.iteritems()):
+        logging.info(
+            'compressed: %6d, %9.1fkb -> %9.1fkb, %6.2f%%, %s',
+            count, size / 1024., compressed / 1024.,
+            compressed * 100. / size if size else 100., decision)
+      if self.stats:
+        logging.info('compressed in %.3fs', self.cpu_time)
+
+
 def create_directories(base_directory, files):
   """Creates the directory structure needed by the given list of files."""
   logging.debug('create_directories(%s, %d)', base_directory, len(files))
@@ -317,11 +662,16 @@ def create_directories(base_directory, files):
     while item:
       directories.add(item)
       item = os.path.dirname(item)
+  # Parents sort before their children. Trying mkdir() first saves a stat()
+  # per directory, the tree is usually new.
   for d in sorted(directories):
     if d:
       abs_d = os.path.join(base_directory, d)
-      if not fs.isdir(abs_d):
+      try:
         fs.mkdir(abs_d)
+      except OSError as e:
+        if e.errno != errno.EEXIST or not fs.isdir(abs_d):
+          raise
 
 
 def create_symlinks(base_directory, files):
@@ -342,6 +692,21 @@ def create_symlinks(base_directory, files):
       raise
 
 
+def _ensure_mode(path, mode):
+  """Changes the permissions of |path| to |mode| only if they differ.
+
+  It is cheaper to stat a file than to modify its metadata.
+  """
+  actual = fs.stat(path).st_mode
+  if sys.platform == 'win32':
+    # Only the read-only attribute can be changed.
+    if bool(actual & stat.S_IWRITE) == bool(mode & stat.S_IWRITE):
+      return
+  elif stat.S_IMODE(actual) == mode:
+    return
+  fs.chmod(path, mode)
+
+
 def is_valid_file(path, size):
   """Determines if the given files appears valid.
 
@@ -382,6 +747,9 @@ class FileItem(Item):
   def content(self):
     return file_read(self.path)
 
+  def content_at(self, offset):
+    return file_read(self.path, offset=offset)
+
 
 class BufferItem(Item):
   """A byte buffer to push to Storage."""
@@ -393,6 +761,70 @@ class BufferItem(Item):
   def content(self):
     return [self.buffer]
 
+  def content_at(self, offset):
+    return [self.buffer[offset:]]
+
+
+class PresenceCache(object):
+  """Digests recently confirmed present on isolate servers, saved to a file.
+
+  Storage.upload_items() doesn't ask the server again about these digests. The
+  .isolated files of trees fully uploaded are also remembered, so all their
+  files can be skipped at once.
+
+  Items are remembered for |ttl| seconds, per server and namespace. The file can
+  be shared by concurrent processes, see shared_lru.SharedLRUDict. It is only
+  a cache: a false positive would cause an item to not be uploaded, so it is an
+  exact set of digests and not a probabilistic filter.
+  """
+
+  def __init__(self, path, ttl=None, max_items=None):
+    self.ttl = PRESENCE_CACHE_TTL if ttl is None else ttl
+    self._lru = shared_lru.SharedLRUDict(
+        path, max_items or PRESENCE_CACHE_MAX_ITEMS)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  @staticmethod
+  def _key(location, namespace, digest, kind):
+    # Keep keys short, the file holds many of them.
+    scope = hashlib.sha1('%s/%s' % (location, namespace)).hexdigest()[:8]
+    return '%s:%s:%s' % (kind, scope, digest)
+
+  def contains(self, location, namespace, digest):
+    """Returns True if |digest| was recently confirmed present."""
+    return self._is_fresh(self._key(location, namespace, digest, 'i'))
+
+  def add(self, location, namespace, digests):
+    """Remembers that |digests| are present on the server."""
+    now = int(time.time())
+    for digest in digests:
+      self._lru.add(self._key(location, namespace, digest, 'i'), now)
+
+  def contains_tree(self, location, namespace, isolated_hash):
+    """Returns True if the tree of |isolated_hash| was recently fully uploaded.
+    """
+    return self._is_fresh(self._key(location, namespace, isolated_hash, 't'))
+
+  def add_tree(self, location, namespace, isolated_hash):
+    """Remembers that the tree of |isolated_hash| and all its files, including
+    the ones of its included .isolated files, are present on the server.
+    """
+    self._lru.add(
+        self._key(location, namespace, isolated_hash, 't'), int(time.time()))
+
+  def save(self):
+    self._lru.save()
+
+  def _is_fresh(self, key):
+    confirmed = self._lru.get(key)
+    return confirmed is not None and time.time() - confirmed < self.ttl
+
 
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
@@ -407,13 +839,18 @@ class Storage(object):
   signal handlers table to handle Ctrl+C.
   """
 
-  def __init__(self, storage_api):
+  def __init__(self, storage_api, presence_cache=None):
     self._storage_api = storage_api
+    self._presence_cache = presence_cache
+    self._contains_controller = ContainsController()
+    self._compression_policy = CompressionPolicy()
     self._use_zip = isolated_format.is_namespace_with_compression(
         storage_api.namespace) and not storage_api.internal_compression
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
+    self._inflate_thread_pool = None
+    self._disk_thread_pool = None
     self._aborted = False
     self._prev_sig_handlers = {}
 
@@ -438,6 +875,29 @@ class Storage(object):
     """
     return self._storage_api.namespace
 
+  @property
+  def batch_limits(self):
+    """Limits of the batches of small items, None if not supported.
+
+    See StorageApi.batch_limits.
+    """
+    return self._storage_api.batch_limits
+
+  @property
+  def presence_cache(self):
+    """Optional PresenceCache used to skip the existence checks."""
+    return self._presence_cache
+
+  @property
+  def contains_controller(self):
+    """ContainsController that sizes the existence checks, with their stats."""
+    return self._contains_controller
+
+  @property
+  def compression_policy(self):
+    """CompressionPolicy choosing the level of the items, with their stats."""
+    return self._compression_policy
+
   @property
   def cpu_thread_pool(self):
     """ThreadPool for CPU-bound tasks like zipping."""
@@ -456,17 +916,44 @@ class Storage(object):
       self._net_thread_pool = threading_utils.IOAutoRetryThreadPool()
     return self._net_thread_pool
 
+  @property
+  def inflate_thread_pool(self):
+    """ThreadPool for the decompression stage of fetches."""
+    if self._inflate_thread_pool is None:
+      self._inflate_thread_pool = threading_utils.ThreadPool(
+          1, FETCH_INFLATE_THREADS, 0, 'inflate')
+    return self._inflate_thread_pool
+
+  @property
+  def disk_thread_pool(self):
+    """ThreadPool for the stage of fetches that writes to the cache."""
+    if self._disk_thread_pool is None:
+      self._disk_thread_pool = threading_utils.ThreadPool(
+          1, FETCH_DISK_THREADS, 0, 'disk')
+    return self._disk_thread_pool
+
   def close(self):
     """Waits for all pending tasks to finish."""
     logging.info('Waiting for all threads to die...')
-    if self._cpu_thread_pool:
-      self._cpu_thread_pool.join()
-      self._cpu_thread_pool.close()
-      self._cpu_thread_pool = None
-    if self._net_thread_pool:
-      self._net_thread_pool.join()
-      self._net_thread_pool.close()
-      self._net_thread_pool = None
+    # In the order of the fetch stages.
+    names = (
+        '_cpu_thread_pool', '_net_thread_pool', '_inflate_thread_pool',
+        '_disk_thread_pool')
+    # A stage can queue tasks on an earlier one, e.g. a restart of the inflate
+    # stage or the fallback of a batch fetch go back to the network pool. Join
+    # them all until none got a new task, before closing any.
+    def pools():
+      return [getattr(self, name) for name in names if getattr(self, name)]
+    added = None
+    while added != sum(pool.added_tasks for pool in pools()):
+      added = sum(pool.added_tasks for pool in pools())
+      for pool in pools():
+        pool.join()
+    for name in names:
+      pool = getattr(self, name)
+      if pool:
+        pool.close()
+        setattr(self, name, None)
     logging.info('Done.')
 
   def abort(self):
@@ -498,38 +985,90 @@ class Storage(object):
     """Uploads a bunch of items to the isolate server.
 
     It figures out what items are missing from the server and uploads only them.
+    The items recently confirmed present in |presence_cache| are not checked.
 
     Arguments:
-      items: list of Item instances that represents data to upload.
+      items: list of Item instances that represents data to upload. It can also
+          be a generator, in which case the existence checks start as soon as
+          it yields the first batch of items and uploads as soon as a check
+          returns, while it keeps yielding.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    streamed = isinstance(items, types.GeneratorType)
+    if streamed:
+      logging.info('upload_items(items=<generator>)')
+    else:
+      logging.info('upload_items(items=%d)', len(items))
 
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
-
-    # Enqueue all upload tasks.
+    duplicates = [0]
+    known = [0]
+    def unique_items():
+      for item in items:
+        # Ensure the digest is calculated.
+        item.prepare(self._hash_algo)
+        if seen.setdefault(item.digest, item) is not item:
+          duplicates[0] += 1
+        elif self._presence_cache and self._presence_cache.contains(
+            self.location, self.namespace, item.digest):
+          known[0] += 1
+        else:
+          yield item
+    unique = unique_items()
+    if not streamed:
+      # Keep it a list so the larger items are checked first.
+      unique = list(unique)
+
+    # Enqueue all upload tasks. Each one is started by the existence check that
+    # found it missing, without waiting for |items| to be exhausted.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
-      missing.add(missing_item)
-      self.async_push(channel, missing_item, push_state)
+    checks = threading_utils.TaskChannel()
+    def contains(batch):
+      if self._aborted:
+        raise Aborted()
+      with self._contains_controller.measure(len(batch)):
+        result = self._storage_api.contains(batch)
+      # Small items are pushed in batches if the server supports it.
+      limits = self.batch_limits if result else None
+      batchable = []
+      for missing_item, push_state in result.iteritems():
+        if limits and self._storage_api.can_push_in_batch(
+            missing_item, push_state):
+          batchable.append((missing_item, push_state))
+        else:
+          self.async_push(channel, missing_item, push_state)
+      for pushes in split_in_batches(batchable, limits):
+        self.async_push_batch(channel, pushes)
+      if self._presence_cache:
+        self._presence_cache.add(
+            self.location, self.namespace,
+            (i.digest for i in batch if i not in result))
+      return result.keys()
+    pending = 0
+    controller = self._contains_controller
+    for batch in batch_items_for_check(unique, controller):
+      # Do not send more queries at once than the server handles well.
+      while pending >= controller.concurrency:
+        missing.update(checks.pull())
+        pending -= 1
+      self.net_thread_pool.add_task_with_channel(
+          checks, threading_utils.PRIORITY_HIGH, contains, batch)
+      pending += 1
+    for _ in xrange(pending):
+      missing.update(checks.pull())
+    items = seen.values()
+    controller.log_stats()
+    if duplicates[0]:
+      logging.info('Skipped %d files with duplicated content', duplicates[0])
+    if known[0]:
+      logging.info('Skipped %d files recently seen on the server', known[0])
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -537,11 +1076,19 @@ class Storage(object):
         # Wait for all started uploads to finish.
         while len(uploaded) != len(missing):
           detector.ping()
-          item = channel.pull()
-          uploaded.append(item)
+          result = channel.pull()
+          # Batches return the list of their items.
+          pushed = result if isinstance(result, list) else [result]
+          uploaded.extend(pushed)
+          if self._presence_cache:
+            self._presence_cache.add(
+                self.location, self.namespace, [i.digest for i in pushed])
           logging.debug(
-              'Uploaded %d / %d: %s', len(uploaded), len(missing), item.digest)
+              'Uploaded %d / %d: %s', len(uploaded), len(missing),
+              ', '.join(i.digest for i in pushed))
     logging.info('All files are uploaded')
+    self._compression_policy.log_stats()
+    log_memory_stats()
 
     # Print stats.
     total = len(items)
@@ -589,8 +1136,9 @@ class Storage(object):
     priority = (
         threading_utils.PRIORITY_HIGH if item.high_priority
         else threading_utils.PRIORITY_MED)
+    content = self._push_content(item)
 
-    def push(content):
+    def push():
       """Pushes an Item and returns it to |channel|."""
       if self._aborted:
         raise Aborted()
@@ -598,28 +1146,72 @@ class Storage(object):
       self._storage_api.push(item, push_state, content)
       return item
 
-    # If zipping is not required, just start a push task.
-    if not self._use_zip:
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, item.content())
-      return
+    self.net_thread_pool.add_task_with_channel(channel, priority, push)
 
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
+  def async_push_batch(self, channel, pushes):
+    """Starts asynchronous push of small items in a single request.
+
+    If the batch fails, the items are pushed one by one instead.
+
+    Arguments:
+      channel: TaskChannel that receives back the list of items when the upload
+          ends.
+      pushes: list of tuple(item, push_state) within the storage batch_limits,
+          for items accepted by StorageApi.can_push_in_batch().
+
+    Returns:
+      None, but |channel| later receives back the list of items when the upload
+      ends.
+    """
+    priority = (
+        threading_utils.PRIORITY_HIGH if any(i.high_priority for i, _ in pushes)
+        else threading_utils.PRIORITY_MED)
+    contents = [self._push_content(item) for item, _ in pushes]
+    # Items already pushed one by one, in case the task is retried.
+    pushed = set()
+
+    def push_batch():
+      """Pushes the items and returns them to |channel|."""
+      if self._aborted:
+        raise Aborted()
+      remaining = [
+        (item, push_state, content)
+        for (item, push_state), content in zip(pushes, contents)
+        if item not in pushed
+      ]
       try:
-        if self._aborted:
-          raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
-        return
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+        self._storage_api.push_batch(remaining)
+      except IOError as e:
+        logging.warning(
+            'Failed to push a batch of %d items, pushing them one by one: %s',
+            len(remaining), e)
+        for item, push_state, content in remaining:
+          self._storage_api.push(item, push_state, content)
+          pushed.add(item)
+      return [item for item, _ in pushes]
+
+    self.net_thread_pool.add_task_with_channel(channel, priority, push_batch)
+
+  def _push_content(self, item):
+    """Returns the RestartableContent to push for |item|."""
+    # The content is streamed, compressing it on the fly if necessary. It is
+    # restartable so retries of the push task reread it as needed instead of
+    # keeping it in memory.
+    transform = None
+    if self._use_zip:
+      # The level is chosen once, retries reuse it.
+      decision = []
+      def transform(content_generator):
+        if not decision:
+          decision.extend(self._compression_policy.choose(item))
+        # Large items are compressed on all the cores.
+        thread_pool = None
+        if (decision[1] and item.size >= PARALLEL_COMPRESSION_MIN_SIZE and
+            threading_utils.num_processors() > 1):
+          thread_pool = self.cpu_thread_pool
+        return self._compression_policy.compress(
+            decision[0], decision[1], content_generator, thread_pool)
+    return isolate_storage.RestartableContent(item, transform)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -641,7 +1233,8 @@ class Storage(object):
       assert pushed is item
     return item
 
-  def async_fetch(self, channel, priority, digest, size, sink):
+  def async_fetch(
+      self, channel, priority, digest, size, sink, partial=None, move=None):
     """Starts asynchronous fetch from the server in a parallel thread.
 
     Arguments:
@@ -650,25 +1243,237 @@ class Storage(object):
       digest: hex digest of an item to download.
       size: expected size of the item (after decompression).
       sink: function that will be called as sink(generator).
+      partial: optional path of a file to download the raw (still compressed)
+          data to before it is passed to |sink|. It is kept if the download is
+          interrupted and the next attempt, possibly by another process,
+          resumes after its last byte. It is deleted once the data is used.
+      move: optional function called as move(partial) instead of |sink| when
+          |partial| holds the item as is, i.e. the data is not compressed. It
+          must take ownership of the file, e.g. by renaming it.
+
+    The fetch runs in three stages connected by bounded pipes: the network in
+    net_thread_pool, the decompression and verification in inflate_thread_pool
+    and |sink| in disk_thread_pool. A network thread is released as soon as the
+    data is received. Each stage is started by the previous one, so a stage
+    never waits for one that can't start.
+
+    Network errors are retried by net_thread_pool. An IOError of the
+    decompression stage, e.g. corrupted data, restarts the whole fetch up to the
+    same number of times. Errors of |sink| are not retried.
     """
-    def fetch():
+    # Gets the exceptions of the network stage once it is not retried anymore,
+    # the last stage sends the result.
+    network_errors = _ErrorsChannel(channel)
+    # Number of times the fetch was restarted because of the decompression.
+    restarts = [0]
+    # Set once |partial| is complete, there's nothing to resume from if its
+    # content is broken.
+    downloaded = [False]
+
+    def failed(exc_info, retry):
+      logging.error('Failed to fetch %s: %s', digest, exc_info[1])
+      if downloaded[0]:
+        file_path.try_remove(partial)
+        downloaded[0] = False
+      if retry and restarts[0] < threading_utils.IOAutoRetryThreadPool.RETRIES:
+        restarts[0] += 1
+        self.net_thread_pool.add_task_with_channel(
+            network_errors, priority, fetch)
+      else:
+        channel.send_exception(exc_info)
+
+    def write(inflated):
       try:
-        # Prepare reading pipeline.
-        stream = self._storage_api.fetch(digest)
+        sink(iter(inflated))
+      except _StageFailed:
+        return
+      except Exception:
+        failed(sys.exc_info(), False)
+        return
+      finally:
+        inflated.abort()
+      if partial:
+        file_path.try_remove(partial)
+      channel.send_result(digest)
+
+    def inflate(raw):
+      inflated = threading_utils.Pipe(FETCH_DISK_PIPE_SIZE)
+      self.disk_thread_pool.add_task(priority, write, inflated)
+      try:
+        stream = iter(raw)
         if self._use_zip:
           stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
         # Run |stream| through verifier that will assert its size.
-        verifier = FetchStreamVerifier(stream, size)
-        # Verified stream goes to |sink|.
-        sink(verifier.run())
+        for chunk in FetchStreamVerifier(stream, size).run():
+          inflated.put(chunk)
+      except (_StageFailed, threading_utils.Pipe.Aborted):
+        # The failing stage reports it.
+        inflated.close((_StageFailed, _StageFailed(), None))
+        return
+      except Exception:
+        inflated.close((_StageFailed, _StageFailed(), None))
+        failed(sys.exc_info(), isinstance(sys.exc_info()[1], IOError))
+        return
+      finally:
+        raw.abort()
+      inflated.close()
+
+    def fetch():
+      if partial:
+        self._fetch_to_partial(digest, partial, size)
+        downloaded[0] = True
+        if move and not self._use_zip:
+          actual = fs.stat(partial).st_size
+          if size != UNKNOWN_FILE_SIZE and actual != size:
+            failed((IOError, IOError('Incorrect file size: want %d, got %d' % (
+                size, actual)), None), True)
+            return
+          try:
+            move(partial)
+          except Exception:
+            failed(sys.exc_info(), False)
+            return
+          channel.send_result(digest)
+          return
+        stream = file_read(partial)
+      else:
+        stream = self._storage_api.fetch(digest)
+      raw = threading_utils.Pipe(FETCH_NETWORK_PIPE_SIZE)
+      self.inflate_thread_pool.add_task(priority, inflate, raw)
+      try:
+        for chunk in stream:
+          raw.put(chunk)
+      except threading_utils.Pipe.Aborted:
+        # The next stages failed and report it.
+        return
       except Exception as err:
-        logging.error('Failed to fetch %s: %s', digest, err)
+        logging.warning('Failed to fetch %s: %s', digest, err)
+        raw.close((_StageFailed, _StageFailed(), None))
         raise
-      return digest
+      raw.close()
+
+    self.net_thread_pool.add_task_with_channel(network_errors, priority, fetch)
 
-    # Don't bother with zip_thread_pool for decompression. Decompression is
-    # really fast and most probably IO bound anyway.
-    self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
+  def async_fetch_batch(self, priority, items):
+    """Starts asynchronous fetch of small items in a single request.
+
+    The items the server didn't return, or that are corrupted, are fetched with
+    async_fetch() instead, as well as all of them if the batch fails.
+
+    Arguments:
+      priority: thread pool task priority for the fetch.
+      items: list of tuple(digest, size, sink, channel) within the storage
+          batch_limits, see async_fetch(). Each channel receives back its
+          digest when its download ends.
+    """
+    def write(contents):
+      for digest, size, sink, channel in items:
+        raw = contents.get(digest)
+        if raw is None:
+          self.async_fetch(channel, priority, digest, size, sink)
+          continue
+        try:
+          stream = [raw]
+          if self._use_zip:
+            stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+          sink(FetchStreamVerifier(stream, size).run())
+        except IOError as e:
+          logging.warning('Failed to fetch %s in a batch: %s', digest, e)
+          self.async_fetch(channel, priority, digest, size, sink)
+          continue
+        except Exception:
+          channel.send_exception()
+          continue
+        channel.send_result(digest)
+
+    def fetch():
+      try:
+        try:
+          contents = self._storage_api.fetch_batch(
+              [d for d, _, _, _ in items])
+        except IOError as e:
+          logging.warning(
+              'Failed to fetch a batch of %d items, fetching them one by one: '
+              '%s', len(items), e)
+          contents = {}
+        # The items are small, one disk thread writes them all.
+        self.disk_thread_pool.add_task(priority, write, contents)
+      except Exception:
+        # The pool would swallow it, and the items would never be reported.
+        exc_info = sys.exc_info()
+        for _, _, _, channel in items:
+          channel.send_exception(exc_info)
+
+    self.net_thread_pool.add_task(priority, fetch)
+
+  def _fetch_to_partial(self, digest, partial, size):
+    """Downloads raw data of |digest| to file |partial|.
+
+    Resumes after the data already present in |partial|, if any.
+    """
+    offset = fs.stat(partial).st_size if fs.isfile(partial) else 0
+    if offset:
+      logging.info('Resuming fetch of %s at offset %d', digest, offset)
+    if (not self._use_zip and size != UNKNOWN_FILE_SIZE and
+        size - offset >= PARALLEL_FETCH_MIN_SIZE):
+      self._fetch_ranges(digest, partial, offset, size)
+      return
+    with fs.open(partial, 'ab') as f:
+      for data in self._storage_api.fetch(digest, offset):
+        f.write(data)
+
+  def _fetch_ranges(self, digest, partial, offset, size):
+    """Downloads bytes [offset, size) of |digest| to file |partial|.
+
+    The ranges are fetched over parallel connections and written at their
+    offset in the file. On failure, |partial| is truncated to the data fetched
+    without gap, so the next attempt can resume from there.
+
+    While it has gaps, the file is moved aside so a crash can't leave a partial
+    file that looks complete. DiskCache.cleanup() deletes it as unknown.
+    """
+    in_progress = partial + u'.ranges'
+    ranges = [
+      (start, min(PARALLEL_FETCH_RANGE_SIZE, size - start))
+      for start in xrange(offset, size, PARALLEL_FETCH_RANGE_SIZE)
+    ]
+    # Number of bytes written for each range, updated as data comes in.
+    written = [0] * len(ranges)
+
+    def fetch_range(index):
+      start, length = ranges[index]
+      with fs.open(in_progress, 'r+b') as f:
+        f.seek(start)
+        for data in self._storage_api.fetch(digest, start, length):
+          f.write(data)
+          written[index] += len(data)
+      if written[index] != length:
+        raise IOError('Incomplete range %d-%d: got %d bytes' % (
+            start, start + length - 1, written[index]))
+
+    if fs.isfile(partial):
+      fs.rename(partial, in_progress)
+    with fs.open(in_progress, 'ab') as f:
+      f.truncate(size)
+    try:
+      connections = min(PARALLEL_FETCH_CONNECTIONS, len(ranges))
+      with threading_utils.ThreadPool(
+          connections, connections, 0, 'fetch_ranges') as pool:
+        for index in xrange(len(ranges)):
+          pool.add_task(threading_utils.PRIORITY_MED, fetch_range, index)
+        pool.join()
+    except:
+      # Keep the data up to the first missing byte.
+      end = offset
+      for (_, length), done in zip(ranges, written):
+        end += done
+        if done != length:
+          break
+      with fs.open(in_progress, 'r+b') as f:
+        f.truncate(end)
+      fs.rename(in_progress, partial)
+      raise
+    fs.rename(in_progress, partial)
 
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
@@ -676,7 +1481,9 @@ class Storage(object):
     Issues multiple parallel queries via StorageApi's 'contains' method.
 
     Arguments:
-      items: a list of Item objects to check.
+      items: a list of Item objects to check. It can also be a generator, the
+          queries are then sent as soon as it yields a batch of items, and the
+          results received so far are yielded in between.
 
     Yields:
       For each missing item it yields a pair (item, push_state), where:
@@ -690,19 +1497,39 @@ class Storage(object):
     pending = 0
 
     # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    def prepared(items):
+      for item in items:
+        item.prepare(self._hash_algo)
+        yield item
+    if isinstance(items, types.GeneratorType):
+      items = prepared(items)
+    else:
+      items = list(prepared(items))
 
     def contains(batch):
       if self._aborted:
         raise Aborted()
-      return self._storage_api.contains(batch)
-
-    # Enqueue all requests.
-    for batch in batch_items_for_check(items):
+      with self._contains_controller.measure(len(batch)):
+        return self._storage_api.contains(batch)
+
+    # Enqueue all requests, yielding the results already in between.
+    controller = self._contains_controller
+    for batch in batch_items_for_check(items, controller):
+      while pending >= controller.concurrency:
+        pending -= 1
+        for missing_item, push_state in channel.pull().iteritems():
+          yield missing_item, push_state
       self.net_thread_pool.add_task_with_channel(
           channel, threading_utils.PRIORITY_HIGH, contains, batch)
       pending += 1
+      while pending:
+        try:
+          result = channel.pull(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for missing_item, push_state in result.iteritems():
+          yield missing_item, push_state
 
     # Yield results as they come in.
     for _ in xrange(pending):
@@ -710,34 +1537,158 @@ class Storage(object):
         yield missing_item, push_state
 
 
-def batch_items_for_check(items):
+def split_in_batches(items, limits):
+  """Splits |items| in batches within the storage batch_limits.
+
+  Arguments:
+    items: list of tuple(Item, ...) to split.
+    limits: tuple(maximum number of items, maximum total size) or None.
+
+  Yields:
+    Lists of tuple(Item, ...).
+  """
+  if not items:
+    return
+  max_items, max_size = limits
+  batch = []
+  size = 0
+  for entry in items:
+    if batch and (
+        len(batch) >= max_items or size + entry[0].size > max_size):
+      yield batch
+      batch = []
+      size = 0
+    batch.append(entry)
+    size += entry[0].size
+  yield batch
+
+
+def batch_items_for_check(items, controller=None):
   """Splits list of items to check for existence on the server into batches.
 
   Each batch corresponds to a single 'exists?' query to the server via a call
   to StorageApi's 'contains' method.
 
   Arguments:
-    items: a list of Item objects.
+    items: a list of Item objects, larger items are checked first. It can also
+        be a generator, its items are then batched in the order they come.
+    controller: optional ContainsController that caps the size of each batch,
+        as it is started. Otherwise the size is only defined by
+        ITEMS_PER_CONTAINS_QUERIES.
 
   Yields:
     Batches of items to query for existence in a single operation,
     each batch is a list of Item objects.
   """
+  if not isinstance(items, types.GeneratorType):
+    items = sorted(items, key=lambda x: x.size, reverse=True)
+
+  def get_batch_size_limit(batch_count):
+    if batch_count < len(ITEMS_PER_CONTAINS_QUERIES):
+      limit = ITEMS_PER_CONTAINS_QUERIES[batch_count]
+      return min(limit, controller.batch_size) if controller else limit
+    if controller:
+      return controller.batch_size
+    return ITEMS_PER_CONTAINS_QUERIES[-1]
+
   batch_count = 0
-  batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
+  batch_size_limit = get_batch_size_limit(0)
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
+  for item in items:
     next_queries.append(item)
-    if len(next_queries) == batch_size_limit:
+    if len(next_queries) >= batch_size_limit:
       yield next_queries
       next_queries = []
       batch_count += 1
-      batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
-          min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
+      batch_size_limit = get_batch_size_limit(batch_count)
   if next_queries:
     yield next_queries
 
 
+def log_memory_stats():
+  """Logs the use of the push memory budget and the peak RSS of the process."""
+  budget = isolate_storage.get_memory_budget()
+  peak_rss = tools.get_peak_rss()
+  logging.info(
+      'memory:     %.1fmb peak of %.1fmb budget, waited %.3fs; peak RSS %s',
+      budget.peak / 1024. / 1024., budget.max_size / 1024. / 1024.,
+      budget.waited,
+      '%.1fmb' % (peak_rss / 1024. / 1024.) if peak_rss else 'unknown')
+
+
+class ContainsController(object):
+  """Adapts the existence checks to the observed server latency and errors.
+
+  It is an AIMD (additive increase, multiplicative decrease) controller of both
+  the number of items per query and the number of concurrent queries. This way
+  a loaded server gets fewer and smaller queries instead of being flooded, while
+  a fast one is queried with larger batches.
+
+  Thread safe. Keeps the timing of every query in |stats|.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._batch_size = ITEMS_PER_CONTAINS_QUERIES[-1]
+    self._concurrency = float(CONTAINS_INITIAL_CONCURRENCY)
+    # List of tuple(number of items, duration in seconds, succeeded).
+    self.stats = []
+
+  @property
+  def batch_size(self):
+    """Maximum number of items to send in the next query."""
+    return self._batch_size
+
+  @property
+  def concurrency(self):
+    """Maximum number of queries to have in flight."""
+    return int(self._concurrency)
+
+  @contextlib.contextmanager
+  def measure(self, size):
+    """Times a query for |size| items, the body raising means it failed."""
+    start = time.time()
+    try:
+      yield
+    except Exception:
+      self.record(size, time.time() - start, False)
+      raise
+    self.record(size, time.time() - start, True)
+
+  def record(self, size, duration, succeeded):
+    """Updates the limits with the result of a query."""
+    with self._lock:
+      self.stats.append((size, duration, succeeded))
+      if not succeeded:
+        self._batch_size = max(
+            ITEMS_PER_CONTAINS_QUERIES[0], self._batch_size / 2)
+        self._concurrency = max(1., self._concurrency / 2)
+      elif duration > CONTAINS_TARGET_LATENCY:
+        self._batch_size = max(
+            ITEMS_PER_CONTAINS_QUERIES[0], self._batch_size / 2)
+      elif size >= self._batch_size:
+        # Only grow when the limit was actually reached, smaller queries don't
+        # tell if larger ones would be fast too. The concurrency grows by about
+        # one per round of |concurrency| queries.
+        self._batch_size = min(
+            CONTAINS_MAX_BATCH_SIZE, self._batch_size + CONTAINS_BATCH_SIZE_STEP)
+        self._concurrency = min(
+            float(CONTAINS_MAX_CONCURRENCY),
+            self._concurrency + 1. / self._concurrency)
+
+  def log_stats(self):
+    with self._lock:
+      if not self.stats:
+        return
+      durations = [d for _, d, _ in self.stats]
+      logging.info(
+          'contains:   %6d queries, %d failed, %.3fs max, %.3fs avg; '
+          'batch size %d, concurrency %d',
+          len(self.stats), sum(1 for _, _, ok in self.stats if not ok),
+          max(durations), sum(durations) / len(durations), self._batch_size,
+          int(self._concurrency))
+
+
 class FetchQueue(object):
   """Fetches items from Storage and places them into LocalCache.
 
@@ -753,6 +1704,10 @@ class FetchQueue(object):
     self._pending = set()
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # Small items waiting to be fetched in a batch, all at |_batch_priority|.
+    self._batch = []
+    self._batch_size = 0
+    self._batch_priority = None
 
   def add(
       self,
@@ -787,9 +1742,64 @@ class FetchQueue(object):
 
     # Start fetching.
     self._pending.add(digest)
+    if not self.cache.claim(digest):
+      # Another process is fetching it, wait for it in a network thread.
+      self.storage.net_thread_pool.add_task(
+          priority, self._wait_other_fetch, digest, size, priority)
+      return
+    if size != UNKNOWN_FILE_SIZE and size <= BATCH_FETCH_MAX_ITEM_SIZE:
+      limits = self.storage.batch_limits
+      if limits:
+        self._add_to_batch(digest, size, priority, limits)
+        return
+    self._fetch(digest, size, priority)
+
+  def _fetch(self, digest, size, priority, resumable=True):
+    """Starts fetching |digest| alone.
+
+    Its partial file is only used if |resumable|, i.e. this process has the
+    claim.
+    """
+    sink = functools.partial(self.cache.write, digest)
+    partial = None
+    if (resumable and size != UNKNOWN_FILE_SIZE and
+        size >= RESUMABLE_FETCH_MIN_SIZE):
+      partial = self.cache.get_partial_path(digest)
     self.storage.async_fetch(
-        self._channel, priority, digest, size,
-        functools.partial(self.cache.write, digest))
+        _ClaimChannel(self._channel, self.cache, digest), priority, digest,
+        size, sink, partial, functools.partial(self.cache.move_in, digest))
+
+  def _wait_other_fetch(self, digest, size, priority):
+    """Uses the item another process fetched, or fetches it if it failed."""
+    try:
+      claimed = self.cache.wait_claim(digest, size)
+      if claimed:
+        self._channel.send_result(digest)
+      else:
+        # None if the other process is still at it after the timeout.
+        self._fetch(digest, size, priority, resumable=claimed is not None)
+    except Exception:
+      self._channel.send_exception()
+
+  def _add_to_batch(self, digest, size, priority, limits):
+    """Queues a small item to be fetched in a batch."""
+    max_items, max_size = limits
+    if self._batch and (
+        priority != self._batch_priority or len(self._batch) >= max_items or
+        self._batch_size + size > max_size):
+      self._flush_batch()
+    self._batch.append((
+        digest, size, functools.partial(self.cache.write, digest),
+        _ClaimChannel(self._channel, self.cache, digest)))
+    self._batch_size += size
+    self._batch_priority = priority
+
+  def _flush_batch(self):
+    """Starts fetching the queued small items."""
+    if self._batch:
+      self.storage.async_fetch_batch(self._batch_priority, self._batch)
+      self._batch = []
+      self._batch_size = 0
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
@@ -804,6 +1814,7 @@ class FetchQueue(object):
     # Ensure all requested items are being fetched now.
     assert all(digest in self._pending for digest in digests), (
         digests, self._pending)
+    self._flush_batch()
 
     # Wait for some requested item to finish fetching.
     while self._pending:
@@ -973,6 +1984,16 @@ class LocalCache(object):
     """
     raise NotImplementedError()
 
+  def getfilepath(self, digest):
+    """Returns the path of the file of |digest|, or None if it has none.
+
+    Saves opening the file when it only needs to be linked. Raises CacheMiss if
+    |digest| isn't in the cache.
+    """
+    if digest not in self:
+      raise CacheMiss(digest)
+    return None
+
   def write(self, digest, content):
     """Reads data from |content| generator and stores it in cache.
 
@@ -980,6 +2001,46 @@ class LocalCache(object):
     """
     raise NotImplementedError()
 
+  def get_partial_path(self, digest):
+    """Returns a path to keep a partially fetched |digest| in, or None.
+
+    Data in this file survives a failed fetch so the next one can resume from
+    it. Returns None if the cache can't keep partial files.
+    """
+    return None
+
+  def move_in(self, digest, path):
+    """Moves the file |path| into the cache as the content of |digest|.
+
+    Returns digest to simplify chaining.
+    """
+    self.write(digest, file_read(path))
+    file_path.try_remove(path)
+    return digest
+
+  def claim(self, digest):
+    """Claims the fetch of |digest| for this process.
+
+    Returns False if another process sharing the cache is fetching it, see
+    wait_claim(). The claim is released once the item is written or moved in,
+    or by release_claim() if its fetch fails.
+    """
+    return True
+
+  def wait_claim(self, digest, size):
+    """Waits for the other process fetching |digest| to be done.
+
+    Returns True if it is now in the cache. False if the fetch failed, this
+    process now has the claim and must fetch |digest|. None if the other
+    process is still at it after a timeout, this process must then fetch
+    |digest| too but without the claim, so without its partial file.
+    """
+    return False
+
+  def release_claim(self, digest):
+    """Releases the claim of |digest| after its fetch failed."""
+    pass
+
   def trim(self):
     """Enforces cache policies.
 
@@ -1061,13 +2122,53 @@ class CachePolicies(object):
 
 
 class DiskCache(LocalCache):
-  """Stateful LRU cache in a flat hash table in a directory.
+  """Stateful LRU cache in a hash table in a directory.
 
   Saves its state as json file.
+
+  The items are either all in the directory, or sharded in subdirectories named
+  after the first 2 characters of their digest, e.g. ab/cdef... A flat cache is
+  migrated in place when it is opened as sharded, then stays sharded.
+
+  Multiple processes can share the directory. Each merges its changes with the
+  state saved by the others, under a lock. The items a process uses are pinned
+  until it closes the cache so the others don't evict them, and only one process
+  at a time fetches an item, see claim().
   """
   STATE_FILE = u'state.json'
-
-  def __init__(self, cache_dir, policies, hash_algo, trim, time_fn=None):
+  # File present in a sharded cache.
+  SHARDED_FILE = u'sharded'
+  # Directory with the files used to coordinate the processes.
+  LOCKS_DIR = u'locks'
+  # Suffix of the file listing the items pinned by one process.
+  PINS_SUFFIX = u'.pins'
+  # Suffix of the file created by the process fetching an item. It holds the
+  # name of the pins file of that process, which tells if it is still alive.
+  FETCH_SUFFIX = u'.fetch'
+  # Lists the items to check at the next cleanup().
+  INTEGRITY_FILE = u'integrity.journal'
+  # Line of the integrity journal added when a process died.
+  CRASHED = '!'
+  # Prefix of the lines of the integrity journal listing an item written since.
+  WRITTEN = '+'
+  # Suffix of files holding the raw data of an interrupted fetch.
+  PARTIAL_SUFFIX = u'.partial'
+  # Partial files older than this (in seconds) are deleted by cleanup().
+  PARTIAL_MAX_AGE = 24 * 60 * 60
+  # Maximum time (in seconds) to wait for another process to fetch an item
+  # before fetching it too, see wait_claim().
+  CLAIM_TIMEOUT = 5 * 60
+  # Items used since they were hashed more than this (in seconds) ago are
+  # hashed again by a verifying cleanup().
+  VERIFY_MAX_AGE = 7 * 24 * 60 * 60
+  # Files and directories at the top of the cache that are not items.
+  _RESERVED = frozenset((
+      STATE_FILE, STATE_FILE + lru.JOURNAL_SUFFIX, SHARDED_FILE, LOCKS_DIR,
+      INTEGRITY_FILE))
+
+  def __init__(
+      self, cache_dir, policies, hash_algo, trim, time_fn=None, sharded=False,
+      verify=False):
     """
     Arguments:
       cache_dir: directory where to place the cache.
@@ -1075,6 +2176,11 @@ class DiskCache(LocalCache):
       algo: hashing algorithm used.
       trim: if True to enforce |policies| right away.
         It can be done later by calling trim() explicitly.
+      sharded: if True, the items are sharded in subdirectories. A flat cache
+        is migrated unless another process is using it.
+      verify: if True, cleanup() hashes the items written since they were
+        last hashed, and the ones used whose hash is older than VERIFY_MAX_AGE.
+        Only for caches of items named after the digest of their content.
     """
     # All protected methods (starting with '_') except _path should be called
     # with self._lock held.
@@ -1083,10 +2189,33 @@ class DiskCache(LocalCache):
     self.policies = policies
     self.hash_algo = hash_algo
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    # Journal of the items to check at the next cleanup(). Its first line is a
+    # json header with the time of the last full scan, the time each item was
+    # last hashed and the items left to hash. The items this process pins and
+    # writes are appended when it closes the cache.
+    self._integrity_file = os.path.join(cache_dir, self.INTEGRITY_FILE)
+    self._verify = verify
     # Items in a LRU lookup dict(digest: size).
     self._lru = lru.LRUDict()
+    # os.stat() of the state file and its journal when last read or written.
+    self._state_stamp = None
+    self._locks_dir = os.path.join(cache_dir, self.LOCKS_DIR)
+    # Held to read and write the state file, to pin items and to evict them.
+    self._state_lock = file_lock.FileLock(
+        os.path.join(self._locks_dir, u'state.lock'))
+    # Items in use by this process, listed in the locked file self._pins.
+    self._pinned = set()
+    self._pins = None
+    # Items written by this process, they must be hashed again.
+    self._written = set()
+    # Items this process claimed the fetch of.
+    self._claims = set()
+    # True if the items are in subdirectories. A process may migrate the cache
+    # while others have it open, they switch under the state lock.
+    self._sharded = False
     # Current cached free disk space. It is updated by self._trim().
     file_path.ensure_tree(self.cache_dir)
+    file_path.ensure_tree(self._locks_dir)
     self._free_disk = file_path.get_free_space(self.cache_dir)
     # The first item in the LRU cache that must not be evicted during this run
     # since it was referenced. All items more recent that _protected in the LRU
@@ -1097,7 +2226,7 @@ class DiskCache(LocalCache):
     self._operations = []
     with tools.Profiler('Setup'):
       with self._lock:
-        self._load(trim, time_fn)
+        self._load(trim, time_fn, sharded)
 
   def __contains__(self, digest):
     with self._lock:
@@ -1109,7 +2238,10 @@ class DiskCache(LocalCache):
   def __exit__(self, _exc_type, _exec_value, _traceback):
     with tools.Profiler('CleanupTrimming'):
       with self._lock:
-        self._trim()
+        try:
+          self._trim()
+        finally:
+          self._release_locks()
 
         logging.info(
             '%5d (%8dkb) added',
@@ -1117,7 +2249,7 @@ class DiskCache(LocalCache):
         logging.info(
             '%5d (%8dkb) current',
             len(self._lru),
-            sum(self._lru.itervalues()) / 1024)
+            self._lru.total / 1024)
         logging.info(
             '%5d (%8dkb) evicted',
             len(self._evicted), sum(self._evicted) / 1024)
@@ -1136,25 +2268,115 @@ class DiskCache(LocalCache):
     Ensures there is no unknown files in cache_dir.
     Ensures the read-only bits are set correctly.
 
+    The whole directory is only scanned if a process died since the last scan,
+    and every PARTIAL_MAX_AGE. Otherwise, only the items written or used since
+    the previous cleanup are checked, see the integrity journal. If the cache
+    verifies its items, the ones written since they were hashed or hashed more
+    than VERIFY_MAX_AGE ago are hashed and the corrupted ones evicted. Other
+    threads can use the cache meanwhile.
+
     At that point, the cache was already loaded, trimmed to respect cache
     policies.
     """
-    fs.chmod(self.cache_dir, 0700)
-    # Ensure that all files listed in the state still exist and add new ones.
-    previous = self._lru.keys_set()
-    # It'd be faster if there were a readdir() function.
-    for filename in fs.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
-        fs.chmod(os.path.join(self.cache_dir, filename), 0600)
+    _ensure_mode(self.cache_dir, 0700)
+    with self._lock:
+      with self._state_lock:
+        self._sync()
+        # The files being written by other processes are not in the state yet.
+        pinned = self._pinned_by_others()
+        header, used, written, crashed, _ = self._read_integrity()
+        for path in self._state_files() + (self._integrity_file,):
+          if fs.isfile(path):
+            _ensure_mode(path, 0600)
+        _ensure_mode(self._locks_dir, 0700)
+        _ensure_mode(self._state_lock.path, 0600)
+        scanned = header['scanned'] if header else None
+        now = time.time()
+        if (scanned is None or crashed or
+            not 0 <= now - scanned < self.PARTIAL_MAX_AGE):
+          self._scan(pinned)
+          scanned = now
+        else:
+          self._check_items(used | written)
+        verified = dict(
+            (d, t) for d, t in (header or {}).get('verified', {}).iteritems()
+            if d in self._lru and d not in written and
+            0 <= now - t < self.VERIFY_MAX_AGE)
+        unverified = set(
+            d for d in
+            set((header or {}).get('unverified', [])) | used | written
+            if d in self._lru and d not in verified)
+        # The items still in use by other processes are verified next time.
+        to_verify = {}
+        if self._verify:
+          to_verify = dict(
+              (d, self._path(d)) for d in unverified if d not in pinned)
+        journal_id, offset = self._write_integrity(
+            scanned, verified, unverified.difference(to_verify))
+    if not to_verify:
+      return
+
+    # Hashing is slow, the other threads and processes can use the cache
+    # meanwhile.
+    hashed = set()
+    corrupted = set()
+    for digest, path in sorted(to_verify.iteritems()):
+      try:
+        valid = isolated_format.hash_file(path, self.hash_algo) == digest
+      except IOError:
+        # Evicted meanwhile, or lost and then removed by the next cleanup().
         continue
+      (hashed if valid else corrupted).add(digest)
+
+    with self._lock:
+      with self._state_lock:
+        self._sync()
+        pinned = self._pinned_by_others()
+        for digest in corrupted:
+          if digest in self._lru and digest not in pinned:
+            logging.warning('Deleting corrupted item %s', digest)
+            self._lru.pop(digest)
+            self._delete_file(digest, UNKNOWN_FILE_SIZE)
+        self._write_state()
+        header, _, _, _, _ = self._read_integrity()
+        if header and header['id'] == journal_id:
+          # Keep what was appended since, and what could not be evicted.
+          _, used, written, crashed, _ = self._read_integrity(offset)
+          verified = header['verified']
+          verified.update((d, now) for d in hashed)
+          self._write_integrity(
+              header['scanned'], verified,
+              set(header['unverified']) | (corrupted & pinned), used, written,
+              crashed)
+
+  def _scan(self, pinned):
+    """Checks every file of the cache directory.
+
+    Must be called with the state lock held.
+    """
+    # Ensure that all files listed in the state still exist and add new
+    # ones.
+    previous = self._lru.keys_set()
+    for filename, p in self._list_items():
       if filename in previous:
-        fs.chmod(os.path.join(self.cache_dir, filename), 0400)
+        _ensure_mode(p, 0400)
         previous.remove(filename)
         continue
+      if filename in pinned:
+        continue
+      if filename.endswith(self.PARTIAL_SUFFIX):
+        digest = filename[:-len(self.PARTIAL_SUFFIX)]
+        age = time.time() - fs.stat(p).st_mtime
+        if digest not in self._lru and age < self.PARTIAL_MAX_AGE:
+          # Keep it so the fetch can be resumed.
+          continue
+        logging.warning(
+            'Removing stale partial file %s from cache', filename)
+        file_path.try_remove(p)
+        continue
 
       # An untracked file. Delete it.
       logging.warning('Removing unknown file %s from cache', filename)
-      p = self._path(filename)
       if fs.isdir(p):
         try:
           file_path.rmtree(p)
@@ -1162,28 +2384,114 @@ class DiskCache(LocalCache):
           pass
       else:
         file_path.try_remove(p)
-      continue
 
     if previous:
       # Filter out entries that were not found.
       logging.warning('Removed %d lost files', len(previous))
       for filename in previous:
         self._lru.pop(filename)
-      self._save()
-
-    # What remains to be done is to hash every single item to
-    # detect corruption, then save to ensure state.json is up to date.
-    # Sadly, on a 50Gb cache with 100mib/s I/O, this is still over 8 minutes.
-    # TODO(maruel): Let's revisit once directory metadata is stored in
-    # state.json so only the files that had been mapped since the last cleanup()
-    # call are manually verified.
-    #
-    #with self._lock:
-    #  for digest in self._lru:
-    #    if not isolated_format.is_valid_hash(
-    #        self._path(digest), self.hash_algo):
-    #      self.evict(digest)
-    #      logging.info('Deleted corrupted item: %s', digest)
+      self._write_state()
+
+  def _check_items(self, digests):
+    """Checks the files of |digests| only, instead of scanning the directory.
+
+    Must be called with the state lock held.
+    """
+    lost = []
+    for digest in digests:
+      if digest not in self._lru:
+        continue
+      try:
+        _ensure_mode(self._path(digest), 0400)
+      except OSError:
+        lost.append(digest)
+    if lost:
+      logging.warning('Removed %d lost files', len(lost))
+      for digest in lost:
+        self._lru.pop(digest)
+      self._write_state()
+
+  def _read_integrity(self, offset=0):
+    """Reads the integrity journal from |offset|.
+
+    Returns (header, set of digests used, set of digests written, True if a
+    process died, size of the journal). The header is None if the journal is
+    missing or broken, or if |offset| is not 0.
+    """
+    try:
+      with fs.open(self._integrity_file, 'rb') as f:
+        data = f.read()
+    except IOError:
+      return None, set(), set(), False, 0
+    lines = data[offset:].split('\n')
+    header = None
+    if not offset:
+      try:
+        header = json.loads(lines.pop(0))
+        if (not isinstance(header, dict) or
+            not isinstance(header.get('scanned'), (int, float)) or
+            not isinstance(header.get('verified', {}), dict) or
+            not isinstance(header.get('unverified', []), list)):
+          header = None
+      except ValueError:
+        pass
+    used = set()
+    written = set()
+    for l in lines:
+      if l.startswith(self.WRITTEN):
+        written.add(l[len(self.WRITTEN):].decode('utf-8'))
+      elif l and l != self.CRASHED:
+        used.add(l.decode('utf-8'))
+    return header, used, written, self.CRASHED in lines, len(data)
+
+  def _write_integrity(
+      self, scanned, verified, unverified, used=(), written=(), crashed=False):
+    """Rewrites the integrity journal.
+
+    |verified| maps the items hashed to the time they were, |unverified| lists
+    the items left to hash. Returns the id of its header and its size. Must be
+    called with the state lock held.
+    """
+    journal_id = os.urandom(8).encode('hex')
+    lines = [json.dumps({
+      'id': journal_id,
+      'scanned': scanned,
+      'unverified': sorted(unverified),
+      'verified': verified,
+    }, sort_keys=True)]
+    lines.extend(d.encode('utf-8') for d in sorted(used))
+    lines.extend(self.WRITTEN + d.encode('utf-8') for d in sorted(written))
+    if crashed:
+      lines.append(self.CRASHED)
+    data = '\n'.join(lines) + '\n'
+    # Written to a temporary file first so a crash doesn't leave a partial
+    # journal.
+    tmp = self._integrity_file + u'.tmp'
+    with fs.open(tmp, 'wb') as f:
+      f.write(data)
+    fs.chmod(tmp, 0600)
+    if sys.platform == 'win32':
+      # os.rename() doesn't replace an existing file on Windows.
+      file_path.try_remove(self._integrity_file)
+    fs.rename(tmp, self._integrity_file)
+    return journal_id, len(data)
+
+  def _append_integrity(self, digests, written=(), crashed=False):
+    """Adds |digests| to the integrity journal, to check at the next cleanup().
+
+    The items |written| must be hashed again. If |crashed|, a process died and
+    the next cleanup() scans the whole directory. Must be called with the state
+    lock held.
+    """
+    lines = sorted(d.encode('utf-8') for d in digests)
+    lines.extend(self.WRITTEN + d.encode('utf-8') for d in sorted(written))
+    if crashed:
+      lines.append(self.CRASHED)
+    if not lines:
+      return
+    # A line cut short by a crash is ignored, start on a new one.
+    with fs.open(self._integrity_file, 'ab') as f:
+      f.write('\n' + '\n'.join(lines) + '\n')
 
   def touch(self, digest, size):
     """Verifies an actual file is valid and bumps its LRU position.
@@ -1196,6 +2504,12 @@ class DiskCache(LocalCache):
 
     TODO(maruel): More stringent verification while keeping the check fast.
     """
+    with self._lock:
+      if digest not in self._lru:
+        return False
+      # Pin it before the check, so no other process evicts it afterward.
+      self._pin(digest)
+
     # Do the check outside the lock.
     if not is_valid_file(self._path(digest), size):
       return False
@@ -1224,33 +2538,111 @@ class DiskCache(LocalCache):
     except IOError:
       raise CacheMiss(digest)
 
+  def getfilepath(self, digest):
+    with self._lock:
+      try:
+        self._used.append(self._lru[digest])
+      except KeyError:
+        raise CacheMiss(digest)
+      return self._path(digest)
+
   def write(self, digest, content):
     assert content is not None
     with self._lock:
       self._protected = self._protected or digest
+      # Other processes' cleanup() ignores the file while it isn't in the state.
+      self._pin(digest)
     path = self._path(digest)
+    self._ensure_shard(path)
+    # Written aside then renamed, another process that waited too long for the
+    # claim may be writing the same item. The name keeps it from cleanup().
+    tmp = u'%s.%d%s' % (path, os.getpid(), self.PARTIAL_SUFFIX)
     # A stale broken file may remain. It is possible for the file to have write
     # access bit removed which would cause the file_write() call to fail to open
     # in write mode. Take no chance here.
-    file_path.try_remove(path)
+    file_path.try_remove(tmp)
     try:
-      size = file_write(path, content)
+      size = file_write(tmp, content)
     except:
       # There are two possible places were an exception can occur:
       #   1) Inside |content| generator in case of network or unzipping errors.
       #   2) Inside file_write itself in case of disk IO errors.
       # In any case delete an incomplete file and propagate the exception to
       # caller, it will be logged there.
-      file_path.try_remove(path)
+      file_path.try_remove(tmp)
+      with self._lock:
+        self._release_claim(digest)
       raise
     # Make the file read-only in the cache.  This has a few side-effects since
     # the file node is modified, so every directory entries to this file becomes
     # read-only. It's fine here because it is a new file.
-    file_path.set_read_only(path, True)
+    file_path.set_read_only(tmp, True)
+    if sys.platform == 'win32':
+      # rename() doesn't replace an existing file.
+      file_path.try_remove(path)
+    fs.rename(tmp, path)
     with self._lock:
-      self._add(digest, size)
+      try:
+        self._written.add(digest)
+        self._add(digest, size)
+      finally:
+        self._release_claim(digest)
     return digest
 
+  def get_partial_path(self, digest):
+    path = self._path(digest)
+    self._ensure_shard(path)
+    return path + self.PARTIAL_SUFFIX
+
+  def move_in(self, digest, path):
+    with self._lock:
+      self._protected = self._protected or digest
+      self._pin(digest)
+    dst = self._path(digest)
+    self._ensure_shard(dst)
+    file_path.try_remove(dst)
+    size = fs.stat(path).st_size
+    fs.rename(path, dst)
+    file_path.set_read_only(dst, True)
+    with self._lock:
+      try:
+        self._written.add(digest)
+        self._add(digest, size)
+      finally:
+        self._release_claim(digest)
+    return digest
+
+  def claim(self, digest):
+    with self._lock:
+      return self._claim(digest)
+
+  def wait_claim(self, digest, size):
+    deadline = time.time() + self.CLAIM_TIMEOUT
+    delay = 0.01
+    while not self.claim(digest):
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        logging.warning(
+            'Another process is still fetching %s, fetching it too', digest)
+        return None
+      time.sleep(min(delay, remaining))
+      delay = min(delay * 2, 1.)
+    with self._lock:
+      self._pin(digest)
+      if not is_valid_file(self._path(digest), size):
+        return False
+      # The other process may not have saved its state yet.
+      if size == UNKNOWN_FILE_SIZE:
+        size = fs.stat(self._path(digest)).st_size
+      self._lru.add(digest, size)
+      self._protected = self._protected or digest
+      self._release_claim(digest)
+    return True
+
+  def release_claim(self, digest):
+    with self._lock:
+      self._release_claim(digest)
+
   def get_oldest(self):
     """Returns digest of the LRU item or None."""
     try:
@@ -1270,24 +2662,35 @@ class DiskCache(LocalCache):
     with self._lock:
       return self._trim()
 
-  def _load(self, trim, time_fn):
+  def _load(self, trim, time_fn, sharded):
     """Loads state of the cache from json file.
 
     If cache_dir does not exist on disk, it is created.
     """
     self._lock.assert_locked()
+    with self._state_lock:
+      self._update_layout()
+      if sharded and not self._sharded:
+        if self._pinned_by_others():
+          logging.warning(
+              'Not sharding %s, it is in use by other processes',
+              self.cache_dir)
+        else:
+          self._migrate()
 
     if not fs.isfile(self.state_file):
       if not os.path.isdir(self.cache_dir):
         fs.makedirs(self.cache_dir)
     else:
       # Load state of the cache.
+      self._state_stamp = self._stat_state()
       try:
         self._lru = lru.LRUDict.load(self.state_file)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+        self._state_stamp = self._stat_state()
     if time_fn:
       self._lru.time_fn = time_fn
     if trim:
@@ -1295,38 +2698,88 @@ class DiskCache(LocalCache):
     # We want the initial cache size after trimming, i.e. what is readily
     # avaiable.
     self._initial_number_items = len(self._lru)
-    self._initial_size = sum(self._lru.itervalues())
+    self._initial_size = self._lru.total
     if self._evicted:
       logging.info(
           'Trimming evicted items with the following sizes: %s',
           sorted(self._evicted))
 
-  def _save(self):
-    """Saves the LRU ordering."""
+  def _sync(self):
+    """Replays the changes of self._lru on the state saved by other processes.
+
+    Must be called with the state lock held.
+    """
+    self._lock.assert_locked()
+    self._update_layout()
+    stamp = self._stat_state()
+    if stamp[0] is not None and stamp != self._state_stamp:
+      try:
+        state = lru.LRUDict.load(self.state_file)
+      except ValueError as err:
+        # Keep what this process knows.
+        logging.error('Failed to load cache state: %s' % (err,))
+        return
+      state.time_fn = self._lru.time_fn
+      state.apply_changes(self._lru.get_changes())
+      self._lru = state
+      self._state_stamp = stamp
+
+  def _write_state(self):
+    """Writes self._lru to the state file if it was modified.
+
+    Must be called with the state lock held, after self._sync().
+    """
     self._lock.assert_locked()
     if sys.platform != 'win32':
       d = os.path.dirname(self.state_file)
       if fs.isdir(d):
         # Necessary otherwise the file can't be created.
         file_path.set_read_only(d, False)
-    if fs.isfile(self.state_file):
-      file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    if not self._lru.save(self.state_file):
+      return
+    for path in self._state_files():
+      if fs.isfile(path):
+        _ensure_mode(path, 0600)
+    self._state_stamp = self._stat_state()
+
+  def _state_files(self):
+    """Returns the paths of the state file and of its journal."""
+    return self.state_file, self.state_file + lru.JOURNAL_SUFFIX
+
+  def _stat_state(self):
+    """Returns what identifies the current version of the state."""
+    stamp = []
+    for path in self._state_files():
+      try:
+        stats = fs.stat(path)
+        stamp.append((stats.st_ino, stats.st_size, stats.st_mtime))
+      except OSError:
+        stamp.append(None)
+    return tuple(stamp)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
     self._lock.assert_locked()
+    with self._state_lock:
+      self._sync()
+      trimmed_due_to_space = self._trim_locked()
+      self._write_state()
+    return trimmed_due_to_space
 
+  def _trim_locked(self):
+    """Enforces the policies. Must be called with the state lock held."""
+    pinned = self._pinned_by_others()
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.itervalues())
-      while total_size > self.policies.max_cache_size:
-        total_size -= self._remove_lru_file(True)
+      while self._lru.total > self.policies.max_cache_size:
+        if self._remove_lru_file(True, pinned) is None:
+          break
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
       for _ in xrange(len(self._lru) - self.policies.max_items):
-        self._remove_lru_file(True)
+        if self._remove_lru_file(True, pinned) is None:
+          break
 
     # Ensure enough free space.
     self._free_disk = file_path.get_free_space(self.cache_dir)
@@ -1335,11 +2788,12 @@ class DiskCache(LocalCache):
         self.policies.min_free_space and
         self._lru and
         self._free_disk < self.policies.min_free_space):
+      if self._remove_lru_file(True, pinned) is None:
+        break
       trimmed_due_to_space += 1
-      self._remove_lru_file(True)
 
     if trimmed_due_to_space:
-      total_usage = sum(self._lru.itervalues())
+      total_usage = self._lru.total
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -1352,25 +2806,110 @@ class DiskCache(LocalCache):
           total_usage / 1024.,
           usage_percent,
           self.policies.max_cache_size / 1024.)
-    self._save()
     return trimmed_due_to_space
 
   def _path(self, digest):
     """Returns the path to one item."""
+    if self._sharded:
+      return os.path.join(self.cache_dir, digest[:2], digest[2:])
     return os.path.join(self.cache_dir, digest)
 
-  def _remove_lru_file(self, allow_protected):
-    """Removes the lastest recently used file and returns its size."""
+  def _ensure_shard(self, path):
+    """Creates the directory of the item at |path| if it is missing."""
+    if not self._sharded:
+      return
+    d = os.path.dirname(path)
+    if not fs.isdir(d):
+      try:
+        fs.mkdir(d)
+      except OSError as e:
+        # Another process may have created it.
+        if e.errno != errno.EEXIST:
+          raise
+
+  def _update_layout(self):
+    """Switches to the sharded layout if the cache was migrated.
+
+    Must be called with the state lock held.
+    """
+    if not self._sharded:
+      self._sharded = fs.isfile(
+          os.path.join(self.cache_dir, self.SHARDED_FILE))
+
+  def _migrate(self):
+    """Moves the items of a flat cache into their shard.
+
+    The cache is marked as sharded first, so cleanup() moves the items left
+    behind if the process dies halfway. Must be called with the state lock held
+    and no other process using the cache.
+    """
+    logging.info('Sharding %s', self.cache_dir)
+    with fs.open(os.path.join(self.cache_dir, self.SHARDED_FILE), 'wb'):
+      pass
+    self._sharded = True
+    for filename in fs.listdir(self.cache_dir):
+      self._move_to_shard(filename)
+
+  def _move_to_shard(self, filename):
+    """Moves a file at the top of a sharded cache into its shard.
+
+    Returns its new path, or None if it is not an item.
+    """
+    if len(filename) <= 2 or filename in self._RESERVED:
+      return None
+    src = os.path.join(self.cache_dir, filename)
+    if not fs.isfile(src):
+      return None
+    dst = self._path(filename)
+    self._ensure_shard(dst)
+    file_path.try_remove(dst)
+    fs.rename(src, dst)
+    return dst
+
+  def _list_items(self):
+    """Yields (name, path) of the files and directories that may be items.
+
+    In a sharded cache, the name of a file in a shard is the name of its shard
+    followed by its own.
+    """
+    for filename in fs.listdir(self.cache_dir):
+      if filename in self._RESERVED:
+        continue
+      p = os.path.join(self.cache_dir, filename)
+      if self._sharded:
+        if len(filename) == 2 and fs.isdir(p):
+          _ensure_mode(p, 0700)
+          for name in fs.listdir(p):
+            yield filename + name, os.path.join(p, name)
+          continue
+        # Left behind by an interrupted migration.
+        dst = self._move_to_shard(filename)
+        if dst:
+          yield filename, dst
+          continue
+      yield filename, p
+
+  def _remove_lru_file(self, allow_protected, pinned):
+    """Removes the lastest recently used file and returns its size.
+
+    The items in |pinned| are skipped, returns None if only they are left. Must
+    be called with the state lock held.
+    """
     self._lock.assert_locked()
-    try:
-      digest, (size, _) = self._lru.get_oldest()
-      if not allow_protected and digest == self._protected:
-        raise Error(
-            'Not enough space to fetch the whole isolated tree; %sb free, min '
-            'is %sb' % (self._free_disk, self.policies.min_free_space))
-    except KeyError:
+    if not self._lru:
       raise Error('Nothing to remove')
-    digest, (size, _) = self._lru.pop_oldest()
+    for digest in self._lru:
+      if digest not in pinned:
+        break
+    else:
+      logging.warning('All the items left are in use by other processes')
+      return None
+    if not allow_protected and (
+        digest == self._protected or digest in self._pinned):
+      raise Error(
+          'Not enough space to fetch the whole isolated tree; %sb free, min '
+          'is %sb' % (self._free_disk, self.policies.min_free_space))
+    size = self._lru.pop(digest)
     logging.debug('Removing LRU file %s', digest)
     self._delete_file(digest, size)
     return size
@@ -1389,11 +2928,18 @@ class DiskCache(LocalCache):
     # real trimming but doing this quick version here makes it possible to map
     # an isolated that is larger than the current amount of free disk space when
     # the cache size is already large.
-    while (
-        self.policies.min_free_space and
-        self._lru and
+    if (self.policies.min_free_space and
         self._free_disk < self.policies.min_free_space):
-      self._remove_lru_file(False)
+      with self._state_lock:
+        pinned = self._pinned_by_others()
+        while (
+            self._lru and
+            self._free_disk < self.policies.min_free_space):
+          if self._remove_lru_file(False, pinned) is None:
+            raise Error(
+                'Not enough space to fetch the whole isolated tree; %sb free, '
+                'min is %sb' % (
+                    self._free_disk, self.policies.min_free_space))
 
   def _delete_file(self, digest, size=UNKNOWN_FILE_SIZE):
     """Deletes cache file from the file system."""
@@ -1411,6 +2957,167 @@ class DiskCache(LocalCache):
       if e.errno != errno.ENOENT:
         logging.error('Error attempting to delete a file %s:\n%s' % (digest, e))
 
+  def _pin(self, digest):
+    """Keeps the other processes from evicting |digest| until closed."""
+    self._lock.assert_locked()
+    if digest in self._pinned:
+      return
+    with self._state_lock:
+      self._update_layout()
+      self._ensure_pins()
+      self._pins.file.write(digest.encode('utf-8') + '\n')
+      self._pins.file.flush()
+    self._pinned.add(digest)
+
+  def _ensure_pins(self):
+    """Creates and locks the pins file of this process if needed.
+
+    Must be called with the state lock held.
+    """
+    if not self._pins:
+      self._pins = file_lock.FileLock(os.path.join(
+          self._locks_dir,
+          u'%d.%s%s' % (
+              os.getpid(), os.urandom(4).encode('hex'), self.PINS_SUFFIX)))
+      self._pins.acquire()
+
+  def _pinned_by_others(self):
+    """Returns the set of items pinned by the other processes.
+
+    Deletes the files left by dead processes, after adding the items they used
+    to the integrity journal, and their claims. Must be called with the state
+    lock held.
+    """
+    self._lock.assert_locked()
+    pinned = set()
+    own = self._pins.path if self._pins else None
+    dead = set()
+    claims = []
+    for filename in fs.listdir(self._locks_dir):
+      path = os.path.join(self._locks_dir, filename)
+      if filename.endswith(self.FETCH_SUFFIX):
+        claims.append(path)
+        continue
+      if path == own or not filename.endswith(self.PINS_SUFFIX):
+        continue
+      lock = file_lock.FileLock(path)
+      if lock.acquire(blocking=False):
+        # Its process is gone, it may have been writing the items it pinned.
+        self._append_integrity((), self._read_pins(path), crashed=True)
+        lock.release(delete=True)
+        dead.add(filename)
+        continue
+      lock.close()
+      pinned.update(self._read_pins(path))
+    if dead:
+      # The claims are only read once a process is found dead, which is rare.
+      for path in claims:
+        if self._read_claim(path) in dead:
+          file_path.try_remove(path)
+    return pinned
+
+  def _read_pins(self, path):
+    """Returns the items listed in the pins file |path|."""
+    try:
+      with fs.open(path, 'rb') as f:
+        return f.read().decode('utf-8').split()
+    except IOError:
+      return []
+
+  def _claim_path(self, digest):
+    return os.path.join(self._locks_dir, digest + self.FETCH_SUFFIX)
+
+  def _claim(self, digest):
+    """Claims the fetch of |digest|, or takes it over from a dead process.
+
+    The claim is a file created exclusively, no file stays open per claim.
+    Returns False if another process has it.
+    """
+    self._lock.assert_locked()
+    if digest in self._claims:
+      return True
+    if not self._pins:
+      with self._state_lock:
+        # The claim tells the other processes to look at the pins file.
+        self._ensure_pins()
+    path = self._claim_path(digest)
+    # Tried again once if a stale claim file was removed.
+    for _ in xrange(2):
+      try:
+        fd = os.open(
+            fs.extend(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+        with self._state_lock:
+          if not self._is_stale_claim(path):
+            return False
+          file_path.try_remove(path)
+        continue
+      try:
+        os.write(fd, os.path.basename(self._pins.path).encode('utf-8'))
+      finally:
+        os.close(fd)
+      self._claims.add(digest)
+      return True
+    return False
+
+  def _is_stale_claim(self, path):
+    """Returns True if the process that created the claim file |path| is gone.
+
+    Must be called with the state lock held.
+    """
+    owner = self._read_claim(path)
+    if owner is None:
+      # Released meanwhile.
+      return True
+    if not owner:
+      # Its process may not have written it yet, or died right after creating
+      # it.
+      try:
+        return time.time() - fs.stat(path).st_mtime > self.CLAIM_TIMEOUT
+      except OSError:
+        return True
+    pins = os.path.join(self._locks_dir, owner)
+    if owner.endswith(self.PINS_SUFFIX) and fs.isfile(pins):
+      lock = file_lock.FileLock(pins)
+      alive = not lock.acquire(blocking=False)
+      lock.close()
+      if alive:
+        return False
+    logging.warning('Removing the claim of %s left by a dead process', path)
+    return True
+
+  def _read_claim(self, path):
+    """Returns the name of the pins file of the owner of the claim file |path|.
+
+    Returns None if it doesn't exist.
+    """
+    try:
+      with fs.open(path, 'rb') as f:
+        return os.path.basename(f.read().decode('utf-8'))
+    except IOError:
+      return None
+
+  def _release_claim(self, digest):
+    self._lock.assert_locked()
+    if digest in self._claims:
+      self._claims.remove(digest)
+      file_path.try_remove(self._claim_path(digest))
+
+  def _release_locks(self):
+    """Releases the claims and pins of this process."""
+    self._lock.assert_locked()
+    for digest in list(self._claims):
+      self._release_claim(digest)
+    if self._pins:
+      with self._state_lock:
+        self._append_integrity(self._pinned - self._written, self._written)
+      self._pins.release(delete=True)
+      self._pins = None
+    self._pinned = set()
+    self._written = set()
+
 
 class IsolatedBundle(object):
   """Fetched and parsed .isolated file with all dependencies."""
@@ -1542,7 +3249,7 @@ class IsolatedBundle(object):
       self.relative_cwd = node.data['relative_cwd']
 
 
-def get_storage(url, namespace):
+def get_storage(url, namespace, presence_cache=None):
   """Returns Storage class that can upload and download from |namespace|.
 
   Arguments:
@@ -1550,20 +3257,24 @@ def get_storage(url, namespace):
     namespace: isolate namespace to operate in, also defines hashing and
         compression scheme used, i.e. namespace names that end with '-gzip'
         store compressed data.
+    presence_cache: optional PresenceCache to skip the existence checks of
+        items recently found on the server.
 
   Returns:
     Instance of Storage.
   """
-  return Storage(isolate_storage.get_storage_api(url, namespace))
+  return Storage(
+      isolate_storage.get_storage_api(url, namespace), presence_cache)
 
 
-def upload_tree(base_url, infiles, namespace):
+def upload_tree(base_url, infiles, namespace, presence_cache=None):
   """Uploads the given tree to the given url.
 
   Arguments:
     base_url:  The url of the isolate server to upload to.
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
+    presence_cache: optional PresenceCache, see get_storage().
   """
   # Convert |infiles| into a list of FileItem objects, skip duplicates.
   # Filter out symlinks, since they are not represented by items on isolate
@@ -1585,13 +3296,117 @@ def upload_tree(base_url, infiles, namespace):
       skipped += 1
 
   logging.info('Skipped %d duplicated entries', skipped)
-  with get_storage(base_url, namespace) as storage:
+  with get_storage(base_url, namespace, presence_cache) as storage:
     return storage.upload_items(items)
 
 
+class _TreeMaterializer(object):
+  """Creates the files of an isolated tree from the cache, in a thread pool.
+
+  The first error of a worker is raised by check() or join().
+  """
+
+  def __init__(self, cache, outdir, use_symlinks):
+    self._cache = cache
+    self._outdir = outdir
+    self._use_symlinks = use_symlinks
+    self._pool = threading_utils.ThreadPool(
+        0, MATERIALIZE_THREADS, 0, 'materialize')
+    self._lock = threading.Lock()
+    self._error = None
+    # Time spent creating files, summed over the threads.
+    self.duration = 0.
+
+  def add(self, digest, entries):
+    """Creates the files |entries|, list of (path, props), of |digest|."""
+    self._pool.add_task(0, self._materialize, digest, entries)
+
+  def check(self):
+    """Raises the first error of a worker, if any."""
+    with self._lock:
+      if self._error:
+        raise self._error[0], self._error[1], self._error[2]
+
+  def join(self):
+    """Waits for all the files to be created and closes the pool."""
+    try:
+      self._pool.join()
+    finally:
+      self._pool.close()
+    self.check()
+
+  def _materialize(self, digest, entries):
+    start = time.time()
+    try:
+      for filepath, props in entries:
+        self._create(digest, os.path.join(self._outdir, filepath), props)
+    except Exception:
+      with self._lock:
+        self._error = self._error or sys.exc_info()
+    finally:
+      with self._lock:
+        self.duration += time.time() - start
+
+  def _create(self, digest, fullpath, props):
+    """Creates the file at |fullpath| using the item in cache as the source."""
+    filetype = props.get('t', 'basic')
+    if filetype == 'basic':
+      file_mode = props.get('m')
+      if file_mode:
+        # Ignore all bits apart from the user
+        file_mode &= 0700
+      srcpath = self._cache.getfilepath(digest)
+      if srcpath:
+        putfile_from_path(
+            srcpath, fullpath, file_mode, use_symlink=self._use_symlinks)
+      else:
+        with self._cache.getfileobj(digest) as srcfileobj:
+          putfile(
+              srcfileobj, fullpath, file_mode,
+              use_symlink=self._use_symlinks)
+
+    elif filetype == 'tar':
+      basedir = os.path.dirname(fullpath)
+      with self._cache.getfileobj(digest) as srcfileobj:
+        with tarfile.TarFile(fileobj=srcfileobj) as extractor:
+          for ti in extractor:
+            if not ti.isfile():
+              logging.warning(
+                  'Path(%r) is nonfile (%s), skipped',
+                  ti.name, ti.type)
+              continue
+            fp = os.path.normpath(os.path.join(basedir, ti.name))
+            if not fp.startswith(basedir):
+              logging.error(
+                  'Path(%r) is outside root directory',
+                  fp)
+            ifd = extractor.extractfile(ti)
+            file_path.ensure_tree(os.path.dirname(fp))
+            putfile(ifd, fp, 0700, ti.size)
+
+    elif filetype == 'ar':
+      basedir = os.path.dirname(fullpath)
+      with self._cache.getfileobj(digest) as srcfileobj:
+        extractor = arfile.ArFileReader(srcfileobj, fullparse=False)
+        for ai, ifd in extractor:
+          fp = os.path.normpath(os.path.join(basedir, ai.name))
+          if not fp.startswith(basedir):
+            logging.error(
+                'Path(%r) is outside root directory',
+                fp)
+          file_path.ensure_tree(os.path.dirname(fp))
+          putfile(ifd, fp, 0700, ai.size)
+
+    else:
+      raise isolated_format.IsolatedError(
+            'Unknown file type %r', filetype)
+
+
 def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   """Aggressively downloads the .isolated file(s), then download all the files.
 
+  The files are created by a pool of threads as they arrive in the cache.
+
   Arguments:
     isolated_hash: hash of the root *.isolated file.
     storage: Storage class that communicates with isolate storage.
@@ -1646,71 +3461,27 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
       logging.info('Retrieving remaining files (%d of them)...',
           fetch_queue.pending_count)
       last_update = time.time()
-      with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
-        while remaining:
-          detector.ping()
-
-          # Wait for any item to finish fetching to cache.
-          digest = fetch_queue.wait(remaining)
-
-          # Create the files in the destination using item in cache as the
-          # source.
-          for filepath, props in remaining.pop(digest):
-            fullpath = os.path.join(outdir, filepath)
-
-            with cache.getfileobj(digest) as srcfileobj:
-              filetype = props.get('t', 'basic')
-
-              if filetype == 'basic':
-                file_mode = props.get('m')
-                if file_mode:
-                  # Ignore all bits apart from the user
-                  file_mode &= 0700
-                putfile(
-                    srcfileobj, fullpath, file_mode,
-                    use_symlink=use_symlinks)
-
-              elif filetype == 'tar':
-                basedir = os.path.dirname(fullpath)
-                with tarfile.TarFile(fileobj=srcfileobj) as extractor:
-                  for ti in extractor:
-                    if not ti.isfile():
-                      logging.warning(
-                          'Path(%r) is nonfile (%s), skipped',
-                          ti.name, ti.type)
-                      continue
-                    fp = os.path.normpath(os.path.join(basedir, ti.name))
-                    if not fp.startswith(basedir):
-                      logging.error(
-                          'Path(%r) is outside root directory',
-                          fp)
-                    ifd = extractor.extractfile(ti)
-                    file_path.ensure_tree(os.path.dirname(fp))
-                    putfile(ifd, fp, 0700, ti.size)
-
-              elif filetype == 'ar':
-                basedir = os.path.dirname(fullpath)
-                extractor = arfile.ArFileReader(srcfileobj, fullparse=False)
-                for ai, ifd in extractor:
-                  fp = os.path.normpath(os.path.join(basedir, ai.name))
-                  if not fp.startswith(basedir):
-                    logging.error(
-                        'Path(%r) is outside root directory',
-                        fp)
-                  file_path.ensure_tree(os.path.dirname(fp))
-                  putfile(ifd, fp, 0700, ai.size)
-
-              else:
-                raise isolated_format.IsolatedError(
-                      'Unknown file type %r', filetype)
-
-          # Report progress.
-          duration = time.time() - last_update
-          if duration > DELAY_BETWEEN_UPDATES_IN_SECS:
-            msg = '%d files remaining...' % len(remaining)
-            print msg
-            logging.info(msg)
-            last_update = time.time()
+      materializer = _TreeMaterializer(cache, outdir, use_symlinks)
+      try:
+        with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
+          while remaining:
+            detector.ping()
+
+            # Wait for any item to finish fetching to cache.
+            digest = fetch_queue.wait(remaining)
+            materializer.add(digest, remaining.pop(digest))
+            materializer.check()
+
+            # Report progress.
+            duration = time.time() - last_update
+            if duration > DELAY_BETWEEN_UPDATES_IN_SECS:
+              msg = '%d files remaining...' % len(remaining)
+              print msg
+              logging.info(msg)
+              last_update = time.time()
+      finally:
+        materializer.join()
+      logging.info('Created the files in %.3fs', materializer.duration)
 
   # Cache could evict some items we just tried to fetch, it's a fatal error.
   if not fetch_queue.verify_all_cached():
@@ -1719,30 +3490,138 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
+def bundle_small_files(root, files, algo, tempdir):
+  """Packs the small files of a tree into ar bundles, directory by directory.
+
+  The files of a directory are sorted by name and cut into bundles after each
+  file name whose hash is a multiple of BUNDLE_AVG_FILES, or before a bundle
+  grows past BUNDLE_MAX_SIZE. The ar headers only contain the names and sizes.
+  So a bundle's content and digest only depend on the files it contains, and
+  modifying a file only changes its own bundle. The bundles of unmodified
+  directories are still cache hits on the next build.
+
+  fetch_isolated() extracts 'ar' entries in the directory of the entry, with
+  mode 0700, so the modes of the bundled files are not kept.
+
+  Arguments:
+    root: directory the paths in |files| are relative to.
+    files: dict of .isolated 'files' entries. The bundled files are replaced
+        by their bundle, in place.
+    algo: hashing algorithm used.
+    tempdir: directory to write the bundles to.
+
+  Returns:
+    list of tuple(path, metadata, list of bundled relpaths) of the bundles
+    written in |tempdir|.
+  """
+  by_dir = {}
+  for relpath, meta in files.iteritems():
+    if ('h' in meta and meta.get('t', 'basic') == 'basic' and
+        meta['s'] <= BUNDLE_MAX_FILE_SIZE and
+        not relpath.endswith('.isolated')):
+      by_dir.setdefault(os.path.dirname(relpath), []).append(relpath)
+
+  bundles = []
+  bundled = 0
+  for dirpath, relpaths in sorted(by_dir.iteritems()):
+    chunks = [[]]
+    size = 0
+    for relpath in sorted(relpaths):
+      if chunks[-1] and size + files[relpath]['s'] > BUNDLE_MAX_SIZE:
+        chunks.append([])
+        size = 0
+      chunks[-1].append(relpath)
+      size += files[relpath]['s']
+      name = os.path.basename(relpath).encode('utf-8')
+      if not int(hashlib.sha1(name).hexdigest()[:8], 16) % BUNDLE_AVG_FILES:
+        chunks.append([])
+        size = 0
+
+    index = 0
+    for chunk in chunks:
+      # A single file is not worth the ar header.
+      if len(chunk) < 2:
+        continue
+      buf = io.BytesIO()
+      writer = arfile.ArFileWriter(buf)
+      for relpath in chunk:
+        with fs.open(os.path.join(root, relpath), 'rb') as f:
+          content = f.read()
+        if algo(content).hexdigest() != files[relpath]['h']:
+          raise Error('%s was modified while archiving' % relpath)
+        writer.addfile(
+            arfile.ArInfo.fromdefault(os.path.basename(relpath), len(content)),
+            io.BytesIO(content))
+      data = buf.getvalue()
+      digest = algo(data).hexdigest()
+      path = os.path.join(tempdir, u'%s.ar' % digest)
+      with fs.open(path, 'wb') as f:
+        f.write(data)
+
+      while True:
+        bundle_relpath = os.path.join(dirpath, u'.isolate_bundle_%d.ar' % index)
+        index += 1
+        if bundle_relpath not in files:
+          break
+      for relpath in chunk:
+        del files[relpath]
+      bundled += len(chunk)
+      meta = {'h': digest, 's': len(data), 't': 'ar'}
+      files[bundle_relpath] = meta
+      bundles.append((path, meta, chunk))
+  if bundles:
+    logging.info('Bundled %d small files in %d bundles', bundled, len(bundles))
+  return bundles
+
+
+def directory_to_metadata(root, algo, blacklist, hash_cache=None):
   """Returns the FileItem list and .isolated metadata for a directory."""
+  metadata = {}
+  items = list(
+      iter_directory_items(root, algo, blacklist, metadata, hash_cache))
+  return items, metadata
+
+
+def iter_directory_items(root, algo, blacklist, metadata, hash_cache=None):
+  """Yields a FileItem for each file in a directory as soon as it is hashed.
+
+  The directory is walked while its files are hashed in parallel.
+
+  Arguments:
+    root: directory to walk.
+    algo: hashing algorithm used.
+    blacklist: function that returns True if a file should be omitted.
+    metadata: dict filled with the .isolated metadata of every entry, including
+        symlinks. It is complete once the generator is exhausted.
+    hash_cache: optional hash_cache.HashCache to skip hashing unmodified files.
+  """
   root = file_path.get_native_path_case(root)
-  paths = isolated_format.expand_directory_and_symlink(
-      root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo, False)
-    for relpath in paths
-  }
-  for v in metadata.itervalues():
-    v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
+  # Maps the path of each file walked to its path relative to |root|.
+  relpaths = {}
+  def walk():
+    for relpath in isolated_format.iter_directory_and_symlink(
+        root, '.' + os.path.sep, blacklist, sys.platform != 'win32'):
+      filepath = os.path.join(root, relpath)
+      # A file can be reached through a symlink too.
+      if filepath not in relpaths:
+        relpaths[filepath] = relpath
+        yield filepath, {}
+
+  for filepath, meta in isolated_format.iter_file_to_metadata(
+      walk(), 0, algo, False, ordered=False, hash_cache=hash_cache):
+    relpath = relpaths[filepath]
+    meta.pop('t')
+    metadata[relpath] = meta
+    if 'h' in meta:
+      yield FileItem(
+          path=filepath,
           digest=meta['h'],
           size=meta['s'],
           high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
-  return items, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(
+    storage, files, blacklist, hash_cache=None, bundle=False):
   """Stores every entries and returns the relevant data.
 
   Arguments:
@@ -1750,6 +3629,9 @@ def archive_files_to_storage(storage, files, blacklist):
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    hash_cache: optional hash_cache.HashCache to skip hashing unmodified files.
+    bundle: if True, the small files of the directories are uploaded in
+        bundles, see bundle_small_files().
 
   Returns:
     tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
@@ -1761,23 +3643,55 @@ def archive_files_to_storage(storage, files, blacklist):
 
   # List of tuple(hash, path).
   results = []
+  # All the items to upload, in the order they are passed to upload_items().
+  items_to_upload = []
   # The temporary directory is only created as needed.
-  tempdir = None
-  try:
-    # TODO(maruel): Yield the files to a worker thread.
-    items_to_upload = []
+  tempdir = []
+
+  def get_tempdir():
+    if not tempdir:
+      tempdir.append(tempfile.mkdtemp(prefix=u'isolateserver'))
+    return tempdir[0]
+
+  def iter_items():
+    """Yields the items to upload as soon as they are hashed.
+
+    This way the directories are walked, the files hashed, looked up on the
+    server and uploaded all at the same time.
+    """
     for f in files:
       try:
         filepath = os.path.abspath(f)
         if fs.isdir(filepath):
           # Uploading a whole directory.
-          items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+          metadata = {}
+          # Small files are held back until the whole directory is walked, to
+          # be uploaded either in a bundle or alone.
+          held = []
+          for item in iter_directory_items(
+              filepath, storage.hash_algo, blacklist, metadata, hash_cache):
+            if (bundle and item.size <= BUNDLE_MAX_FILE_SIZE and
+                not item.high_priority):
+              held.append(item)
+              continue
+            items_to_upload.append(item)
+            yield item
+
+          if held:
+            root = file_path.get_native_path_case(filepath)
+            for path, meta, _ in bundle_small_files(
+                root, metadata, storage.hash_algo, get_tempdir()):
+              item = FileItem(path=path, digest=meta['h'], size=meta['s'])
+              items_to_upload.append(item)
+              yield item
+            for item in held:
+              if os.path.relpath(item.path, root) in metadata:
+                items_to_upload.append(item)
+                yield item
 
           # Create the .isolated file.
-          if not tempdir:
-            tempdir = tempfile.mkdtemp(prefix=u'isolateserver')
-          handle, isolated = tempfile.mkstemp(dir=tempdir, suffix=u'.isolated')
+          handle, isolated = tempfile.mkstemp(
+              dir=get_tempdir(), suffix=u'.isolated')
           os.close(handle)
           data = {
               'algo':
@@ -1787,38 +3701,40 @@ def archive_files_to_storage(storage, files, blacklist):
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
-          items_to_upload.extend(items)
-          items_to_upload.append(
-              FileItem(
-                  path=isolated,
-                  digest=h,
-                  size=fs.stat(isolated).st_size,
-                  high_priority=True))
-          results.append((h, f))
+          item = FileItem(
+              path=isolated,
+              digest=h,
+              size=fs.stat(isolated).st_size,
+              high_priority=True)
 
         elif fs.isfile(filepath):
           h = isolated_format.hash_file(filepath, storage.hash_algo)
-          items_to_upload.append(
-            FileItem(
-                path=filepath,
-                digest=h,
-                size=fs.stat(filepath).st_size,
-                high_priority=f.endswith('.isolated')))
-          results.append((h, f))
+          item = FileItem(
+              path=filepath,
+              digest=h,
+              size=fs.stat(filepath).st_size,
+              high_priority=f.endswith('.isolated'))
         else:
           raise Error('%s is neither a file or directory.' % f)
       except OSError:
         raise Error('Failed to process %s.' % f)
-    uploaded = storage.upload_items(items_to_upload)
+      items_to_upload.append(item)
+      results.append((h, f))
+      yield item
+
+  try:
+    uploaded = set(storage.upload_items(iter_items()))
     cold = [i for i in items_to_upload if i in uploaded]
     hot = [i for i in items_to_upload if i not in uploaded]
     return results, cold, hot
   finally:
-    if tempdir and fs.isdir(tempdir):
-      file_path.rmtree(tempdir)
+    if tempdir and fs.isdir(tempdir[0]):
+      file_path.rmtree(tempdir[0])
 
 
-def archive(out, namespace, files, blacklist):
+def archive(
+    out, namespace, files, blacklist, hash_cache_path=None,
+    presence_cache_path=None, bundle=False):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -1827,9 +3743,12 @@ def archive(out, namespace, files, blacklist):
 
   files = [f.decode('utf-8') for f in files]
   blacklist = tools.gen_blacklist(blacklist)
-  with get_storage(out, namespace) as storage:
-    # Ignore stats.
-    results = archive_files_to_storage(storage, files, blacklist)[0]
+  with open_presence_cache(presence_cache_path) as presence_cache:
+    with get_storage(out, namespace, presence_cache) as storage:
+      with open_hash_cache(hash_cache_path) as hash_cache:
+        # Ignore stats.
+        results = archive_files_to_storage(
+            storage, files, blacklist, hash_cache, bundle)[0]
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -1850,7 +3769,9 @@ def CMDarchive(parser, args):
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True, True)
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        options.hash_cache, options.presence_cache, options.bundle_small_files)
   except Error as e:
     parser.error(e.args[0])
   return 0
@@ -1938,6 +3859,31 @@ def add_archive_options(parser):
       action='append', default=list(DEFAULT_BLACKLIST),
       help='List of regexp to use as blacklist filter when uploading '
            'directories')
+  parser.add_option(
+      '--bundle-small-files', action='store_true',
+      help='Uploads the files of %d bytes or less in ar bundles, one or more '
+           'per directory, to reduce the number of items to upload and '
+           'download. The files in bundles are mapped with mode 0700' %
+           BUNDLE_MAX_FILE_SIZE)
+  add_upload_cache_options(parser)
+
+
+def add_upload_cache_options(parser):
+  """Adds --hash-cache and --presence-cache options to parser."""
+  parser.add_option(
+      '--hash-cache',
+      metavar='FILE', default=os.environ.get('ISOLATE_HASH_CACHE', ''),
+      help='File to keep the digests of the files hashed on this machine, '
+           'keyed by inode and timestamp, so they are not hashed again until '
+           'they are modified. Can be shared by concurrent processes. '
+           'Defaults to $ISOLATE_HASH_CACHE')
+  parser.add_option(
+      '--presence-cache',
+      metavar='FILE', default=os.environ.get('ISOLATE_PRESENCE_CACHE', ''),
+      help='File to keep the digests recently found on the isolate server, so '
+           'they are not looked up again for %d seconds. Can be shared by '
+           'concurrent processes. Defaults to $ISOLATE_PRESENCE_CACHE' %
+           PRESENCE_CACHE_TTL)
 
 
 def add_isolate_server_options(parser):
@@ -1953,6 +3899,11 @@ def add_isolate_server_options(parser):
   parser.add_option(
       '--namespace', default='default-gzip',
       help='The namespace to use on the Isolate Server, default: %default')
+  parser.add_option(
+      '--memory-budget', type='int', metavar='MB',
+      default=isolate_storage.DEFAULT_MEMORY_BUDGET_MB,
+      help='Maximum number of megabytes held in memory by the uploads at '
+           'once, default: %default')
 
 
 def process_isolate_server_options(
@@ -1961,6 +3912,7 @@ def process_isolate_server_options(
 
   Returns the identity as determined by the server.
   """
+  isolate_storage.set_memory_budget(options.memory_budget)
   if not options.isolate_server:
     if required:
       parser.error('--isolate-server is required.')
@@ -2007,9 +3959,47 @@ def add_cache_options(parser):
       default=100000,
       help='Trim if more than this number of items are in the cache '
            'default=%default')
+  cache_group.add_option(
+      '--sharded-cache',
+      action='store_true',
+      help='Keep the items in subdirectories of the cache, faster with '
+           'hundreds of thousands of items. An existing cache is migrated and '
+           'stays sharded')
+  cache_group.add_option(
+      '--verify-cache',
+      action='store_true',
+      help='Hash the items written or used since they were last hashed when '
+           'cleaning the cache, and evict the corrupted ones. Slow, meant for '
+           '--clean runs')
   parser.add_option_group(cache_group)
 
 
+@contextlib.contextmanager
+def open_hash_cache(path):
+  """Yields a hash_cache.HashCache saved to |path| on exit, or None if |path|
+  is empty.
+  """
+  if not path:
+    yield None
+    return
+  with hash_cache_module.HashCache(unicode(os.path.abspath(path))) as cache:
+    yield cache
+  logging.info(
+      'Hash cache %s: %d hits, %d misses', path, cache.hits, cache.misses)
+
+
+@contextlib.contextmanager
+def open_presence_cache(path):
+  """Yields a PresenceCache saved to |path| on exit, or None if |path| is
+  empty.
+  """
+  if not path:
+    yield None
+    return
+  with PresenceCache(unicode(os.path.abspath(path))) as cache:
+    yield cache
+
+
 def process_cache_options(options, **kwargs):
   if options.cache:
     policies = CachePolicies(
@@ -2020,6 +4010,8 @@ def process_cache_options(options, **kwargs):
         unicode(os.path.abspath(options.cache)),
         policies,
         isolated_format.get_hash_algo(options.namespace),
+        sharded=options.sharded_cache,
+        verify=options.verify_cache,
         **kwargs)
   else:
     return MemoryCache()
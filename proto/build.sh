@@ -6,10 +6,11 @@
 # Python packages must be installed, or else you'll get an error. I recommend
 # using virtualenv to do this.
 #
-# Call this script every time you modify the .proto file and check in the
+# Call this script every time you modify a .proto file and check in the
 # resulting *_pb2.py files as well.
 python -m grpc.tools.protoc \
   --python_out=. \
   --grpc_python_out=. \
   bytestream.proto \
+  cas.proto \
   -I.
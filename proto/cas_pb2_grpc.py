@@ -0,0 +1,55 @@
+# Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
+import grpc
+from grpc.framework.common import cardinality
+from grpc.framework.interfaces.face import utilities as face_utilities
+
+import cas_pb2 as cas__pb2
+
+
+class ContentAddressableStorageStub(object):
+  """The Content Addressable Storage (CAS) is used to store the inputs to and
+  outputs from the execution service. Each piece of content is addressed by the
+  digest of its binary data.
+  """
+
+  def __init__(self, channel):
+    """Constructor.
+
+    Args:
+      channel: A grpc.Channel.
+    """
+    self.FindMissingBlobs = channel.unary_unary(
+        '/build.bazel.remote.execution.v2.ContentAddressableStorage/FindMissingBlobs',
+        request_serializer=cas__pb2.FindMissingBlobsRequest.SerializeToString,
+        response_deserializer=cas__pb2.FindMissingBlobsResponse.FromString,
+        )
+
+
+class ContentAddressableStorageServicer(object):
+  """The Content Addressable Storage (CAS) is used to store the inputs to and
+  outputs from the execution service. Each piece of content is addressed by the
+  digest of its binary data.
+  """
+
+  def FindMissingBlobs(self, request, context):
+    """Determine if blobs are present in the CAS.
+
+    Clients can use this API before uploading blobs to determine which ones are
+    already present in the CAS and do not need to be uploaded again.
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+
+def add_ContentAddressableStorageServicer_to_server(servicer, server):
+  rpc_method_handlers = {
+      'FindMissingBlobs': grpc.unary_unary_rpc_method_handler(
+          servicer.FindMissingBlobs,
+          request_deserializer=cas__pb2.FindMissingBlobsRequest.FromString,
+          response_serializer=cas__pb2.FindMissingBlobsResponse.SerializeToString,
+      ),
+  }
+  generic_handler = grpc.method_handlers_generic_handler(
+      'build.bazel.remote.execution.v2.ContentAddressableStorage', rpc_method_handlers)
+  server.add_generic_rpc_handlers((generic_handler,))
@@ -415,6 +415,13 @@ def link_outputs_to_outdir(run_dir, out_dir, outputs):
   if not outputs:
     return
   isolateserver.create_directories(out_dir, outputs)
+  # A clone keeps the output intact if a process left behind modifies the file
+  # in |run_dir|, a hardlink doesn't. |run_dir| may be read only, so probe
+  # |out_dir|; both are usually on the same filesystem.
+  if file_path.can_reflink(out_dir):
+    link_mode = file_path.REFLINK_WITH_FALLBACK
+  else:
+    link_mode = file_path.HARDLINK_WITH_FALLBACK
   for o in outputs:
     try:
       infile = os.path.join(run_dir, o)
@@ -423,14 +430,16 @@ def link_outputs_to_outdir(run_dir, out_dir, outputs):
         # TODO(aludwin): handle directories
         fs.copy2(infile, outfile)
       else:
-        file_path.link_file(outfile, infile, file_path.HARDLINK_WITH_FALLBACK)
+        file_path.link_file(outfile, infile, link_mode)
     except OSError as e:
       logging.info("Couldn't collect output file %s: %s", o, e)
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+def delete_and_upload(storage, out_dir, leak_temp_dir, hash_cache=None):
   """Deletes the temporary run directory and uploads results back.
 
+  |hash_cache| is an optional hash_cache.HashCache used to hash the outputs.
+
   Returns:
     tuple(outputs_ref, success, stats)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -451,7 +460,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, hash_cache)
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
@@ -492,7 +501,7 @@ def map_and_run(
     command, isolated_hash, storage, isolate_cache, outputs,
     install_named_caches, leak_temp_dir, root_dir, hard_timeout, grace_period,
     bot_file, switch_to_account, install_packages_fn, use_symlinks,
-    constant_run_path):
+    constant_run_path, hash_cache=None):
   """Runs a command with optional isolated input/output.
 
   See run_tha_test for argument documentation.
@@ -657,7 +666,7 @@ def map_and_run(
       if out_dir:
         isolated_stats = result['stats'].setdefault('isolated', {})
         result['outputs_ref'], success, isolated_stats['upload'] = (
-            delete_and_upload(storage, out_dir, leak_temp_dir))
+            delete_and_upload(storage, out_dir, leak_temp_dir, hash_cache))
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
     except Exception as e:
@@ -672,7 +681,7 @@ def run_tha_test(
     command, isolated_hash, storage, isolate_cache, outputs,
     install_named_caches, leak_temp_dir, result_json, root_dir, hard_timeout,
     grace_period, bot_file, switch_to_account, install_packages_fn,
-    use_symlinks):
+    use_symlinks, hash_cache=None):
   """Runs an executable and records execution metadata.
 
   Either command or isolated_hash must be specified.
@@ -718,6 +727,7 @@ def run_tha_test(
     install_packages_fn: context manager dir => CipdInfo, see
                          install_client_and_packages.
     use_symlinks: create tree with symlinks instead of hardlinks.
+    hash_cache: optional hash_cache.HashCache used when hashing the outputs.
 
   Returns:
     Process exit code that should be used.
@@ -737,7 +747,8 @@ def run_tha_test(
   result = map_and_run(
       command, isolated_hash, storage, isolate_cache, outputs,
       install_named_caches, leak_temp_dir, root_dir, hard_timeout, grace_period,
-      bot_file, switch_to_account, install_packages_fn, use_symlinks, True)
+      bot_file, switch_to_account, install_packages_fn, use_symlinks, True,
+      hash_cache)
   logging.info('Result:\n%s', tools.format_json(result, dense=True))
 
   if result_json:
@@ -1001,6 +1012,7 @@ def create_option_parser():
       '-s', '--isolated',
       help='Hash of the .isolated to grab from the isolate server.')
   isolateserver.add_isolate_server_options(data_group)
+  isolateserver.add_upload_cache_options(data_group)
   parser.add_option_group(data_group)
 
   isolateserver.add_cache_options(parser)
@@ -1133,26 +1145,31 @@ def main(args):
 
   try:
     if options.isolate_server:
-      storage = isolateserver.get_storage(
-          options.isolate_server, options.namespace)
-      with storage:
-        # Hashing schemes used by |storage| and |isolate_cache| MUST match.
-        assert storage.hash_algo == isolate_cache.hash_algo
-        return run_tha_test(
-            args,
-            options.isolated,
-            storage,
-            isolate_cache,
-            options.output,
-            install_named_caches,
-            options.leak_temp_dir,
-            options.json, options.root_dir,
-            options.hard_timeout,
-            options.grace_period,
-            options.bot_file,
-            options.switch_to_account,
-            install_packages_fn,
-            options.use_symlinks)
+      presence_cache_ctx = isolateserver.open_presence_cache(
+          options.presence_cache)
+      hash_cache_ctx = isolateserver.open_hash_cache(options.hash_cache)
+      with presence_cache_ctx as presence_cache, hash_cache_ctx as hash_cache:
+        storage = isolateserver.get_storage(
+            options.isolate_server, options.namespace, presence_cache)
+        with storage:
+          # Hashing schemes used by |storage| and |isolate_cache| MUST match.
+          assert storage.hash_algo == isolate_cache.hash_algo
+          return run_tha_test(
+              args,
+              options.isolated,
+              storage,
+              isolate_cache,
+              options.output,
+              install_named_caches,
+              options.leak_temp_dir,
+              options.json, options.root_dir,
+              options.hard_timeout,
+              options.grace_period,
+              options.bot_file,
+              options.switch_to_account,
+              install_packages_fn,
+              options.use_symlinks,
+              hash_cache)
     return run_tha_test(
         args,
         options.isolated,
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from utils import file_lock
+from utils import file_path
+
+
+class FileLockTest(unittest.TestCase):
+  def setUp(self):
+    super(FileLockTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'file_lock')
+    self.path = os.path.join(self.tempdir, u'lock')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(FileLockTest, self).tearDown()
+
+  def test_exclusive(self):
+    lock1 = file_lock.FileLock(self.path)
+    lock2 = file_lock.FileLock(self.path)
+    self.assertTrue(lock1.acquire(blocking=False))
+    self.assertFalse(lock2.acquire(blocking=False))
+    lock1.release()
+    self.assertTrue(lock2.acquire(blocking=False))
+    lock2.release()
+    lock1.close()
+    lock2.close()
+
+  def test_close_releases(self):
+    lock1 = file_lock.FileLock(self.path)
+    lock2 = file_lock.FileLock(self.path)
+    lock1.acquire()
+    lock1.close()
+    self.assertTrue(lock2.acquire(blocking=False))
+    lock2.close()
+
+  def test_readable_while_locked(self):
+    with file_lock.FileLock(self.path) as lock:
+      lock.file.write('foo\n')
+      lock.file.flush()
+      with open(self.path, 'rb') as f:
+        self.assertEqual('foo\n', f.read())
+
+  def test_release_delete(self):
+    # A process waiting for a lock deleted by its owner takes a new one.
+    lock1 = file_lock.FileLock(self.path)
+    lock2 = file_lock.FileLock(self.path)
+    lock1.acquire()
+    t = threading.Thread(target=lock2.acquire)
+    t.start()
+    lock1.release(delete=True)
+    t.join()
+    self.assertTrue(os.path.isfile(self.path))
+    lock3 = file_lock.FileLock(self.path)
+    self.assertFalse(lock3.acquire(blocking=False))
+    lock3.close()
+    lock2.release(delete=True)
+    self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
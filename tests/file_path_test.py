@@ -4,6 +4,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import errno
 import getpass
 import logging
 import os
@@ -180,6 +181,67 @@ class FilePathTest(auto_stub.TestCase):
     # must be reset to be read-only after deleting one of the hard link
     # directory entry.
 
+  def test_link_file_reflink(self):
+    file_bar = os.path.join(self.tempdir, u'bar')
+    file_clone = os.path.join(self.tempdir, u'clone')
+    write_content(file_bar, 'bar')
+    fs.chmod(file_bar, 0600)
+    # Whether the clone was done depends on the filesystem of the test.
+    self.assertEqual(
+        file_path.can_reflink(self.tempdir),
+        file_path.link_file(
+            file_clone, file_bar, file_path.REFLINK_WITH_FALLBACK))
+    if sys.platform != 'win32':
+      self.assertFileMode(file_clone, 0100644, 0)
+    write_content(file_clone, 'modified')
+    with fs.open(file_bar, 'rb') as f:
+      self.assertEqual('bar', f.read())
+
+  if sys.platform.startswith('linux'):
+    def test_link_file_reflink_supported(self):
+      def ioctl(fd, request, src_fd):
+        self.assertEqual(file_path._FICLONE, request)
+        os.write(fd, os.read(src_fd, 100))
+      self.mock(file_path.fcntl, 'ioctl', ioctl)
+      self.mock(file_path, '_REFLINK_SUPPORT', {})
+      file_bar = os.path.join(self.tempdir, u'bar')
+      file_clone = os.path.join(self.tempdir, u'clone')
+      write_content(file_bar, 'bar')
+      fs.chmod(file_bar, 0500)
+      fs.utime(file_bar, (1000, 2000))
+      self.assertEqual(
+          True,
+          file_path.link_file(
+              file_clone, file_bar, file_path.REFLINK_WITH_FALLBACK))
+      self.assertFileMode(file_clone, 0100544, 0)
+      self.assertEqual(2000, fs.stat(file_clone).st_mtime)
+      with fs.open(file_clone, 'rb') as f:
+        self.assertEqual('bar', f.read())
+      self.assertEqual(True, file_path.can_reflink(self.tempdir))
+
+    def test_link_file_reflink_unsupported(self):
+      calls = []
+      def ioctl(*args):
+        calls.append(args)
+        raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
+      self.mock(file_path.fcntl, 'ioctl', ioctl)
+      self.mock(file_path, '_REFLINK_SUPPORT', {})
+      file_bar = os.path.join(self.tempdir, u'bar')
+      write_content(file_bar, 'bar')
+      for name in (u'a', u'b'):
+        self.assertEqual(
+            False,
+            file_path.link_file(
+                os.path.join(self.tempdir, name), file_bar,
+                file_path.REFLINK_WITH_FALLBACK))
+      # The filesystem was only probed once.
+      self.assertEqual(1, len(calls))
+      self.assertEqual(False, file_path.can_reflink(self.tempdir))
+      self.assertEqual(1, len(calls))
+      self.assertEqual([u'a', u'b', u'bar'], sorted(fs.listdir(self.tempdir)))
+      with fs.open(os.path.join(self.tempdir, u'b'), 'rb') as f:
+        self.assertEqual('bar', f.read())
+
   def test_rmtree_unicode(self):
     subdir = os.path.join(self.tempdir, 'hi')
     fs.mkdir(subdir)
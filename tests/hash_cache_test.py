@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from utils import file_path
+from utils import hash_cache
+
+
+ALGO = hashlib.sha1
+
+
+class HashCacheTest(unittest.TestCase):
+  def setUp(self):
+    super(HashCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'hash_cache')
+    self.path = os.path.join(self.tempdir, u'cache', u'hashes.json')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(HashCacheTest, self).tearDown()
+
+  def write(self, name, content, age=60):
+    """Writes a file last modified |age| seconds ago and returns its stats."""
+    p = os.path.join(self.tempdir, name)
+    with open(p, 'wb') as f:
+      f.write(content)
+    mtime = time.time() - age
+    os.utime(p, (mtime, mtime))
+    return p, os.stat(p)
+
+  def test_add_save_load(self):
+    p, stats = self.write('a', 'foo')
+    with hash_cache.HashCache(self.path) as cache:
+      self.assertEqual(None, cache.get(ALGO, stats))
+      cache.add(ALGO, p, stats, 'digest_a')
+      self.assertEqual('digest_a', cache.get(ALGO, stats))
+    self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    cache = hash_cache.HashCache(self.path)
+    self.assertEqual('digest_a', cache.get(ALGO, stats))
+    self.assertEqual(None, cache.get(hashlib.sha256, stats))
+
+  def test_modified(self):
+    p, stats = self.write('a', 'foo')
+    with hash_cache.HashCache(self.path) as cache:
+      cache.add(ALGO, p, stats, 'digest_a')
+    _, stats = self.write('a', 'food', age=30)
+    self.assertEqual(None, hash_cache.HashCache(self.path).get(ALGO, stats))
+
+  def test_changed_while_hashing(self):
+    p, stats = self.write('a', 'foo')
+    self.write('a', 'bar', age=30)
+    with hash_cache.HashCache(self.path) as cache:
+      cache.add(ALGO, p, stats, 'digest_a')
+    self.assertFalse(os.path.isfile(self.path))
+
+  def test_racy(self):
+    p, stats = self.write('a', 'foo', age=0)
+    with hash_cache.HashCache(self.path) as cache:
+      cache.add(ALGO, p, stats, 'digest_a')
+      self.assertEqual(None, cache.get(ALGO, stats))
+
+  def test_merge_concurrent(self):
+    p1, stats1 = self.write('a', 'foo')
+    p2, stats2 = self.write('b', 'bar')
+    cache1 = hash_cache.HashCache(self.path)
+    cache2 = hash_cache.HashCache(self.path)
+    cache1.add(ALGO, p1, stats1, 'digest_a')
+    cache2.add(ALGO, p2, stats2, 'digest_b')
+    cache1.save()
+    cache2.save()
+    # cache2 now sees what cache1 saved.
+    self.assertEqual('digest_a', cache2.get(ALGO, stats1))
+    cache = hash_cache.HashCache(self.path)
+    self.assertEqual('digest_a', cache.get(ALGO, stats1))
+    self.assertEqual('digest_b', cache.get(ALGO, stats2))
+
+  def test_evict_oldest(self):
+    files = [self.write(str(i), str(i)) for i in xrange(3)]
+    with hash_cache.HashCache(self.path, max_items=2) as cache:
+      for p, stats in files:
+        cache.add(ALGO, p, stats, 'digest_' + os.path.basename(p))
+    cache = hash_cache.HashCache(self.path)
+    self.assertEqual(
+        [None, 'digest_1', 'digest_2'],
+        [cache.get(ALGO, stats) for _, stats in files])
+
+  def test_corrupted(self):
+    os.mkdir(os.path.dirname(self.path))
+    with open(self.path, 'wb') as f:
+      f.write('not json')
+    p, stats = self.write('a', 'foo')
+    with hash_cache.HashCache(self.path) as cache:
+      self.assertEqual(None, cache.get(ALGO, stats))
+      cache.add(ALGO, p, stats, 'digest_a')
+    self.assertEqual(
+        'digest_a', hash_cache.HashCache(self.path).get(ALGO, stats))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Tests IsolateServerGrpc against a fake gRPC proxy."""
+
+import hashlib
+import logging
+import os
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+import isolate_storage
+import isolateserver
+
+
+class IsolateServerGrpcTest(unittest.TestCase):
+  def setUp(self):
+    super(IsolateServerGrpcTest, self).setUp()
+    self.server = isolateserver_grpc_mock.MockIsolateServerGrpc()
+    self.storage_api = isolate_storage.IsolateServerGrpc(
+        'https://luci.appspot.com', 'default-gzip', self.server.proxy)
+
+  def tearDown(self):
+    try:
+      self.server.close()
+    finally:
+      super(IsolateServerGrpcTest, self).tearDown()
+
+  def items(self, count):
+    items = [isolateserver.BufferItem('item %d' % i) for i in xrange(count)]
+    for item in items:
+      item.prepare(hashlib.sha1)
+    return items
+
+  def test_contains(self):
+    items = self.items(3)
+    self.server.contents[items[1].digest] = items[1].buffer
+    missing = self.storage_api.contains(items)
+    self.assertEqual(set([items[0], items[2]]), set(missing))
+    self.assertEqual(
+        [[i.digest for i in items]], self.server.find_missing_requests)
+
+  def test_contains_not_supported(self):
+    self.server.find_missing_supported = False
+    items = self.items(2)
+    self.server.contents[items[1].digest] = items[1].buffer
+    self.assertEqual(set(items), set(self.storage_api.contains(items)))
+    # It is not tried again.
+    self.assertEqual(set(items), set(self.storage_api.contains(items)))
+    self.assertEqual([], self.server.find_missing_requests)
+
+  def test_upload_only_delta(self):
+    storage = isolateserver.Storage(self.storage_api)
+    items = self.items(5)
+    with storage:
+      self.assertEqual(set(items[:3]), set(storage.upload_items(items[:3])))
+      self.assertEqual(set(items[3:]), set(storage.upload_items(items)))
+    self.assertEqual(
+        sorted(i.digest for i in items), sorted(self.server.pushes))
+    self.assertEqual(
+        items[4].buffer, ''.join(self.storage_api.fetch(items[4].digest)))
+
+
+if __name__ == '__main__':
+  if not isolate_storage.grpc:
+    # Don't print to stderr or return error code as this will
+    # show up as a warning and fail in presubmit.
+    print('gRPC could not be loaded; skipping tests')
+    sys.exit(0)
+  sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+  import isolateserver_grpc_mock
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
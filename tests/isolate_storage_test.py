@@ -43,6 +43,10 @@ class ByteStreamStubMock(object):
     resp.committed_size = nb
     return resp
 
+  def QueryWriteStatus(self, request, timeout=None):
+    del request, timeout
+    raise NotImplementedError()
+
   def popContainsRequests(self):
     cr = self._contains_requests
     self._contains_requests = []
@@ -57,6 +61,12 @@ def raiseError(code):
   raise isolate_storage.grpc.RpcError(
       'cannot turn this into a real code yet: %s' % code)
 
+def rpcErrorWithCode(code):
+  """Returns a grpc.RpcError with a status code, like the ones gRPC raises."""
+  error = isolate_storage.grpc.RpcError(code)
+  error.code = lambda: code
+  return error
+
 class IsolateStorageTest(auto_stub.TestCase):
   def get_server(self):
     return isolate_storage.IsolateServerGrpc('https://luci.appspot.com',
@@ -142,6 +152,37 @@ class IsolateStorageTest(auto_stub.TestCase):
       for _response in s.fetch('abc123'):
         pass
 
+  def testFetchResume(self):
+    """Fetch: a broken stream is resumed after the last byte received"""
+    requests = []
+    def Read(_self, request, timeout=None):
+      del timeout
+      requests.append((request.read_offset, request.read_limit))
+      response = isolate_storage.bytestream_pb2.ReadResponse()
+      if len(requests) == 1:
+        response.data = 'ab'
+        yield response
+        raise rpcErrorWithCode(isolate_storage.grpc.StatusCode.UNAVAILABLE)
+      response.data = 'cd'
+      yield response
+    self.mock(ByteStreamStubMock, 'Read', Read)
+
+    s = self.get_server()
+    self.assertEqual('abcd', ''.join(s.fetch('abc123', 1, 4)))
+    self.assertEqual([(1, 4), (3, 2)], requests)
+
+  def testFetchResumeGivesUp(self):
+    """Fetch: a stream failing over and over is not resumed forever"""
+    def Read(_self, _request, timeout=None):
+      del timeout
+      raise rpcErrorWithCode(isolate_storage.grpc.StatusCode.UNAVAILABLE)
+    self.mock(ByteStreamStubMock, 'Read', Read)
+    self.mock(isolate_storage, 'GRPC_READ_ATTEMPTS', 2)
+
+    s = self.get_server()
+    with self.assertRaises(IOError):
+      list(s.fetch('abc123'))
+
   def testPushHappySingleSmall(self):
     """Push: send one chunk of small data"""
     s = self.get_server()
@@ -229,6 +270,59 @@ class IsolateStorageTest(auto_stub.TestCase):
     self.assertEqual('', requests[0].data)
     self.assertTrue(requests[0].finish_write)
 
+  def testPushResume(self):
+    """Push: a retried push resumes after the committed bytes"""
+    self.mock(isolate_storage, 'NET_IO_FILE_CHUNK', 2)
+    def Write(self, requests, timeout=None):
+      del timeout
+      for r in requests:
+        self._push_requests.append(r.__deepcopy__())
+        if len(self._push_requests) == 1:
+          raise rpcErrorWithCode(isolate_storage.grpc.StatusCode.UNAVAILABLE)
+      resp = isolate_storage.bytestream_pb2.WriteResponse()
+      resp.committed_size = 4
+      return resp
+    status_requests = []
+    def QueryWriteStatus(_self, request, timeout=None):
+      del timeout
+      status_requests.append(request.resource_name)
+      resp = isolate_storage.bytestream_pb2.QueryWriteStatusResponse()
+      resp.committed_size = 2
+      return resp
+    self.mock(ByteStreamStubMock, 'Write', Write)
+    self.mock(ByteStreamStubMock, 'QueryWriteStatus', QueryWriteStatus)
+
+    s = self.get_server()
+    i = isolate_storage.Item(digest='abc123', size=4)
+    push_state = isolate_storage._IsolateServerGrpcPushState()
+    with self.assertRaises(IOError):
+      s.push(i, push_state, '1234')
+    s.push(i, push_state, '1234')
+    requests = s._proxy.stub.popPushRequests()
+    self.assertEqual(
+        [('12', 0, False), ('34', 2, True)],
+        [(r.data, r.write_offset, r.finish_write) for r in requests])
+    self.assertEqual(
+        [push_state.resource_name] * 2, [r.resource_name for r in requests])
+    self.assertEqual([push_state.resource_name], status_requests)
+
+  def testPushResumeComplete(self):
+    """Push: nothing is sent again if the previous push completed"""
+    def QueryWriteStatus(_self, _request, timeout=None):
+      del timeout
+      resp = isolate_storage.bytestream_pb2.QueryWriteStatusResponse()
+      resp.committed_size = 4
+      resp.complete = True
+      return resp
+    self.mock(ByteStreamStubMock, 'QueryWriteStatus', QueryWriteStatus)
+
+    s = self.get_server()
+    i = isolate_storage.Item(digest='abc123', size=4)
+    push_state = isolate_storage._IsolateServerGrpcPushState()
+    push_state.resource_name = 'client/bob/uploads/u/blobs/abc123/4'
+    s.push(i, push_state, '1234')
+    self.assertEqual([], s._proxy.stub.popPushRequests())
+
   def testPushThrowsOnFailure(self):
     """Push: if something goes wrong in Isolate, we throw an exception"""
     def Write(self, request, timeout=None):
@@ -291,6 +291,7 @@ class IsolateLoad(IsolateBase):
       extra_variables = {'foo': 'bar'}
       ignore_broken_items = False
       collapse_symlinks = False
+      hash_cache = None
     return Options()
 
   def _cleanup_isolated(self, expected_isolated):
@@ -1244,7 +1245,7 @@ class IsolateCommand(IsolateBase):
   def test_CMDarchive(self):
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(base_url, infiles, namespace, presence_cache=None):
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -1304,11 +1305,81 @@ class IsolateCommand(IsolateBase):
     actual[0]['infiles'][join('foo')].pop('t')
     self.assertEqual(expected, actual)
 
+  def test_CMDarchive_presence_cache(self):
+    # The files of a tree that was just uploaded are not looked up again.
+    actual = []
+    def mocked_upload_tree(base_url, infiles, namespace, presence_cache=None):
+      self.assertEqual('http://localhost:1', base_url)
+      self.assertEqual('default-gzip', namespace)
+      self.assertTrue(presence_cache)
+      actual.append(sorted(os.path.basename(f) for f, _ in infiles))
+    self.mock(isolateserver, 'upload_tree', mocked_upload_tree)
+    added = []
+    add_tree = isolateserver.PresenceCache.add_tree
+    def mocked_add_tree(presence_cache, location, namespace, isolated_hash):
+      added.append(isolated_hash)
+      add_tree(presence_cache, location, namespace, isolated_hash)
+    self.mock(isolateserver.PresenceCache, 'add_tree', mocked_add_tree)
+
+    isolate_file = os.path.join(self.cwd, 'x.isolate')
+    with open(isolate_file, 'wb') as f:
+      f.write('{\'variables\': {\'files\': [\'foo\']}}')
+    with open(os.path.join(self.cwd, 'foo'), 'wb') as f:
+      f.write('fooo')
+
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    cmd = [
+        '-i', isolate_file,
+        '-s', os.path.join(self.cwd, 'x.isolated'),
+        '--isolate-server', 'http://localhost:1',
+        '--presence-cache', os.path.join(self.cwd, 'presence.json'),
+    ]
+    self.assertEqual(0, isolate.CMDarchive(optparse.OptionParser(), cmd))
+    self.assertEqual(0, isolate.CMDarchive(optparse.OptionParser(), cmd))
+    self.assertEqual([['foo', 'x.isolated'], []], actual)
+    # The skipped tree wasn't checked, so it isn't refreshed in the cache.
+    self.assertEqual(1, len(added))
+
+  def test_CMDarchive_bundle_small_files(self):
+    actual = []
+    def mocked_upload_tree(base_url, infiles, namespace, presence_cache=None):
+      self.assertEqual('http://localhost:1', base_url)
+      self.assertEqual('default-gzip', namespace)
+      self.assertEqual(None, presence_cache)
+      for path, meta in infiles:
+        # The bundles still exist while they are uploaded.
+        self.assertTrue(os.path.isfile(path))
+        actual.append((os.path.basename(path), meta.get('t')))
+    self.mock(isolateserver, 'upload_tree', mocked_upload_tree)
+
+    isolate_file = os.path.join(self.cwd, 'x.isolate')
+    with open(isolate_file, 'wb') as f:
+      f.write('{\'variables\': {\'files\': [\'foo\', \'bar\']}}')
+    for name in ('foo', 'bar'):
+      with open(os.path.join(self.cwd, name), 'wb') as f:
+        f.write(name)
+
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    cmd = [
+        '-i', isolate_file,
+        '-s', os.path.join(self.cwd, 'x.isolated'),
+        '--isolate-server', 'http://localhost:1',
+        '--bundle-small-files',
+    ]
+    self.assertEqual(0, isolate.CMDarchive(optparse.OptionParser(), cmd))
+    bundles = [name for name, t in actual if t == 'ar']
+    self.assertEqual(1, len(bundles))
+    self.assertEqual(
+        sorted(bundles + ['x.isolated']), sorted(name for name, _ in actual))
+    isolated = tools.read_json(os.path.join(self.cwd, 'x.isolated'))
+    self.assertEqual([u'.isolate_bundle_0.ar'], isolated['files'].keys())
+    self.assertEqual('ar', isolated['files'][u'.isolate_bundle_0.ar']['t'])
+
   def test_CMDbatcharchive(self):
     # Same as test_CMDarchive but via code path that parses *.gen.json files.
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(base_url, infiles, namespace, presence_cache=None):
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -18,6 +18,7 @@ import isolated_format
 from depot_tools import auto_stub
 from depot_tools import fix_encoding
 from utils import file_path
+from utils import hash_cache
 from utils import tools
 
 import isolateserver_mock
@@ -170,6 +171,85 @@ class SymlinkTest(unittest.TestCase):
       self.assertEqual(expected, actual)
 
 
+class FileToMetadataTest(auto_stub.TestCase):
+  def setUp(self):
+    super(FileToMetadataTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolate_')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(FileToMetadataTest, self).tearDown()
+
+  def make_files(self, count):
+    paths = []
+    for i in xrange(count):
+      path = os.path.join(self.tempdir, unicode(i))
+      with open(path, 'wb') as f:
+        f.write(str(i) * i)
+      paths.append(path)
+    return paths
+
+  def test_iter_file_to_metadata_ordered(self):
+    paths = self.make_files(50)
+    # Files are queued as they are hashed, not all at once.
+    queued = []
+    def files():
+      for path in paths:
+        queued.append(path)
+        yield path, {}
+    results = isolated_format.iter_file_to_metadata(
+        files(), 0, ALGO, False, threads=4)
+    first = next(results)
+    self.assertTrue(len(queued) < len(paths))
+    results = [first] + list(results)
+    self.assertEqual(paths, [r[0] for r in results])
+    self.assertEqual(
+        [ALGO(str(i) * i).hexdigest() for i in xrange(50)],
+        [r[1]['h'] for r in results])
+
+  def test_iter_file_to_metadata_unordered(self):
+    paths = self.make_files(20)
+    results = dict(isolated_format.iter_file_to_metadata(
+        ((p, {}) for p in paths), 0, ALGO, False, ordered=False))
+    self.assertEqual(
+        {p: ALGO(str(i) * i).hexdigest() for i, p in enumerate(paths)},
+        {p: m['h'] for p, m in results.iteritems()})
+
+  def test_iter_file_to_metadata_prevdict(self):
+    # The hash is reused when the file didn't change.
+    path = self.make_files(2)[1]
+    prev = isolated_format.file_to_metadata(path, {}, 0, ALGO, False)
+    prev['h'] = 'reused'
+    results = list(isolated_format.iter_file_to_metadata(
+        [(path, prev)], 0, ALGO, False))
+    self.assertEqual('reused', results[0][1]['h'])
+
+  def test_iter_file_to_metadata_hash_cache(self):
+    paths = self.make_files(3)
+    for path in paths:
+      os.utime(path, (1000000000, 1000000000))
+    cache = hash_cache.HashCache(os.path.join(self.tempdir, u'hashes.json'))
+    results = list(isolated_format.iter_file_to_metadata(
+        [(p, {}) for p in paths], 0, ALGO, False, hash_cache=cache))
+    self.assertEqual((0, 3), (cache.hits, cache.misses))
+    # The digests now come from the cache.
+    cache.add(ALGO, paths[2], os.stat(paths[2]), 'cached')
+    results = list(isolated_format.iter_file_to_metadata(
+        [(p, {}) for p in paths], 0, ALGO, False, hash_cache=cache))
+    self.assertEqual((3, 3), (cache.hits, cache.misses))
+    self.assertEqual(
+        [ALGO('').hexdigest(), ALGO('1').hexdigest(), 'cached'],
+        [m['h'] for _, m in results])
+
+  def test_iter_file_to_metadata_error(self):
+    missing = os.path.join(self.tempdir, u'missing')
+    with self.assertRaises(isolated_format.MappingError):
+      list(isolated_format.iter_file_to_metadata(
+          [(missing, {})], 0, ALGO, False))
+
+
 class TestIsolated(auto_stub.TestCase):
   def test_load_isolated_empty(self):
     m = isolated_format.load_isolated('{}', isolateserver_mock.ALGO)
@@ -0,0 +1,96 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""A fake gRPC proxy implementing the Byte Stream API and FindMissingBlobs.
+
+Requires grpc, see isolate_storage.grpc.
+"""
+
+import logging
+import re
+import threading
+
+from concurrent import futures
+import grpc
+
+from proto import bytestream_pb2
+from proto import cas_pb2
+from proto import cas_pb2_grpc
+
+
+class ByteStreamServicer(bytestream_pb2.ByteStreamServicer):
+  def __init__(self, server):
+    self._server = server
+
+  def Read(self, request, context):
+    match = re.match(r'^(.*)/blobs/([0-9a-f]+)/\d+$', request.resource_name)
+    data = self._server.contents.get(match.group(2)) if match else None
+    if data is None:
+      context.set_code(grpc.StatusCode.NOT_FOUND)
+      return
+    end = len(data)
+    if request.read_limit:
+      end = min(end, request.read_offset + request.read_limit)
+    yield bytestream_pb2.ReadResponse(data=data[request.read_offset:end])
+
+  def Write(self, request_iterator, context):
+    data = []
+    digest = None
+    for request in request_iterator:
+      if digest is None:
+        match = re.match(
+            r'^(.*)/uploads/[^/]+/blobs/([0-9a-f]+)/\d+$',
+            request.resource_name)
+        digest = match.group(2)
+      data.append(request.data)
+    data = ''.join(data)
+    with self._server.lock:
+      self._server.pushes.append(digest)
+      self._server.contents[digest] = data
+    return bytestream_pb2.WriteResponse(committed_size=len(data))
+
+
+class ContentAddressableStorageServicer(
+    cas_pb2_grpc.ContentAddressableStorageServicer):
+  def __init__(self, server):
+    self._server = server
+
+  def FindMissingBlobs(self, request, context):
+    if not self._server.find_missing_supported:
+      context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+      return cas_pb2.FindMissingBlobsResponse()
+    with self._server.lock:
+      self._server.find_missing_requests.append(
+          [d.hash for d in request.blob_digests])
+    response = cas_pb2.FindMissingBlobsResponse()
+    for digest in request.blob_digests:
+      if digest.hash not in self._server.contents:
+        response.missing_blob_digests.add().CopyFrom(digest)
+    return response
+
+
+class MockIsolateServerGrpc(object):
+  """Fake gRPC proxy listening on localhost, storing the blobs in memory."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # Digest -> content.
+    self.contents = {}
+    # Digests pushed, in order.
+    self.pushes = []
+    # List of digests of each FindMissingBlobs request.
+    self.find_missing_requests = []
+    self.find_missing_supported = True
+    self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    bytestream_pb2.add_ByteStreamServicer_to_server(
+        ByteStreamServicer(self), self._server)
+    cas_pb2_grpc.add_ContentAddressableStorageServicer_to_server(
+        ContentAddressableStorageServicer(self), self._server)
+    port = self._server.add_insecure_port('localhost:0')
+    self._server.start()
+    self.proxy = 'http://localhost:%d/fake/prefix' % port
+    logging.info('Started fake gRPC proxy at %s', self.proxy)
+
+  def close(self):
+    self._server.stop(None)
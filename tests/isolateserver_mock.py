@@ -65,7 +65,9 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
     namespace = embedded['n']
     if namespace not in self.server.contents:
       self.server.contents[namespace] = {}
-    self.server.contents[namespace][embedded['d']] = content
+    if not gs:
+      self.server.contents[namespace][embedded['d']] = content
+    # Otherwise the content was already PUT to the fake GCS.
     self._json({'ok': True})
 
   ### Mocked HTTP Methods
@@ -81,9 +83,29 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
           'primary_url': self.server.url})
     elif self.path == '/auth/api/v1/accounts/self':
       self._json({'identity': 'user:joe', 'xsrf_token': 'foo'})
+    elif self.path.startswith('/FAKE_GCS/'):
+      namespace, h = self.path[len('/FAKE_GCS/'):].split('/', 1)
+      self._gs_content(self.server.contents[namespace][h])
     else:
       raise NotImplementedError(self.path)
 
+  def _gs_content(self, data):
+    """Sends a GCS object, supports 'Range: bytes=<first>-[<last>]' requests."""
+    match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+    if not match:
+      self._octet_stream(data)
+      return
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else len(data) - 1
+    last = min(last, len(data) - 1)
+    self.send_response(206)
+    self.send_header('Content-type', 'application/octet-stream')
+    self.send_header('Content-Length', str(last - first + 1))
+    self.send_header(
+        'Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+    self.end_headers()
+    self.wfile.write(data[first:last+1])
+
   def do_POST(self):
     logging.info('POST %s', self.path)
     body = self._read_body()
@@ -100,7 +122,8 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
               'upload_ticket': self._generate_ticket(entry),
           }
           if self._should_push_to_gs(entry['i'], entry['s']):
-            status['gs_upload_url'] = self._generate_signed_url(entry['d'])
+            status['gs_upload_url'] = self._generate_signed_url(
+                entry['d'], entry['n'])
           li.append(status)
         # Don't use finalize url for the mock.
 
@@ -115,20 +138,51 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
         }, index, response['items'])
       logging.info('Returning %s' % response)
       self._json(response)
+    elif self.path.startswith('/api/isolateservice/v1/store_inline_batch'):
+      request = json.loads(body)
+      if len(request['items']) > self.server.batch['max_items']:
+        raise ValueError('Too many items in batch')
+      for entry in request['items']:
+        embedded = FakeSigner.validate(entry['upload_ticket'], 'datastore')
+        self.server.contents.setdefault(
+            embedded['n'], {})[embedded['d']] = entry['content']
+      self._json({'ok': True})
     elif self.path.startswith('/api/isolateservice/v1/store_inline'):
       self._storage_helper(body)
     elif self.path.startswith('/api/isolateservice/v1/finalize_gs_upload'):
       self._storage_helper(body, True)
+    elif self.path.startswith('/api/isolateservice/v1/retrieve_batch'):
+      request = json.loads(body)
+      if len(request['digests']) > self.server.batch['max_items']:
+        raise ValueError('Too many items in batch')
+      namespace = request['namespace']['namespace']
+      items = []
+      for digest in request['digests']:
+        data = self.server.contents.get(namespace, {}).get(digest)
+        if data is None or (namespace, digest) in self.server.gs_entries:
+          # Missing and GCS entries have to be fetched one by one.
+          items.append({'digest': digest})
+        else:
+          items.append({'digest': digest, 'content': data})
+      self._json({'items': items})
     elif self.path.startswith('/api/isolateservice/v1/retrieve'):
       request = json.loads(body)
       namespace = request['namespace']['namespace']
-      data = self.server.contents[namespace].get(request['digest'])
+      digest = request['digest']
+      if (namespace, digest) in self.server.gs_entries:
+        self._json({'url': self._generate_signed_url(digest, namespace)})
+        return
+      data = self.server.contents[namespace].get(digest)
       if data is None:
-        logging.error(
-            'Failed to retrieve %s / %s', namespace, request['digest'])
+        logging.error('Failed to retrieve %s / %s', namespace, digest)
+      elif request.get('offset'):
+        data = base64.b64encode(base64.b64decode(data)[request['offset']:])
       self._json({'content': data})
     elif self.path.startswith('/api/isolateservice/v1/server_details'):
-      self._json({'server_version': 'such a good version'})
+      details = {'server_version': 'such a good version'}
+      if self.server.batch:
+        details['batch'] = self.server.batch
+      self._json(details)
     else:
       raise NotImplementedError(self.path)
 
@@ -141,6 +195,7 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
     if self.path.startswith('/FAKE_GCS/'):
       namespace, h = self.path[len('/FAKE_GCS/'):].split('/', 1)
       self.server.contents.setdefault(namespace, {})[h] = body
+      self.server.gs_entries.add((namespace, h))
       self._octet_stream('')
     else:
       raise NotImplementedError(self.path)
@@ -152,12 +207,21 @@ class MockIsolateServer(httpserver_mock.MockServer):
   def __init__(self):
     super(MockIsolateServer, self).__init__()
     self._server.contents = {}
+    # Set of (namespace, digest) stored as raw GCS objects in contents.
+    self._server.gs_entries = set()
     self._server.discard_content = False
+    # Limits of the batch API in the /server_details response, None to not
+    # support it.
+    self._server.batch = {'max_items': 100, 'max_size': 1024 * 1024}
 
   def discard_content(self):
     """Stops saving content in memory. Used to test large files."""
     self._server.discard_content = True
 
+  def disable_batch_api(self):
+    """Stops advertising the batch API, so clients use it one item at a time."""
+    self._server.batch = None
+
   @property
   def contents(self):
     return self._server.contents
@@ -15,9 +15,14 @@ import StringIO
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import unittest
 import zlib
 
+if sys.platform != 'win32':
+  import resource
+
 # net_utils adjusts sys.path.
 import net_utils
 
@@ -27,9 +32,12 @@ import isolateserver
 import isolate_storage
 import test_utils
 from depot_tools import fix_encoding
+from libs import arfile
 from utils import file_path
 from utils import fs
 from utils import logging_utils
+from utils import lru
+from utils import net
 from utils import threading_utils
 
 import isolateserver_mock
@@ -108,6 +116,134 @@ class TestZipCompression(TestCase):
     with self.assertRaises(IOError):
       ''.join(isolateserver.zip_decompress(['Im not a zip file']))
 
+  def test_parallel_compress(self):
+    pool = threading_utils.ThreadPool(1, 4, 0)
+    self.addCleanup(pool.close)
+    data = ''.join(str(x) for x in xrange(10000))
+    def compress(chunk_size, level=6):
+      chunks = [data[i:i+chunk_size] for i in xrange(0, len(data), chunk_size)]
+      return ''.join(isolateserver.parallel_zip_compress(
+          chunks, level, pool, block_size=1000, window=3))
+    compressed = compress(777)
+    # Sync flushed blocks end on byte boundaries, it's a regular zlib stream.
+    self.assertEqual(data, zlib.decompress(compressed))
+    self.assertEqual(
+        data, ''.join(isolateserver.zip_decompress([compressed])))
+    # The output doesn't depend on the chunking, it can be regenerated.
+    self.assertEqual(compressed, compress(1000))
+    self.assertEqual(compressed, compress(len(data)))
+    self.assertEqual(data, zlib.decompress(compress(50, level=9)))
+    self.assertEqual(
+        '', zlib.decompress(''.join(
+            isolateserver.parallel_zip_compress([], 6, pool))))
+
+
+class CompressionPolicyTest(TestCase):
+  @staticmethod
+  def item(data):
+    item = isolateserver.BufferItem(data)
+    item.prepare(hashlib.sha1)
+    return item
+
+  def test_choose(self):
+    policy = isolateserver.CompressionPolicy()
+    size = 64 * 1024
+    dense = self.item(os.urandom(size))
+    text = self.item('The quick brown fox jumps over the lazy dog\n' * 2000)
+    # About 5 bits of entropy per byte.
+    binary = self.item(''.join(chr(ord(c) % 32) for c in os.urandom(size)))
+    self.assertEqual(('store', 0), policy.choose(dense))
+    self.assertEqual(('high', 9), policy.choose(text))
+    self.assertEqual(('fast', 1), policy.choose(binary))
+    # Small items and items known to be already compressed are not sampled.
+    small = self.item('a' * 1024)
+    self.assertEqual(('default', 6), policy.choose(small))
+    text.compression_level = 0
+    self.assertEqual(('store', 0), policy.choose(text))
+
+  def test_cpu_budget(self):
+    policy = isolateserver.CompressionPolicy(cpu_budget=0.)
+    text = self.item('The quick brown fox jumps over the lazy dog\n' * 2000)
+    self.assertEqual(('fast', 1), policy.choose(text))
+
+  def test_compress_stats(self):
+    policy = isolateserver.CompressionPolicy()
+    data = 'a' * 100000
+    compressed = ''.join(policy.compress('high', 9, [data[:50000], data[50000:]]))
+    self.assertEqual(data, ''.join(isolateserver.zip_decompress([compressed])))
+    self.assertEqual({'high': [1, 100000, len(compressed)]}, policy.stats)
+
+  def test_upload_parallel(self):
+    self.mock(isolateserver, 'PARALLEL_COMPRESSION_MIN_SIZE', 100 * 1024)
+    self.mock(isolateserver, 'PARALLEL_COMPRESSION_BLOCK_SIZE', 16 * 1024)
+    self.mock(threading_utils, 'num_processors', lambda: 4)
+    data = 'The quick brown fox jumps over the lazy dog\n' * 5000
+    items = [self.item(data[:50000]), self.item(data)]
+    storage_api = MockedStorageApi(
+        {i.digest: 'push_state' for i in items}, namespace='default-gzip')
+    with isolateserver.Storage(storage_api) as storage:
+      self.assertEqual(set(items), set(storage.upload_items(items)))
+    pushed = {i.size: content for i, _, content in storage_api.push_calls}
+    self.assertEqual(zlib.compress(data[:50000], 9), pushed[50000])
+    self.assertNotEqual(zlib.compress(data, 9), pushed[len(data)])
+    self.assertEqual(data, zlib.decompress(pushed[len(data)]))
+    self.assertEqual(
+        [2, 50000 + len(data)],
+        storage.compression_policy.stats['high'][:2])
+
+  def test_upload_stats(self):
+    items = [
+      self.item(os.urandom(64 * 1024)),
+      self.item('The quick brown fox jumps over the lazy dog\n' * 2000),
+    ]
+    storage_api = MockedStorageApi(
+        {i.digest: 'push_state' for i in items}, namespace='default-gzip')
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual(set(items), set(storage.upload_items(items)))
+    stats = storage.compression_policy.stats
+    self.assertEqual(['high', 'store'], sorted(stats))
+    self.assertEqual([1, 64 * 1024], stats['store'][:2])
+    self.assertLess(stats['high'][2], stats['high'][1] / 10)
+
+
+class RestartableContentTest(TestCase):
+  """Test RestartableContent with the Item subclasses."""
+
+  def test_buffer_item(self):
+    content = isolate_storage.RestartableContent(
+        isolateserver.BufferItem('0123456789'))
+    self.assertEqual('0123456789', ''.join(content))
+    self.assertEqual('3456789', ''.join(content.iter_from(3)))
+    self.assertEqual('', ''.join(content.iter_from(10)))
+
+  def test_file_item(self):
+    path = os.path.join(self.tempdir, u'foo')
+    with fs.open(path, 'wb') as f:
+      f.write('0123456789')
+    item = isolateserver.FileItem(path)
+    # Reopens the file at the offset instead of reading it from the start.
+    self.mock(item, 'content', lambda: self.fail('Unexpected read'))
+    content = isolate_storage.RestartableContent(item)
+    self.assertEqual('56789', ''.join(content.iter_from(5)))
+
+  def test_generic_item(self):
+    item = isolateserver.Item()
+    self.mock(item, 'content', lambda: ['012', '345', '6789'])
+    content = isolate_storage.RestartableContent(item)
+    self.assertEqual(['2', '345', '6789'], list(content.iter_from(2)))
+    self.assertEqual(['45', '6789'], list(content.iter_from(4)))
+    self.assertEqual(['6789'], list(content.iter_from(6)))
+
+  def test_compressed(self):
+    data = ''.join(str(x) for x in xrange(1000))
+    content = isolate_storage.RestartableContent(
+        isolateserver.BufferItem(data), isolateserver.zip_compress)
+    zipped = ''.join(content)
+    self.assertEqual(data, zlib.decompress(zipped))
+    # The stream is regenerated, so it can be read many times.
+    self.assertEqual(zipped[10:], ''.join(content.iter_from(10)))
+    self.assertEqual(zipped, ''.join(content))
+
 
 class FakeItem(isolateserver.Item):
   def __init__(self, data, high_priority=False):
@@ -132,6 +268,10 @@ class MockedStorageApi(isolate_storage.StorageApi):
     self.contains_calls = []
     self._namespace = namespace
 
+  @property
+  def location(self):
+    return 'https://fake'
+
   @property
   def namespace(self):
     return self._namespace
@@ -306,6 +446,78 @@ class StorageTest(TestCase):
     batches = list(isolateserver.batch_items_for_check(items))
     self.assertEqual(batches, expected)
 
+  def test_batch_items_for_check_generator(self):
+    # Items from a generator are batched in the order they come.
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (2, 3))
+    items = [isolateserver.Item(str(i), i) for i in xrange(6)]
+    batches = list(isolateserver.batch_items_for_check(i for i in items))
+    self.assertEqual([items[0:2], items[2:5], items[5:6]], batches)
+
+  def test_batch_items_for_check_controller(self):
+    # The controller caps the ramp and sizes the batches past it.
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (2, 3))
+    controller = isolateserver.ContainsController()
+    self.assertEqual(3, controller.batch_size)
+    controller.record(3, isolateserver.CONTAINS_TARGET_LATENCY + 1, True)
+    self.assertEqual(2, controller.batch_size)
+    items = [isolateserver.Item(str(i), i) for i in xrange(6)]
+    batches = list(
+        isolateserver.batch_items_for_check((i for i in items), controller))
+    self.assertEqual([items[0:2], items[2:4], items[4:6]], batches)
+
+  def test_contains_controller(self):
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (20, 100))
+    self.mock(isolateserver, 'CONTAINS_INITIAL_CONCURRENCY', 2)
+    controller = isolateserver.ContainsController()
+    self.assertEqual((100, 2), (controller.batch_size, controller.concurrency))
+    # Fast queries that are smaller than the limit don't change it.
+    controller.record(10, 0.1, True)
+    self.assertEqual((100, 2), (controller.batch_size, controller.concurrency))
+    # Fast full queries grow it additively.
+    controller.record(100, 0.1, True)
+    self.assertEqual((120, 2), (controller.batch_size, controller.concurrency))
+    controller.record(120, 0.1, True)
+    self.assertEqual((140, 2), (controller.batch_size, controller.concurrency))
+    controller.record(140, 0.1, True)
+    self.assertEqual((160, 3), (controller.batch_size, controller.concurrency))
+    # Slow queries halve the batch size.
+    controller.record(160, isolateserver.CONTAINS_TARGET_LATENCY + 1, True)
+    self.assertEqual((80, 3), (controller.batch_size, controller.concurrency))
+    # Failures halve both, down to a minimum.
+    for _ in xrange(4):
+      controller.record(80, 0.1, False)
+    self.assertEqual((20, 1), (controller.batch_size, controller.concurrency))
+    with self.assertRaises(IOError):
+      with controller.measure(20):
+        raise IOError()
+    self.assertEqual(10, len(controller.stats))
+    self.assertEqual(
+        (20, False), (controller.stats[-1][0], controller.stats[-1][2]))
+
+  def test_upload_items_contains_concurrency(self):
+    # Not more than |concurrency| queries are in flight at once.
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (1,))
+    self.mock(isolateserver, 'CONTAINS_INITIAL_CONCURRENCY', 1)
+    self.mock(isolateserver, 'CONTAINS_MAX_CONCURRENCY', 1)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    class SlowStorageApi(MockedStorageApi):
+      def contains(self, items):
+        with lock:
+          in_flight[0] += 1
+          in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        with lock:
+          in_flight[0] -= 1
+        return super(SlowStorageApi, self).contains(items)
+    storage_api = SlowStorageApi({})
+    storage = isolateserver.Storage(storage_api)
+    items = [FakeItem('item %d' % i) for i in xrange(5)]
+    self.assertEqual([], storage.upload_items(items))
+    self.assertEqual(1, in_flight[1])
+    self.assertEqual(
+        5, sum(size for size, _, _ in storage.contains_controller.stats))
+
   def test_get_missing_items(self):
     items = [
       isolateserver.Item('foo', 12),
@@ -327,6 +539,68 @@ class StorageTest(TestCase):
     result = dict(storage.get_missing_items(items))
     self.assertEqual(missing, result)
 
+  def test_upload_items_generator(self):
+    # The first batch is checked and uploaded before the generator is done.
+    self.mock(isolateserver, 'ITEMS_PER_CONTAINS_QUERIES', (2, 100))
+    items = [FakeItem('item %d' % i) for i in xrange(5)]
+    storage_api = MockedStorageApi(
+        {item.digest: 'push_state' for item in items})
+    storage = isolateserver.Storage(storage_api)
+
+    def gen():
+      for i, item in enumerate(items):
+        if i == 3:
+          # Wait for the first pushes to start.
+          for _ in xrange(500):
+            if storage_api.push_calls:
+              break
+            time.sleep(0.01)
+          self.assertTrue(storage_api.push_calls)
+        yield item
+      # Duplicated content is skipped.
+      yield FakeItem('item 0')
+
+    uploaded = storage.upload_items(gen())
+    self.assertEqual(set(items), set(uploaded))
+    self.assertEqual(
+        [items[0:2], items[2:6]],
+        [sorted(b, key=items.index) for b in storage_api.contains_calls])
+
+  def test_upload_items_presence_cache(self):
+    items = [FakeItem('item %d' % i) for i in xrange(3)]
+    storage_api = MockedStorageApi({items[0].digest: 'push_state'})
+    path = os.path.join(self.tempdir, u'presence.json')
+    with isolateserver.PresenceCache(path) as cache:
+      storage = isolateserver.Storage(storage_api, cache)
+      self.assertEqual([items[0]], storage.upload_items(items))
+    self.assertEqual(1, len(storage_api.contains_calls))
+
+    # All the items are now known to be on the server, in another process too.
+    storage_api.missing_hashes = {}
+    with isolateserver.PresenceCache(path) as cache:
+      storage = isolateserver.Storage(storage_api, cache)
+      self.assertEqual([], storage.upload_items(items + [FakeItem('new')]))
+    self.assertEqual(2, len(storage_api.contains_calls))
+    self.assertEqual(['new'], [i.data for i in storage_api.contains_calls[1]])
+
+    # Not after they expired.
+    storage = isolateserver.Storage(
+        storage_api, isolateserver.PresenceCache(path, ttl=0))
+    self.assertEqual([], storage.upload_items(items))
+    self.assertEqual(3, len(storage_api.contains_calls))
+
+  def test_presence_cache_scope(self):
+    cache = isolateserver.PresenceCache(
+        os.path.join(self.tempdir, u'presence.json'))
+    cache.add('https://a', 'default', ['h1'])
+    cache.add_tree('https://a', 'default', 'h2')
+    self.assertTrue(cache.contains('https://a', 'default', 'h1'))
+    self.assertFalse(cache.contains('https://a', 'default-gzip', 'h1'))
+    self.assertFalse(cache.contains('https://b', 'default', 'h1'))
+    self.assertFalse(cache.contains_tree('https://a', 'default', 'h1'))
+    self.assertTrue(cache.contains_tree('https://a', 'default', 'h2'))
+    self.assertFalse(cache.contains('https://a', 'default', 'h2'))
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem('1234567')
@@ -375,10 +649,9 @@ class StorageTest(TestCase):
     def push_side_effect():
       raise IOError('Nope')
 
-    # TODO(vadimsh): Retrying push when fetching data from a generator is
-    # broken now (it reuses same generator instance when retrying).
+    # The content is regenerated on each attempt, so a generator works too.
     content_sources = (
-        # generator(),
+        _generator,
         lambda: [chunk],
     )
 
@@ -404,6 +677,305 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_async_fetch_resume(self):
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    for use_zip in (False, True):
+      raw = zlib.compress(data) if use_zip else data
+      chunk = len(raw) / 3 + 1
+      offsets = []
+
+      class FlakyStorageApi(MockedStorageApi):
+        def fetch(self, _digest, offset=0):
+          # Each connection is dropped after |chunk| bytes.
+          offsets.append(offset)
+          yield raw[offset:offset+chunk]
+          if offset + chunk < len(raw):
+            raise IOError('Connection reset')
+
+      storage = isolateserver.Storage(FlakyStorageApi(
+          {}, namespace='default-gzip' if use_zip else 'default'))
+      partial = os.path.join(self.tempdir, item.digest + '.partial')
+      # A previous run already fetched the first bytes.
+      with open(partial, 'wb') as f:
+        f.write(raw[:10])
+      fetched = []
+      channel = threading_utils.TaskChannel()
+      storage.async_fetch(
+          channel, threading_utils.PRIORITY_MED, item.digest, item.size,
+          lambda content: fetched.extend(content), partial)
+      self.assertEqual(item.digest, channel.pull())
+      self.assertEqual(data, ''.join(fetched))
+      self.assertEqual([10, 10 + chunk, 10 + 2 * chunk], offsets)
+      self.assertFalse(os.path.exists(partial))
+
+  def test_async_fetch_resume_corrupted(self):
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, _digest, offset=0):
+        yield data[offset:]
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    partial = os.path.join(self.tempdir, item.digest + '.partial')
+    # The previous run left more data than the item has.
+    with open(partial, 'wb') as f:
+      f.write(data + 'garbage')
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, item.digest, item.size,
+        list, partial)
+    # The broken partial file is discarded, the retry starts from scratch.
+    self.assertEqual(item.digest, channel.pull())
+    self.assertFalse(os.path.exists(partial))
+
+  def test_async_fetch_stages(self):
+    # The network thread is released before the sink is done.
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    received = threading.Event()
+    release = threading.Event()
+
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, _digest, offset=0):
+        for i in xrange(offset, len(data), 100):
+          yield data[i:i+100]
+        received.set()
+
+    def sink(content):
+      self.assertTrue(release.wait(5))
+      fetched.extend(content)
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    fetched = []
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, item.digest, item.size, sink)
+    self.assertTrue(received.wait(5))
+    with self.assertRaises(threading_utils.TaskChannel.Timeout):
+      channel.pull(timeout=0.01)
+    release.set()
+    self.assertEqual(item.digest, channel.pull())
+    self.assertEqual(data, ''.join(fetched))
+    storage.close()
+
+  def test_close_waits_for_requeued_tasks(self):
+    # A task queued on the network pool by a later stage while closing runs
+    # before close() returns, in the original pool.
+    storage = isolateserver.Storage(MockedStorageApi({}))
+    net_thread_pool = storage.net_thread_pool
+    done = []
+    def disk_task():
+      time.sleep(0.05)
+      storage.net_thread_pool.add_task(0, done.append, 'net')
+    storage.disk_thread_pool.add_task(0, disk_task)
+    storage.close()
+    self.assertEqual(['net'], done)
+    self.assertEqual(1, net_thread_pool.added_tasks)
+    self.assertEqual(None, storage._net_thread_pool)
+
+  def test_async_fetch_batch_unexpected_error(self):
+    # Each item gets the error, FetchQueue.wait() doesn't block forever.
+    class FakeStorageApi(MockedStorageApi):
+      def fetch_batch(self, digests):
+        raise TypeError('Incorrect padding')
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch_batch(
+        threading_utils.PRIORITY_MED,
+        [('a', 1, list, channel), ('b', 1, list, channel)])
+    for _ in xrange(2):
+      with self.assertRaises(TypeError):
+        channel.pull(timeout=5)
+    storage.close()
+
+  def test_fetch_failed_releases_claim(self):
+    # The claim of a resumable fetch that failed is released at once.
+    self.mock(isolateserver, 'RESUMABLE_FETCH_MIN_SIZE', 10)
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0):
+        raise IOError('Unreachable')
+        yield # pylint: disable=unreachable
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    with isolateserver.DiskCache(
+        self.tempdir, policies, storage.hash_algo, trim=False) as cache:
+      queue = isolateserver.FetchQueue(storage, cache)
+      queue.add('a' * 40, 100)
+      with self.assertRaises(IOError):
+        queue.wait(['a' * 40])
+      other = isolateserver.DiskCache(
+          self.tempdir, policies, storage.hash_algo, trim=False)
+      self.assertTrue(other.claim('a' * 40))
+      other.release_claim('a' * 40)
+    storage.close()
+
+  def test_fetch_batch_failed_releases_claim(self):
+    # The claims of the items of a failed batch are released, whether the batch
+    # raised or the items failed once fetched one by one.
+    class FakeStorageApi(MockedStorageApi):
+      batch_limits = (10, 1024)
+      def fetch_batch(self, digests):
+        if digests == ['a' * 40]:
+          raise TypeError('Incorrect padding')
+        return {}
+      def fetch(self, digest, offset=0):
+        raise IOError('Unreachable')
+        yield # pylint: disable=unreachable
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    with isolateserver.DiskCache(
+        self.tempdir, policies, storage.hash_algo, trim=False) as cache:
+      other = isolateserver.DiskCache(
+          self.tempdir, policies, storage.hash_algo, trim=False)
+      queue = isolateserver.FetchQueue(storage, cache)
+      queue.add('a' * 40, 1)
+      with self.assertRaises(TypeError):
+        queue.wait(['a' * 40])
+      self.assertTrue(other.claim('a' * 40))
+      queue.add('b' * 40, 1)
+      with self.assertRaises(IOError):
+        queue.wait(['b' * 40])
+      self.assertTrue(other.claim('b' * 40))
+      other.release_claim('a' * 40)
+      other.release_claim('b' * 40)
+    storage.close()
+
+  def test_fetch_more_items_than_open_files(self):
+    # The pending fetches don't keep a file open each.
+    if sys.platform == 'win32':
+      return
+    started = threading.Event()
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0):
+        started.wait()
+        yield digest[offset:]
+
+    storage = isolateserver.Storage(FakeStorageApi({}))
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    digests = ['%040x' % i for i in xrange(400)]
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (256, limits[1]))
+    try:
+      with isolateserver.DiskCache(
+          self.tempdir, policies, storage.hash_algo, trim=False) as cache:
+        queue = isolateserver.FetchQueue(storage, cache)
+        try:
+          for digest in digests:
+            queue.add(digest, 40)
+        finally:
+          started.set()
+        while queue.pending_count:
+          queue.wait(list(queue._pending))
+        cache.trim()
+        self.assertEqual(set(digests), cache.cached_set())
+    finally:
+      resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+      storage.close()
+
+  def test_async_fetch_corrupted(self):
+    # Corrupted data is fetched again, a failing sink is not retried.
+    calls = []
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0):
+        calls.append(digest)
+        yield 'not zlib data'
+
+    storage = isolateserver.Storage(
+        FakeStorageApi({}, namespace='default-gzip'))
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'corrupted', 100, list)
+    with self.assertRaises(IOError):
+      channel.pull()
+    self.assertEqual(
+        1 + threading_utils.IOAutoRetryThreadPool.RETRIES, len(calls))
+
+    def sink(content):
+      list(content)
+      raise IOError('Disk full')
+    data = 'data'
+    self.mock(FakeStorageApi, 'fetch', lambda _self, digest, offset=0: (
+        calls.append(digest) or [zlib.compress(data)]))
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'sink', len(data), sink)
+    with self.assertRaises(IOError):
+      channel.pull()
+    self.assertEqual(1, calls.count('sink'))
+    storage.close()
+
+  def test_async_fetch_ranges(self):
+    self.mock(isolateserver, 'PARALLEL_FETCH_MIN_SIZE', 1000)
+    self.mock(isolateserver, 'PARALLEL_FETCH_RANGE_SIZE', 300)
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    calls = []
+    lock = threading.Lock()
+
+    class RangeStorageApi(MockedStorageApi):
+      def fetch(self, _digest, offset=0, length=None):
+        with lock:
+          calls.append((offset, length))
+          # The first connection for the second range is dropped halfway.
+          fail = (offset, length) == (300, 300) and calls.count((300, 300)) == 1
+        end = len(data) if length is None else offset + length
+        if fail:
+          yield data[offset:offset+100]
+          raise IOError('Connection reset')
+        yield data[offset:end]
+
+    storage = isolateserver.Storage(RangeStorageApi({}))
+    partial = os.path.join(self.tempdir, item.digest + '.partial')
+    moved = []
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, item.digest, item.size,
+        None, partial, moved.append)
+    self.assertEqual(item.digest, channel.pull())
+    # The file was handed over as is.
+    self.assertEqual([partial], moved)
+    with open(partial, 'rb') as f:
+      self.assertEqual(data, f.read())
+    # The retry resumed after the 400 bytes fetched without gap; the remaining
+    # 2490 bytes are fetched in ranges again.
+    self.assertEqual(
+        [(0, 300), (300, 300), (600, 300), (900, 300), (1200, 300),
+         (1500, 300), (1800, 300), (2100, 300), (2400, 300), (2700, 190)],
+        sorted(calls[:10]))
+    self.assertEqual(
+        [(400, 300), (700, 300), (1000, 300), (1300, 300), (1600, 300),
+         (1900, 300), (2200, 300), (2500, 300), (2800, 90)],
+        sorted(calls[10:]))
+
+  def test_async_fetch_ranges_compressed(self):
+    # Compressed data can't be fetched in ranges.
+    self.mock(isolateserver, 'PARALLEL_FETCH_MIN_SIZE', 1000)
+    self.mock(isolateserver, 'PARALLEL_FETCH_RANGE_SIZE', 300)
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    calls = []
+
+    class FakeStorageApi(MockedStorageApi):
+      def fetch(self, _digest, offset=0, length=None):
+        calls.append((offset, length))
+        yield zlib.compress(data)
+
+    storage = isolateserver.Storage(
+        FakeStorageApi({}, namespace='default-gzip'))
+    partial = os.path.join(self.tempdir, item.digest + '.partial')
+    fetched = []
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, item.digest, item.size,
+        lambda content: fetched.extend(content), partial, self.fail)
+    self.assertEqual(item.digest, channel.pull())
+    self.assertEqual(data, ''.join(fetched))
+    self.assertEqual([(0, None)], calls)
+
   def test_upload_tree(self):
     files = {
       u'/a': {
@@ -438,7 +1010,7 @@ class StorageTest(TestCase):
 
     storage_api = MockedStorageApi(missing_hashes)
     storage = isolateserver.Storage(storage_api)
-    def mock_get_storage(base_url, namespace):
+    def mock_get_storage(base_url, namespace, _presence_cache=None):
       self.assertEqual('base_url', base_url)
       self.assertEqual('some-namespace', namespace)
       return storage
@@ -511,7 +1083,7 @@ class IsolateServerStorageApiTest(TestCase):
     response = data
     return (
         server + '/some/gs/url/%s/%s' % (namespace, item),
-        {},
+        {'headers': request_headers},
         response,
         response_headers,
     )
@@ -552,6 +1124,29 @@ class IsolateServerStorageApiTest(TestCase):
     fetched = ''.join(storage.fetch(item))
     self.assertEqual(data, fetched)
 
+  def test_fetch_batch_invalid_response(self):
+    # A malformed response is an IOError, so the items are fetched one by one.
+    server = 'http://example.com'
+    namespace = 'default'
+    self.expected_requests([(
+      server + '/api/isolateservice/v1/retrieve_batch',
+      {
+          'data': {
+              'digests': ['a' * 40],
+              'namespace': {
+                  'compression': '',
+                  'digest_hash': 'sha-1',
+                  'namespace': namespace,
+              },
+          },
+          'read_timeout': 60,
+      },
+      {'items': [{'content': 'Zm9v'}]},
+    )])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    with self.assertRaises(IOError):
+      storage.fetch_batch([u'a' * 40])
+
   def test_fetch_failure(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -582,6 +1177,61 @@ class IsolateServerStorageApiTest(TestCase):
       fetched = ''.join(storage.fetch(item, offset))
       self.assertEqual(data[offset:], fetched)
 
+  def test_fetch_range_success(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    offset = 200
+    size = len(data)
+
+    good_ranges = [
+      # Entirely in the file.
+      (100, 'bytes %d-%d/%d' % (offset, offset + 99, size)),
+      (100, 'bytes %d-%d/*' % (offset, offset + 99)),
+      # Cut short by the end of the file.
+      (size, 'bytes %d-%d/%d' % (offset, size - 1, size)),
+    ]
+
+    for length, content_range_header in good_ranges:
+      self.expected_requests([
+          self.mock_fetch_request(server, namespace, item, offset=offset),
+          self.mock_gs_request(
+              server, namespace, item, data[offset:offset+length],
+              offset=offset,
+              request_headers={
+                'Range': 'bytes=%d-%d' % (offset, offset + length - 1)},
+              response_headers={'Content-Range': content_range_header}),
+      ])
+      storage = isolate_storage.IsolateServer(server, namespace)
+      fetched = ''.join(storage.fetch(item, offset, length))
+      self.assertEqual(data[offset:offset+length], fetched)
+
+  def test_fetch_range_bad_header(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    size = len(data)
+
+    bad_content_range_headers = [
+      # Incomplete range.
+      'bytes 0-49/%d' % size,
+      'bytes 0-49/*',
+    ]
+
+    for content_range_header in bad_content_range_headers:
+      self.expected_requests([
+          self.mock_fetch_request(server, namespace, item),
+          self.mock_gs_request(
+              server, namespace, item, data[:50],
+              request_headers={'Range': 'bytes=0-99'},
+              response_headers={'Content-Range': content_range_header}),
+      ])
+      storage = isolate_storage.IsolateServer(server, namespace)
+      with self.assertRaises(IOError):
+        _ = ''.join(storage.fetch(item, 0, 100))
+
   def test_fetch_offset_bad_header(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -711,6 +1361,48 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_gs_streamed(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': server + '/FAKE_GCS/whatevs/1234',
+         'upload_ticket': 'ticket!'}]}
+    def check_put(kwargs):
+      # The body is not assembled in memory but streamed chunk by chunk.
+      body = kwargs.pop('data')
+      self.assertTrue(net.HttpService.is_streamed_body(body))
+      self.assertEqual(data, ''.join(body))
+      self.assertEqual(
+          {
+            'content_type': 'application/octet-stream',
+            'method': 'PUT',
+            'headers': {'Cache-Control': 'public, max-age=31536000'},
+          },
+          kwargs)
+    requests = [
+      self.mock_contains_request(
+          server, namespace, contains_request, contains_response),
+      (server + '/FAKE_GCS/whatevs/1234', check_put, '', None),
+      (
+        server + '/api/isolateservice/v1/finalize_gs_upload',
+        {'data': {'upload_ticket': 'ticket!'}},
+        {'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    storage = isolate_storage.IsolateServer(server, namespace)
+    push_state = storage.contains([item])[item]
+    storage.push(
+        item, push_state, (data[i:i+100] for i in xrange(0, len(data), 100)))
+    self.assertTrue(push_state.uploaded)
+    self.assertTrue(push_state.finalized)
+    self.assertEqual(0, isolate_storage.get_memory_budget().used)
+
   def test_contains_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -827,6 +1519,73 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_upload_items_gzip(self):
     self.run_upload_items_test('default-gzip')
 
+  def test_upload_large_file_streamed(self):
+    # Large enough to be pushed to the fake GCS, which is streamed.
+    storage = isolateserver.get_storage(self.server.url, 'default-gzip')
+    path = os.path.join(self.tempdir, u'large')
+    data = os.urandom(1024) * 3 * 1024
+    with fs.open(path, 'wb') as f:
+      f.write(data)
+    item = isolateserver.FileItem(path)
+    self.assertEqual([item], storage.upload_items([item]))
+    self.assertEqual(
+        data,
+        zlib.decompress(self.server.contents['default-gzip'][item.digest]))
+
+  def test_fetch_gs_offset(self):
+    # Large enough to be pushed to the fake GCS, fetched with a Range header.
+    storage_api = isolate_storage.IsolateServer(self.server.url, 'default')
+    data = os.urandom(1024) * 100
+    item = isolateserver.BufferItem(data)
+    item.prepare(isolated_format.get_hash_algo('default'))
+    for i, push_state in storage_api.contains([item]).iteritems():
+      storage_api.push(i, push_state)
+    self.assertEqual(data[1000:], ''.join(storage_api.fetch(item.digest, 1000)))
+
+  def test_fetch_ranges_to_disk_cache(self):
+    for name, value in (
+        ('RESUMABLE_FETCH_MIN_SIZE', 64 * 1024),
+        ('PARALLEL_FETCH_MIN_SIZE', 64 * 1024),
+        ('PARALLEL_FETCH_RANGE_SIZE', 16 * 1024)):
+      self.addCleanup(setattr, isolateserver, name, getattr(isolateserver, name))
+      setattr(isolateserver, name, value)
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    item = isolateserver.BufferItem(os.urandom(1024) * 100)
+    self.assertEqual([item], storage.upload_items([item]))
+
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    with isolateserver.DiskCache(
+        cache_dir, policies, storage.hash_algo, trim=False) as cache:
+      queue = isolateserver.FetchQueue(storage, cache)
+      queue.add(item.digest, item.size)
+      self.assertEqual(item.digest, queue.wait([item.digest]))
+      with cache.getfileobj(item.digest) as f:
+        self.assertEqual(item.buffer, f.read())
+    self.assertEqual(
+        sorted([item.digest, u'integrity.journal', u'locks', u'state.json']),
+        sorted(os.listdir(cache_dir)))
+
+  def test_fetch_claimed_by_other_process(self):
+    # An item fetched by another process sharing the cache isn't fetched again.
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    item = isolateserver.BufferItem('foo')
+    item.prepare(storage.hash_algo)
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    policies = isolateserver.CachePolicies(0, 0, 0)
+    other = isolateserver.DiskCache(
+        cache_dir, policies, storage.hash_algo, trim=False)
+    self.assertTrue(other.claim(item.digest))
+    with isolateserver.DiskCache(
+        cache_dir, policies, storage.hash_algo, trim=False) as cache:
+      queue = isolateserver.FetchQueue(storage, cache)
+      # The item is not on the server, it would fail to be fetched.
+      queue.add(item.digest, item.size)
+      other.write(item.digest, [item.buffer])
+      self.assertEqual(item.digest, queue.wait([item.digest]))
+      with cache.getfileobj(item.digest) as f:
+        self.assertEqual(item.buffer, f.read())
+
   def run_push_and_fetch_test(self, namespace):
     storage = isolateserver.get_storage(self.server.url, namespace)
 
@@ -864,6 +1623,124 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_push_and_fetch_gzip(self):
     self.run_push_and_fetch_test('default-gzip')
 
+  def run_push_and_fetch_batch_test(self, namespace):
+    storage = isolateserver.get_storage(self.server.url, namespace)
+    calls = []
+    def record(name):
+      method = getattr(storage._storage_api, name)
+      def wrapper(*args, **kwargs):
+        calls.append(name)
+        return method(*args, **kwargs)
+      setattr(storage._storage_api, name, wrapper)
+    for name in ('fetch', 'fetch_batch', 'push', 'push_batch'):
+      record(name)
+
+    # The large item is stored in the fake GCS, so is not batched.
+    items = [isolateserver.BufferItem('item %d' % i) for i in xrange(10)]
+    items.append(isolateserver.BufferItem(os.urandom(1024)))
+    self.assertEqual(set(items), set(storage.upload_items(items)))
+
+    cache = isolateserver.MemoryCache()
+    queue = isolateserver.FetchQueue(storage, cache)
+    pending = set()
+    for item in items:
+      pending.add(item.digest)
+      queue.add(item.digest, item.size)
+    while pending:
+      pending.discard(queue.wait(pending))
+    actual = []
+    for i in items:
+      with cache.getfileobj(i.digest) as f:
+        actual.append(f.read())
+    self.assertEqual([i.buffer for i in items], actual)
+    return sorted(calls)
+
+  def test_push_and_fetch_batch(self):
+    self.assertEqual(
+        ['fetch', 'fetch_batch', 'push', 'push_batch'],
+        self.run_push_and_fetch_batch_test('default'))
+
+  def test_push_and_fetch_batch_gzip(self):
+    self.assertEqual(
+        ['fetch', 'fetch_batch', 'push', 'push_batch'],
+        self.run_push_and_fetch_batch_test('default-gzip'))
+
+  def test_push_and_fetch_batch_not_supported(self):
+    self.server.disable_batch_api()
+    self.assertEqual(
+        ['fetch'] * 11 + ['push'] * 11,
+        self.run_push_and_fetch_batch_test('default-gzip'))
+
+  def test_archive_bundle_small_files_and_fetch(self):
+    tree = {'a/%02d' % i: 'content %d' % i for i in xrange(10)}
+    tree['a/big'] = 'x' * (isolateserver.BUNDLE_MAX_FILE_SIZE + 1)
+    tree['b'] = 'b'
+    root = os.path.join(self.tempdir, u'root')
+    for relpath, content in tree.iteritems():
+      p = os.path.join(root, relpath)
+      if not fs.isdir(os.path.dirname(p)):
+        fs.makedirs(os.path.dirname(p))
+      with fs.open(p, 'wb') as f:
+        f.write(content)
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    with storage:
+      results, _, _ = isolateserver.archive_files_to_storage(
+          storage, [root], None, bundle=True)
+    # The .isolated, the bundle of 'a/', 'a/big' and 'b'.
+    self.assertEqual(4, len(self.server.contents['default']))
+
+    outdir = os.path.join(self.tempdir, u'out')
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    with storage:
+      isolateserver.fetch_isolated(
+          results[0][0], storage, isolateserver.MemoryCache(), outdir, False)
+    actual = {}
+    for relpath in tree:
+      with fs.open(os.path.join(outdir, relpath), 'rb') as f:
+        actual[relpath] = f.read()
+    self.assertEqual(tree, actual)
+    self.assertEqual(
+        [u'00', u'01', u'02', u'03', u'04', u'05', u'06', u'07', u'08', u'09',
+         u'big'],
+        sorted(os.listdir(os.path.join(outdir, u'a'))))
+
+  def test_fetch_isolated_to_disk_cache(self):
+    # The files are linked from the cache, without being opened.
+    tree = {'a/%02d' % i: 'content %d' % i for i in xrange(20)}
+    tree['b/c/d'] = 'd'
+    root = os.path.join(self.tempdir, u'root')
+    for relpath, content in tree.iteritems():
+      p = os.path.join(root, relpath)
+      if not fs.isdir(os.path.dirname(p)):
+        fs.makedirs(os.path.dirname(p))
+      with fs.open(p, 'wb') as f:
+        f.write(content)
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    with storage:
+      results, _, _ = isolateserver.archive_files_to_storage(
+          storage, [root], None)
+
+    cache = isolateserver.DiskCache(
+        os.path.join(self.tempdir, u'cache'),
+        isolateserver.CachePolicies(0, 0, 0), storage.hash_algo, trim=False)
+    opened = []
+    getfileobj = cache.getfileobj
+    def getfileobj_hook(digest):
+      opened.append(digest)
+      return getfileobj(digest)
+    cache.getfileobj = getfileobj_hook
+    outdir = os.path.join(self.tempdir, u'out')
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    with storage:
+      isolateserver.fetch_isolated(results[0][0], storage, cache, outdir, False)
+    actual = {}
+    for relpath in tree:
+      with fs.open(os.path.join(outdir, relpath), 'rb') as f:
+        actual[relpath] = f.read()
+    self.assertEqual(tree, actual)
+    # Only the .isolated file was read.
+    self.assertEqual([results[0][0]], opened)
+
   if sys.maxsize == (2**31) - 1:
     def test_archive_multiple_huge_file(self):
       self.server.discard_content()
@@ -1019,6 +1896,8 @@ class IsolateServerDownloadTest(TestCase):
       '--target', self.tempdir,
       '--isolated', isolated_hash,
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(server))
     self.expected_requests(requests)
     self.assertEqual(0, isolateserver.main(cmd))
     expected = dict(
@@ -1121,6 +2000,8 @@ class IsolateServerDownloadTest(TestCase):
       '--target', self.tempdir,
       '--isolated', isolated_hash,
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(server))
     self.expected_requests(requests)
     self.assertEqual(0, isolateserver.main(cmd))
     expected = dict(
@@ -1210,6 +2091,8 @@ class IsolateServerDownloadTest(TestCase):
       '--target', self.tempdir,
       '--isolated', isolated_hash,
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(server))
     self.expected_requests(requests)
     self.assertEqual(0, isolateserver.main(cmd))
     expected = dict(
@@ -1221,7 +2104,7 @@ class IsolateServerDownloadTest(TestCase):
     self.checkOutput(expected_stdout, '')
 
 
-def get_storage(_isolate_server, namespace):
+def get_storage(_isolate_server, namespace, _presence_cache=None):
   class StorageFake(object):
     def __enter__(self, *_):
       return self
@@ -1236,10 +2119,97 @@ def get_storage(_isolate_server, namespace):
     @staticmethod
     def upload_items(items):
       # Always returns the second item as not present.
-      return [items[1]]
+      return [list(items)[1]]
   return StorageFake()
 
 
+class DirectoryToMetadataTest(TestCase):
+  def test_directory_to_metadata(self):
+    self.make_tree({'a': 'a', 'b/c': 'cc', 'b/d.isolated': 'ddd'})
+    if sys.platform != 'win32':
+      os.symlink('a', os.path.join(self.tempdir, 'e'))
+    algo = isolated_format.get_hash_algo('default')
+    items, metadata = isolateserver.directory_to_metadata(
+        self.tempdir, algo, None)
+    expected = {
+      u'a': 'a',
+      os.path.join(u'b', u'c'): 'cc',
+      os.path.join(u'b', u'd.isolated'): 'ddd',
+    }
+    self.assertEqual(
+        {os.path.join(self.tempdir, k): algo(v).hexdigest()
+         for k, v in expected.iteritems()},
+        {i.path: i.digest for i in items})
+    self.assertEqual(
+        [os.path.join(u'b', u'd.isolated')],
+        [os.path.relpath(i.path, self.tempdir) for i in items
+         if i.high_priority])
+    for relpath, content in expected.iteritems():
+      self.assertEqual(algo(content).hexdigest(), metadata[relpath]['h'])
+      self.assertEqual(len(content), metadata[relpath]['s'])
+      self.assertNotIn('t', metadata[relpath])
+    if sys.platform != 'win32':
+      self.assertEqual({'l': 'a'}, metadata[u'e'])
+
+  def test_bundle_small_files(self):
+    self.mock(isolateserver, 'BUNDLE_AVG_FILES', 4)
+    self.mock(isolateserver, 'BUNDLE_MAX_FILE_SIZE', 100)
+    tree = {'a/%02d' % i: 'content %d' % i for i in xrange(20)}
+    tree['a/big'] = 'x' * 101
+    tree['a/b.isolated'] = '{}'
+    tree['c/alone'] = 'alone'
+    self.make_tree(tree)
+    algo = isolated_format.get_hash_algo('default')
+
+    def bundle():
+      _, metadata = isolateserver.directory_to_metadata(
+          self.tempdir, algo, None)
+      out = tempfile.mkdtemp(prefix=u'bundles')
+      self.addCleanup(file_path.rmtree, out)
+      bundles = isolateserver.bundle_small_files(
+          self.tempdir, metadata, algo, out)
+      return metadata, bundles
+
+    metadata, bundles = bundle()
+    # Files are cut on name boundaries, so there is more than one bundle and
+    # every small file is in exactly one bundle.
+    self.assertLess(1, len(bundles))
+    bundled = sorted(r for _, _, relpaths in bundles for r in relpaths)
+    self.assertEqual(
+        [os.path.join(u'a', u'%02d' % i) for i in xrange(20)], bundled)
+    self.assertEqual(
+        sorted([
+          os.path.join(u'a', u'big'), os.path.join(u'a', u'b.isolated'),
+          os.path.join(u'c', u'alone')] +
+          [os.path.join(u'a', u'.isolate_bundle_%d.ar' % i)
+           for i in xrange(len(bundles))]),
+        sorted(metadata))
+    for path, meta, relpaths in bundles:
+      self.assertEqual('ar', meta['t'])
+      with fs.open(path, 'rb') as f:
+        data = f.read()
+      self.assertEqual(algo(data).hexdigest(), meta['h'])
+      self.assertEqual(len(data), meta['s'])
+      ar = arfile.ArFileReader(io.BytesIO(data), fullparse=False)
+      self.assertEqual(
+          [(os.path.basename(r), tree['a/' + os.path.basename(r)])
+           for r in relpaths],
+          [(ai.name, af.read(ai.size)) for ai, af in ar])
+
+    # Bundling is deterministic, and only the bundle of a modified file changes.
+    def digests(bundles):
+      return {tuple(relpaths): meta['h'] for _, meta, relpaths in bundles}
+    expected = digests(bundles)
+    self.assertEqual(expected, digests(bundle()[1]))
+    with fs.open(os.path.join(self.tempdir, u'a', u'05'), 'wb') as f:
+      f.write('modified')
+    actual = digests(bundle()[1])
+    self.assertEqual(sorted(expected), sorted(actual))
+    self.assertEqual(
+        [k for k in expected if os.path.join(u'a', u'05') in k],
+        [k for k in expected if expected[k] != actual[k]])
+
+
 class TestArchive(TestCase):
   @staticmethod
   def get_isolateserver_prog():
@@ -1335,9 +2305,9 @@ class DiskCacheTest(TestCase):
     # TODO(maruel): Test the following.
     #cache.touch()
 
-  def get_cache(self):
+  def get_cache(self, **kwargs):
     return isolateserver.DiskCache(
-        self.tempdir, self._policies, self._algo, trim=True)
+        self.tempdir, self._policies, self._algo, trim=True, **kwargs)
 
   def to_hash(self, content):
     return self._algo(content).hexdigest(), content
@@ -1379,11 +2349,46 @@ class DiskCacheTest(TestCase):
     h_a = self.to_hash('a')[0]
     isolateserver.file_write(os.path.join(self.tempdir, h_a), 'a')
     cache = self.get_cache()
-    self.assertEqual([], sorted(cache._lru._items.iteritems()))
+    self.assertEqual([], sorted(cache._lru.iteritems()))
     self.assertEqual(
-        sorted([h_a, u'state.json']), sorted(os.listdir(self.tempdir)))
+        sorted([h_a, u'locks', u'state.json']),
+        sorted(os.listdir(self.tempdir)))
+    cache.cleanup()
+    self.assertEqual(
+        [u'integrity.journal', u'locks', u'state.json'],
+        sorted(os.listdir(self.tempdir)))
+
+  def test_cleanup_partial(self):
+    # Partial files are kept for a while to resume fetches, unless stale.
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    h_c = self.to_hash('c')[0]
+    self._free_disk = 1100
+    cache = self.get_cache()
+    cache.write(h_a, 'a')
+    isolateserver.file_write(cache.get_partial_path(h_a), 'a')
+    isolateserver.file_write(cache.get_partial_path(h_b), 'b')
+    isolateserver.file_write(cache.get_partial_path(h_c), 'c')
+    old = time.time() - cache.PARTIAL_MAX_AGE - 1
+    os.utime(cache.get_partial_path(h_c), (old, old))
     cache.cleanup()
-    self.assertEqual([u'state.json'], os.listdir(self.tempdir))
+    self.assertEqual(
+        sorted([h_a, h_b + u'.partial']),
+        sorted(
+            f for f in os.listdir(self.tempdir)
+            if f not in (u'integrity.journal', u'locks', u'state.json')))
+
+  def test_move_in(self):
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    with self.get_cache() as cache:
+      partial = cache.get_partial_path(h_a)
+      isolateserver.file_write(partial, 'a')
+      self.assertEqual(h_a, cache.move_in(h_a, partial))
+      self.assertFalse(os.path.exists(partial))
+      with cache.getfileobj(h_a) as f:
+        self.assertEqual('a', f.read())
+      self.assertEqual([1], cache.added)
 
   def test_policies_active_trimming(self):
     # Start with a larger cache, add many object.
@@ -1396,7 +2401,7 @@ class DiskCacheTest(TestCase):
 
     def assertItems(expected):
       actual = [
-        (digest, size) for digest, (size, _) in cache._lru._items.iteritems()]
+        (digest, size) for digest, (size, _) in cache._lru.iteritems()]
       self.assertEqual(expected, actual)
 
     # Max policies is 100 bytes, 2 items, 1000 bytes free space.
@@ -1422,7 +2427,8 @@ class DiskCacheTest(TestCase):
     # At this point, after the implicit trim in __exit__(), h_a and h_large were
     # evicted.
     self.assertEqual(
-        sorted([h_b, h_c, u'state.json']), sorted(os.listdir(self.tempdir)))
+        sorted([h_b, h_c, u'integrity.journal', u'locks', u'state.json']),
+        sorted(os.listdir(self.tempdir)))
 
     # Allow 3 items and 101 bytes so h_large is kept.
     self._policies = isolateserver.CachePolicies(101, 1000, 3)
@@ -1432,7 +2438,8 @@ class DiskCacheTest(TestCase):
       self.assertEqual(2, cache.initial_size)
 
     self.assertEqual(
-        sorted([h_b, h_c, h_large, u'state.json']),
+        sorted([
+            h_b, h_c, h_large, u'integrity.journal', u'locks', u'state.json']),
         sorted(os.listdir(self.tempdir)))
 
     # Assert that trimming is done in constructor too.
@@ -1465,6 +2472,339 @@ class DiskCacheTest(TestCase):
       cache.evict(h_a)
       self.assertEqual(set(), cache.cached_set())
 
+  def test_shared_state(self):
+    # Two processes using the same cache directory see each other's items.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    cache1 = self.get_cache()
+    cache2 = self.get_cache()
+    cache1.write(h_a, 'a')
+    cache2.write(h_b, 'b')
+    with cache1:
+      pass
+    with cache2:
+      pass
+    with self.get_cache() as cache:
+      self.assertEqual({h_a, h_b}, cache.cached_set())
+
+  def test_pinned_by_other_process(self):
+    # Items in use by another process are not evicted.
+    self._free_disk = 1100
+    self._policies = isolateserver.CachePolicies(100, 1000, 1)
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    cache1 = self.get_cache()
+    self.assertTrue(cache1.touch(h_a, 1))
+    with self.get_cache() as cache2:
+      cache2.write(h_b, 'b')
+    # The most recent item was evicted instead.
+    self.assertEqual(
+        sorted([h_a, u'integrity.journal', u'locks', u'state.json']),
+        sorted(os.listdir(self.tempdir)))
+    # Once h_a is released, it can be evicted.
+    with cache1:
+      pass
+    with self.get_cache() as cache:
+      cache.write(h_b, 'b')
+    with self.get_cache() as cache:
+      self.assertEqual({h_b}, cache.cached_set())
+
+  def test_stale_pins(self):
+    # The pins of a process that died are ignored and deleted.
+    self._free_disk = 1100
+    self._policies = isolateserver.CachePolicies(100, 1000, 1)
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    pins = os.path.join(self.tempdir, u'locks', u'1.dead.pins')
+    isolateserver.file_write(pins, [h_a + '\n'])
+    with self.get_cache() as cache:
+      cache.write(h_b, 'b')
+    self.assertFalse(os.path.exists(pins))
+    with self.get_cache() as cache:
+      self.assertEqual({h_b}, cache.cached_set())
+
+  def test_journal(self):
+    # Changes to a large state are appended to its journal.
+    self.mock(lru, 'JOURNAL_MIN_ITEMS', 1)
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    state = os.path.join(self.tempdir, u'state.json')
+    with open(state, 'rb') as f:
+      content = f.read()
+    with self.get_cache() as cache:
+      cache.write(h_b, 'b')
+    with open(state, 'rb') as f:
+      self.assertEqual(content, f.read())
+    journal = state + lru.JOURNAL_SUFFIX
+    cache = self.get_cache()
+    cache.cleanup()
+    self.assertTrue(os.path.exists(journal))
+    self.assertEqual({h_a, h_b}, cache.cached_set())
+
+  def test_claim(self):
+    # Only one process fetches an item, the others wait for it.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    cache1 = self.get_cache()
+    cache2 = self.get_cache()
+    self.assertTrue(cache1.claim(h_a))
+    self.assertFalse(cache2.claim(h_a))
+    result = []
+    t = threading.Thread(target=lambda: result.append(cache2.wait_claim(h_a, 1)))
+    t.start()
+    cache1.write(h_a, 'a')
+    t.join()
+    self.assertEqual([True], result)
+    self.assertEqual({h_a}, cache2.cached_set())
+    self.assertFalse(
+        os.path.exists(os.path.join(self.tempdir, u'locks', h_a + u'.fetch')))
+    self.assertTrue(cache2.claim(h_a))
+
+  def test_claim_failed(self):
+    # The claim passes to a waiting process if the fetch fails.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    cache1 = self.get_cache()
+    cache2 = self.get_cache()
+    self.assertTrue(cache1.claim(h_a))
+    result = []
+    t = threading.Thread(target=lambda: result.append(cache2.wait_claim(h_a, 1)))
+    t.start()
+    with self.assertRaises(IOError):
+      cache1.write(h_a, self._failing_content())
+    t.join()
+    self.assertEqual([False], result)
+    self.assertFalse(cache1.claim(h_a))
+    cache2.write(h_a, 'a')
+    self.assertTrue(cache1.claim(h_a))
+
+  def test_claim_timeout(self):
+    # A process stuck with the claim doesn't block the others forever.
+    self.mock(isolateserver.DiskCache, 'CLAIM_TIMEOUT', 0.01)
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    cache1 = self.get_cache()
+    cache2 = self.get_cache()
+    self.assertTrue(cache1.claim(h_a))
+    self.assertEqual(None, cache2.wait_claim(h_a, 1))
+    # Both can write it.
+    cache2.write(h_a, 'a')
+    cache1.write(h_a, 'a')
+    self.assertEqual({h_a}, cache2.cached_set())
+    # No temporary file is left behind.
+    self.assertEqual(
+        [h_a], [i for i in fs.listdir(self.tempdir) if i.startswith(h_a)])
+
+  def test_claim_dead_process(self):
+    # The claims of a dead process are taken over, or deleted once its pins are
+    # found.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    locks = os.path.join(self.tempdir, u'locks')
+    claim_a = os.path.join(locks, h_a + u'.fetch')
+    claim_b = os.path.join(locks, h_b + u'.fetch')
+    with self.get_cache() as cache:
+      isolateserver.file_write(claim_a, ['1.gone.pins'])
+      self.assertTrue(cache.claim(h_a))
+      cache.write(h_a, 'a')
+    self.assertFalse(os.path.exists(claim_a))
+    isolateserver.file_write(os.path.join(locks, u'2.dead.pins'), [])
+    isolateserver.file_write(claim_b, ['2.dead.pins'])
+    with self.get_cache() as cache:
+      cache.cleanup()
+    self.assertEqual([u'state.lock'], os.listdir(locks))
+
+  def test_sharded(self):
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache(sharded=True) as cache:
+      cache.write(h_a, 'a')
+      isolateserver.file_write(cache.get_partial_path(h_b), 'b')
+    self.assertEqual(
+        sorted([
+            h_a[:2], h_b[:2], u'integrity.journal', u'locks', u'sharded',
+            u'state.json']),
+        sorted(os.listdir(self.tempdir)))
+    self.assertEqual(
+        [h_a[2:]], os.listdir(os.path.join(self.tempdir, h_a[:2])))
+    # A cache stays sharded.
+    with self.get_cache() as cache:
+      cache.cleanup()
+      with cache.getfileobj(h_a) as f:
+        self.assertEqual('a', f.read())
+    self.assertEqual(
+        [h_b[2:] + u'.partial'],
+        os.listdir(os.path.join(self.tempdir, h_b[:2])))
+
+  def test_migrate(self):
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+      isolateserver.file_write(cache.get_partial_path(h_b), 'b')
+    with self.get_cache(sharded=True) as cache:
+      self.assertEqual({h_a}, cache.cached_set())
+      self.assertTrue(cache.touch(h_a, 1))
+      self.assertEqual(
+          os.path.join(self.tempdir, h_b[:2], h_b[2:] + u'.partial'),
+          cache.get_partial_path(h_b))
+      self.assertTrue(os.path.isfile(cache.get_partial_path(h_b)))
+    self.assertEqual(
+        sorted([
+            h_a[:2], h_b[:2], u'integrity.journal', u'locks', u'sharded',
+            u'state.json']),
+        sorted(os.listdir(self.tempdir)))
+
+  def test_migrate_in_use(self):
+    # The cache is not migrated while another process uses it.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    cache1 = self.get_cache()
+    self.assertTrue(cache1.touch(h_a, 1))
+    with self.get_cache(sharded=True) as cache:
+      self.assertTrue(cache.touch(h_a, 1))
+    self.assertTrue(os.path.isfile(os.path.join(self.tempdir, h_a)))
+    with cache1:
+      pass
+    with self.get_cache(sharded=True) as cache:
+      self.assertTrue(cache.touch(h_a, 1))
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.tempdir, h_a[:2], h_a[2:])))
+
+  def test_migrated_by_other_process(self):
+    # A process that had the cache open before it was migrated switches to the
+    # sharded layout.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    cache1 = self.get_cache()
+    with self.get_cache(sharded=True):
+      pass
+    with cache1:
+      self.assertTrue(cache1.touch(h_a, 1))
+      cache1.write(h_b, 'b')
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.tempdir, h_b[:2], h_b[2:])))
+
+  def test_cleanup_interrupted_migration(self):
+    # cleanup() moves the items left behind by a migration into their shard.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    isolateserver.file_write(os.path.join(self.tempdir, u'sharded'), '')
+    with self.get_cache() as cache:
+      self.assertFalse(cache.touch(h_a, 1))
+      cache.cleanup()
+      self.assertTrue(cache.touch(h_a, 1))
+    self.assertEqual(
+        sorted([
+            h_a[:2], u'integrity.journal', u'locks', u'sharded',
+            u'state.json']),
+        sorted(os.listdir(self.tempdir)))
+
+  def test_cleanup_lazy(self):
+    # Only the items used since the previous cleanup() are checked, unless a
+    # process died.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    unknown = os.path.join(self.tempdir, u'unknown')
+    with self.get_cache() as cache:
+      cache.write(h_a, 'a')
+    with self.get_cache() as cache:
+      cache.cleanup()
+      cache.write(h_b, 'b')
+    isolateserver.file_write(unknown, 'unknown')
+    os.remove(os.path.join(self.tempdir, h_a))
+    os.remove(os.path.join(self.tempdir, h_b))
+    with self.get_cache() as cache:
+      cache.cleanup()
+      self.assertEqual({h_a}, cache.cached_set())
+    self.assertTrue(os.path.isfile(unknown))
+
+    isolateserver.file_write(
+        os.path.join(self.tempdir, u'locks', u'1.dead.pins'), [])
+    with self.get_cache() as cache:
+      cache.cleanup()
+      self.assertEqual(set(), cache.cached_set())
+    self.assertFalse(os.path.isfile(unknown))
+
+  def test_cleanup_verify(self):
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    with self.get_cache(verify=True) as cache:
+      cache.write(h_a, 'a')
+      cache.write(h_b, 'b')
+    p = os.path.join(self.tempdir, h_a)
+    file_path.set_read_only(p, False)
+    isolateserver.file_write(p, 'c')
+    with self.get_cache(verify=True) as cache:
+      cache.cleanup()
+      self.assertEqual({h_b}, cache.cached_set())
+      mode = os.stat(os.path.join(self.tempdir, h_b)).st_mode
+      self.assertEqual(0400, mode & 0777)
+    with open(os.path.join(self.tempdir, u'integrity.journal'), 'rb') as f:
+      self.assertEqual(1, len(f.read().splitlines()))
+
+  def test_cleanup_verify_once(self):
+    # Items are hashed again only once written again, or once their hash is
+    # older than VERIFY_MAX_AGE. The cache stays usable while hashing.
+    self._free_disk = 1100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    hashed = []
+    hash_file = isolated_format.hash_file
+    def hash_file_mock(path, algo):
+      self.assertIsNone(cache._lock._owner)
+      hashed.append(os.path.basename(path))
+      return hash_file(path, algo)
+    self.mock(isolated_format, 'hash_file', hash_file_mock)
+    with self.get_cache(verify=True) as cache:
+      cache.write(h_a, 'a')
+      cache.write(h_b, 'b')
+    with self.get_cache(verify=True) as cache:
+      cache.cleanup()
+      self.assertEqual(sorted([h_a, h_b]), sorted(hashed))
+      self.assertTrue(cache.touch(h_a, 1))
+      cache.write(h_b, 'b')
+    del hashed[:]
+    with self.get_cache() as cache:
+      # Not verifying, the items are left to verify.
+      cache.cleanup()
+      self.assertEqual([], hashed)
+    with self.get_cache(verify=True) as cache:
+      cache.cleanup()
+      self.assertEqual([h_b], hashed)
+      self.assertTrue(cache.touch(h_a, 1))
+    del hashed[:]
+    self.mock(isolateserver.DiskCache, 'VERIFY_MAX_AGE', -1)
+    with self.get_cache(verify=True) as cache:
+      cache.cleanup()
+      self.assertEqual([h_a], hashed)
+      self.assertEqual({h_a, h_b}, cache.cached_set())
+
+  @staticmethod
+  def _failing_content():
+    yield 'a'
+    raise IOError('Broken download')
+
 
 def clear_env_vars():
   for e in ('ISOLATE_DEBUG', 'ISOLATE_SERVER'):
@@ -6,6 +6,7 @@
 import json
 import logging
 import os
+import shutil
 import sys
 import tempfile
 import unittest
@@ -246,6 +247,149 @@ class LRUDictTest(unittest.TestCase):
     self.assertEqual(lru_dict.get_oldest(), ('kb', ('vb', 1)))
     self.assertEqual(lru_dict.pop_oldest(), ('kb', ('vb', 1)))
 
+  def test_explicit_timestamp(self):
+    lru_dict = lru.LRUDict()
+    lru_dict.time_fn = lambda: 10
+    lru_dict.add('ka', 'va', 1)
+    lru_dict.add('kb', 'vb')
+    self.assertEqual(1, lru_dict.get_timestamp('ka'))
+    lru_dict.touch('ka', 5)
+    self.assertEqual(lru_dict.get_oldest(), ('kb', ('vb', 10)))
+    self.assertEqual(5, lru_dict.get_timestamp('ka'))
+
+  def test_apply_changes(self):
+    lru_dict = self.prepare_lru_dict([1, 2, 3])
+    lru_dict.touch(1)
+    lru_dict.pop(2)
+    lru_dict.add(4, 4)
+    other = self.prepare_lru_dict([5])
+    other.apply_changes(lru_dict.get_changes())
+    self.assert_order(other, [5, 3, 1, 4])
+    # Touching or popping a missing key is ignored.
+    other = lru.LRUDict()
+    other.apply_changes([('t', 1, 0), ('p', 2)])
+    self.assertFalse(other)
+
+  def test_total(self):
+    lru_dict = lru.LRUDict()
+    lru_dict.add('a', 10)
+    lru_dict.add('b', 'not a number')
+    lru_dict.add('c', 5)
+    self.assertEqual(15, lru_dict.total)
+    lru_dict.add('a', 3)
+    self.assertEqual(8, lru_dict.total)
+    lru_dict.pop('c')
+    self.assertEqual(3, lru_dict.total)
+    self.assertEqual('b', lru_dict.pop_oldest()[0])
+    self.assertEqual(3, lru_dict.total)
+    lru_dict.pop_oldest()
+    self.assertEqual(0, lru_dict.total)
+
+  def test_reuse_slots(self):
+    lru_dict = lru.LRUDict()
+    lru_dict.time_fn = lambda: 0
+    for key in (1, 2, 3):
+      lru_dict.add(key, key)
+    lru_dict.pop(2)
+    lru_dict.pop_oldest()
+    lru_dict.add(4, 4)
+    lru_dict.add(5, 5)
+    lru_dict.touch(3, 1)
+    self.assertEqual(
+        [(4, (4, 0)), (5, (5, 0)), (3, (3, 1))], list(lru_dict.iteritems()))
+    self.assertEqual(3, len(lru_dict._keys))
+    self.assert_order(lru_dict, [4, 5, 3])
+
+
+class LRUDictJournalTest(unittest.TestCase):
+  def setUp(self):
+    super(LRUDictJournalTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    self.path = os.path.join(self.tempdir, u'state.json')
+    self.journal = self.path + lru.JOURNAL_SUFFIX
+    old = lru.JOURNAL_MIN_ITEMS
+    lru.JOURNAL_MIN_ITEMS = 3
+    self.addCleanup(setattr, lru, 'JOURNAL_MIN_ITEMS', old)
+
+  def tearDown(self):
+    try:
+      shutil.rmtree(self.tempdir)
+    finally:
+      super(LRUDictJournalTest, self).tearDown()
+
+  def save(self, keys):
+    lru_dict = LRUDictTest.prepare_lru_dict(keys)
+    lru_dict.save(self.path)
+    return lru.LRUDict.load(self.path)
+
+  def keys(self):
+    return list(lru.LRUDict.load(self.path))
+
+  def read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def test_append(self):
+    lru_dict = self.save([1, 2, 3, 4])
+    self.assertFalse(os.path.exists(self.journal))
+    state = self.read(self.path)
+    lru_dict.touch(1)
+    lru_dict.pop(2)
+    lru_dict.add(5, 5)
+    self.assertTrue(lru_dict.save(self.path))
+    # Only the journal was written.
+    self.assertEqual(state, self.read(self.path))
+    self.assertEqual(4, len(self.read(self.journal).splitlines()))
+    self.assertEqual([3, 4, 1, 5], self.keys())
+    lru_dict.pop(3)
+    lru_dict.save(self.path)
+    self.assertEqual([4, 1, 5], self.keys())
+
+  def test_compact(self):
+    lru_dict = self.save([1, 2, 3])
+    lru_dict.touch(1)
+    lru_dict.touch(2)
+    lru_dict.save(self.path)
+    self.assertTrue(os.path.exists(self.journal))
+    # The journal would have more records than the state has items.
+    lru_dict.touch(3)
+    lru_dict.touch(1)
+    lru_dict.save(self.path)
+    self.assertFalse(os.path.exists(self.journal))
+    self.assertEqual([2, 3, 1], self.keys())
+
+  def test_small(self):
+    # Small states are rewritten.
+    lru_dict = self.save([1, 2])
+    lru_dict.touch(1)
+    lru_dict.save(self.path)
+    self.assertFalse(os.path.exists(self.journal))
+    self.assertEqual([2, 1], self.keys())
+
+  def test_torn_record(self):
+    lru_dict = self.save([1, 2, 3])
+    lru_dict.touch(1)
+    lru_dict.save(self.path)
+    with open(self.journal, 'ab') as f:
+      f.write('["t",2,')
+    self.assertEqual([2, 3, 1], self.keys())
+    lru_dict = lru.LRUDict.load(self.path)
+    lru_dict.touch(2)
+    lru_dict.save(self.path)
+    self.assertEqual([3, 1, 2], self.keys())
+
+  def test_stale_journal(self):
+    # A journal of a previous version of the state file is ignored.
+    lru_dict = self.save([1, 2, 3])
+    lru_dict.touch(1)
+    lru_dict.save(self.path)
+    journal = self.read(self.journal)
+    self.save([1, 2, 3])
+    with open(self.journal, 'wb') as f:
+      f.write(journal)
+    self.assertEqual([1, 2, 3], self.keys())
+
+
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
   logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
@@ -162,6 +162,27 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(response.read(), response_body)
     self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
 
+  def test_request_PUT_streamed(self):
+    chunks = ['data', '_', 'body']
+    content_type = 'application/octet-stream'
+    attempts = []
+
+    def mock_perform_request(request):
+      attempts.append(request)
+      self.assertNotIn('Content-Length', request.headers)
+      self.assertEqual(request.headers['Content-Type'], content_type)
+      self.assertEqual('data_body', ''.join(request.body))
+      raise net.ConnectionError()
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    response = service.request(
+        '/some_request', data=(c for c in chunks), content_type=content_type,
+        method='PUT')
+    self.assertEqual(None, response)
+    # A generator can't be rewound, so the request is not retried.
+    self.assertEqual(1, len(attempts))
+    self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
+
   def test_request_success_after_failure(self):
     response = 'True'
     attempts = []
@@ -259,6 +280,52 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertTrue(service.request('/', data={}).read(), response)
     self.assertAttempts(2, net.URL_OPEN_TIMEOUT)
 
+  def test_request_HTTP_error_lowers_concurrency(self):
+    attempts = []
+
+    def mock_perform_request(request):
+      attempts.append(request)
+      if len(attempts) < 3:
+        raise net.HttpError(503, 'text/plain', None)
+      return net_utils.make_fake_response('response', request.get_full_url())
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    self.assertEqual(net.CONCURRENCY_INITIAL_LIMIT, service.concurrency.limit)
+    self.assertEqual('response', service.request('/').read())
+    # Each retry started after the limit was lowered, so it lowered it again.
+    self.assertEqual(
+        net.CONCURRENCY_INITIAL_LIMIT / 4, service.concurrency.limit)
+    self.assertEqual(0, service.concurrency.in_flight)
+
+  def test_request_stream_holds_slot(self):
+    # The slot of a streamed response is held until its body is read.
+    def mock_perform_request(request):
+      self.assertTrue(request.stream)
+      return net_utils.make_fake_response('response', request.get_full_url())
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    response = service.request('/', stream=True)
+    self.assertEqual(1, service.concurrency.in_flight)
+    self.assertEqual('response', ''.join(response.iter_content(3)))
+    self.assertEqual(0, service.concurrency.in_flight)
+    self.assertEqual(1, service.concurrency.requests)
+
+    # Also when the response is closed, or the body fails to be read.
+    response = service.request('/', stream=True)
+    response.close()
+    self.assertEqual(0, service.concurrency.in_flight)
+    response = service.request('/', stream=True)
+    def iter_content(_chunk_size):
+      raise net.TimeoutError()
+      yield # pylint: disable=unreachable
+    response._timeout_exc_classes = (net.TimeoutError,)
+    self.mock(response._response, 'iter_content', iter_content)
+    self.assertEqual(1, service.concurrency.in_flight)
+    with self.assertRaises(net.TimeoutError):
+      list(response.iter_content(3))
+    self.assertEqual(0, service.concurrency.in_flight)
+    self.assertEqual(1, service.concurrency.failures)
+
   def test_auth_success(self):
     calls = []
     response = 'response'
@@ -360,6 +427,74 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(['filepath'], removed)
 
 
+class ConcurrencyLimitTest(auto_stub.TestCase):
+  def setUp(self):
+    super(ConcurrencyLimitTest, self).setUp()
+    self.now = 100.
+    self.mock(net.time, 'time', lambda: self.now)
+
+  def test_increase_when_reached(self):
+    limit = net.ConcurrencyLimit(initial=2, maximum=3)
+    with limit.slot() as start:
+      limit.record(start, True, True)
+    # The limit wasn't reached.
+    self.assertEqual(2, limit.limit)
+    for _ in xrange(4):
+      with limit.slot() as start1:
+        with limit.slot() as start2:
+          limit.record(start1, True, True)
+          limit.record(start2, True, True)
+    self.assertEqual(3, limit.limit)
+
+  def test_decrease_once_per_round(self):
+    limit = net.ConcurrencyLimit(initial=8)
+    with limit.slot() as start1:
+      with limit.slot() as start2:
+        self.now += 1
+        limit.record(start1, False, True)
+        limit.record(start2, False, True)
+    self.assertEqual(4, limit.limit)
+    # Requests started after the decrease lower the limit again.
+    with limit.slot() as start:
+      limit.record(start, False, True)
+    self.assertEqual(2, limit.limit)
+    self.assertEqual((3, 3), (limit.requests, limit.failures))
+
+  def test_slow(self):
+    limit = net.ConcurrencyLimit(initial=1)
+    with limit.slot() as start:
+      self.now += 0.5
+      limit.record(start, True, True)
+    self.assertEqual(2, limit.limit)
+    with limit.slot() as start:
+      self.now += 5
+      limit.record(start, True, True)
+    # Slow requests hold the limit, unless the latency isn't measured.
+    self.assertEqual((2, 1), (limit.limit, limit.slow))
+    with limit.slot() as start:
+      with limit.slot() as start2:
+        self.now += 5
+        limit.record(start, True, False)
+        limit.record(start2, None, True)
+    self.assertEqual((2, 1), (limit.limit, limit.slow))
+    self.assertEqual(3, limit.requests)
+
+  def test_set_pool_size(self):
+    engine = net.RequestsLibEngine()
+    sizes = []
+    cleared = []
+    for connections in (1, 5, 8, 9, 1000):
+      poolmanager = engine.session.get_adapter('https://localhost').poolmanager
+      self.mock(poolmanager, 'clear', lambda: cleared.append(True))
+      engine.set_pool_size(connections)
+      sizes.append(
+          engine.session.get_adapter('https://localhost').poolmanager
+              .connection_pool_kw['maxsize'])
+    self.assertEqual([4, 8, 8, 16, 64], sizes)
+    # The pools replaced may still be in use, they are left to drain.
+    self.assertEqual([], cleared)
+
+
 class TestNetFunctions(auto_stub.TestCase):
   def test_fix_url(self):
     data = [
@@ -334,6 +334,8 @@ class RunIsolatedTest(unittest.TestCase):
     # different names and ensure both are created.
     isolated_hash = self._store('repeated_files.isolated')
     expected = [
+      'integrity.journal',
+      os.path.join('locks', 'state.lock'),
       'state.json',
       isolated_hash,
       self._store('file1.txt'),
@@ -352,6 +354,8 @@ class RunIsolatedTest(unittest.TestCase):
     # MAX_PATH.
     isolated_hash = self._store('max_path.isolated')
     expected = [
+      'integrity.journal',
+      os.path.join('locks', 'state.lock'),
       'state.json',
       isolated_hash,
       self._store('file1.txt'),
@@ -366,7 +370,10 @@ class RunIsolatedTest(unittest.TestCase):
 
   def test_fail_empty_isolated(self):
     isolated_hash = self._store_isolated({})
-    expected = ['state.json', isolated_hash]
+    expected = [
+        'integrity.journal', os.path.join('locks', 'state.lock'), 'state.json',
+        isolated_hash,
+    ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', out)
     self.assertIn(
@@ -384,6 +391,8 @@ class RunIsolatedTest(unittest.TestCase):
     # as file2.txt.
     isolated_hash = self._store('check_files.isolated')
     expected = [
+      'integrity.journal',
+      os.path.join('locks', 'state.lock'),
       'state.json',
       isolated_hash,
       self._store('check_files.py'),
@@ -407,6 +416,8 @@ class RunIsolatedTest(unittest.TestCase):
     # Loads an .isolated that includes an ar archive.
     isolated_hash = self._store('ar_archive.isolated')
     expected = [
+      'integrity.journal',
+      os.path.join('locks', 'state.lock'),
       'state.json',
       isolated_hash,
       self._store('ar_archive'),
@@ -423,6 +434,8 @@ class RunIsolatedTest(unittest.TestCase):
     # Loads an .isolated that includes an ar archive.
     isolated_hash = self._store('tar_archive.isolated')
     expected = [
+      'integrity.journal',
+      os.path.join('locks', 'state.lock'),
       'state.json',
       isolated_hash,
       self._store('tar_archive'),
@@ -435,7 +448,7 @@ class RunIsolatedTest(unittest.TestCase):
     actual = list_files_tree(self.cache)
     self.assertEqual(sorted(expected), actual)
 
-  def _test_corruption_common(self, new_content):
+  def _test_corruption_common(self, new_content, *args):
     isolated_hash = self._store('file_with_size.isolated')
     file1_hash = self._store('file1.txt')
 
@@ -444,6 +457,9 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       u'.': (040700, 040700, 040777),
+      u'locks': (040700, 040700, 040777),
+      u'integrity.journal': (0100600, 0100600, 0100666),
+      os.path.join(u'locks', u'state.lock'): (0100600, 0100600, 0100666),
       u'state.json': (0100600, 0100600, 0100666),
       # The reason for 0100666 on Windows is that the file node had to be
       # modified to delete the hardlinked node. The read only bit is reset on
@@ -464,10 +480,14 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertNotEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
 
     # Rerun the test and make sure the cache contains the right file afterwards.
-    out, err, returncode = self._run(self._cmd_args(isolated_hash))
+    out, err, returncode = self._run(
+        self._cmd_args(isolated_hash) + list(args))
     self.assertEqual(0, returncode, (out, err, returncode))
     expected = {
       u'.': (040700, 040700, 040777),
+      u'locks': (040700, 040700, 040777),
+      u'integrity.journal': (0100600, 0100600, 0100666),
+      os.path.join(u'locks', u'state.lock'): (0100600, 0100600, 0100666),
       u'state.json': (0100600, 0100600, 0100666),
       unicode(file1_hash): (0100400, 0100400, 0100666),
       unicode(isolated_hash): (0100400, 0100400, 0100444),
@@ -483,13 +503,12 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
 
   def test_corrupted_cache_entry_same_size(self):
-    # Test that an entry with an invalid file content but same size is NOT
-    # detected property.
+    # Test that an entry with an invalid file content but same size is detected
+    # when the cache is cleaned up with --verify-cache, since it was written by
+    # the previous run.
     cached_file_path = self._test_corruption_common(
-        CONTENTS['file1.txt'][:-1] + ' ')
-    # TODO(maruel): This corruption is NOT detected.
-    # This needs to be fixed.
-    self.assertNotEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
+        CONTENTS['file1.txt'][:-1] + ' ', '--verify-cache')
+    self.assertEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
 
 
 if __name__ == '__main__':
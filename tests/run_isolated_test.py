@@ -67,6 +67,28 @@ def genTree(path):
   return out
 
 
+def genTreeWithState(path):
+  """Returns genTree(path), with the items listed in state.json as the content
+  of state.json, as [key, [value, timestamp]] pairs from oldest to newest.
+
+  The content of integrity.journal, if any, is replaced by the sorted list of
+  the items left to verify it lists.
+  """
+  out = genTree(path)
+  state = json.loads(out[u'state.json'])
+  out[u'state.json'] = [
+    [k, [v, t]] for k, v, t in zip(
+        state['keys'], state['values'], state['timestamps'])
+  ]
+  if u'integrity.journal' in out:
+    lines = out[u'integrity.journal'].splitlines()
+    header = json.loads(lines[0]) if lines[0] else {}
+    out[u'integrity.journal'] = sorted(
+        set(header.get('unverified', []) + [l.lstrip('+') for l in lines[1:]])
+        - {''})
+  return out
+
+
 @contextlib.contextmanager
 def init_named_caches_stub(_run_dir):
   yield
@@ -101,13 +123,14 @@ class StorageFake(object):
   def hash_algo(self):
     return isolateserver_mock.ALGO
 
-  def async_fetch(self, channel, _priority, digest, _size, sink):
+  def async_fetch(
+      self, channel, _priority, digest, _size, sink, _partial=None, _move=None):
     sink([self._files[digest]])
     channel.send_result(digest)
 
   def upload_items(self, items_to_upload):
     # Return all except the first one.
-    return items_to_upload[1:]
+    return list(items_to_upload)[1:]
 
 
 class RunIsolatedTestBase(auto_stub.TestCase):
@@ -201,7 +224,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
           'command': ['foo.exe', 'cmd with space'],
         })
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, _presence_cache=None):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -223,7 +246,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
     self.mock(tools, 'disable_buffering', lambda: None)
     isolated = json_dumps({'command': ['foo.exe', 'cmd w/ space']})
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, _presence_cache=None):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -365,7 +388,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
     self.mock(tools, 'disable_buffering', lambda: None)
     isolated = json_dumps({'command': ['invalid', 'command']})
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, _presence_cache=None):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -534,7 +557,9 @@ class RunIsolatedTest(RunIsolatedTestBase):
         os.path.join(cipd_cache, 'cache'))
 
     # Test cipd client cache. `git:wowza` was a tag and so is cacheable.
-    self.assertEqual(len(os.listdir(os.path.join(cipd_cache, 'versions'))), 2)
+    versions = set(os.listdir(os.path.join(cipd_cache, 'versions')))
+    versions -= {'integrity.journal', 'locks', 'state.json'}
+    self.assertEqual({'633d2aa4119cc66803f1600f9c4d85ce0e0581b5'}, versions)
     version_file = unicode(os.path.join(
         cipd_cache, 'versions', '633d2aa4119cc66803f1600f9c4d85ce0e0581b5'))
     self.assertTrue(fs.isfile(version_file))
@@ -689,7 +714,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
       put_to_named_cache(named_cache_manager, u'second', u'small', small)
 
     # Ensures the cache contain the expected data.
-    actual = genTree(np)
+    actual = genTreeWithState(np)
     # Figure out the cache path names.
     cache_small = [
         os.path.dirname(n) for n in actual if os.path.basename(n) == 'small'][0]
@@ -698,19 +723,17 @@ class RunIsolatedTest(RunIsolatedTestBase):
     expected = {
       os.path.join(cache_small, u'small'): small,
       os.path.join(cache_big, u'big'): big,
-      u'state.json':
-          '{"items":[["first",["%s",1]],["second",["%s",3]]],"version":2}' % (
-          cache_big, cache_small),
+      u'state.json': [['first', [cache_big, 1]], ['second', [cache_small, 3]]],
     }
     self.assertEqual(expected, actual)
     expected = {
       big_digest: big,
       small_digest: small,
-      u'state.json':
-          '{"items":[["%s",[10140,1]],["%s",[10,2]]],"version":2}' % (
-          big_digest, small_digest),
+      u'integrity.journal': sorted([big_digest, small_digest]),
+      os.path.join(u'locks', u'state.lock'): '',
+      u'state.json': [[big_digest, [10140, 1]], [small_digest, [10, 2]]],
     }
-    self.assertEqual(expected, genTree(ip))
+    self.assertEqual(expected, genTreeWithState(ip))
 
     # Request triming.
     fake_free_space[0] = 1020
@@ -731,19 +754,19 @@ class RunIsolatedTest(RunIsolatedTestBase):
     # - file_path.get_free_space() is mocked
     # - DiskCache.trim() keeps its own internal counter while deleting files so
     #   it ignores get_free_space() output while deleting files.
-    actual = genTree(np)
+    actual = genTreeWithState(np)
     expected = {
       os.path.join(cache_small, u'small'): small,
-      u'state.json':
-          '{"items":[["second",["%s",3]]],"version":2}' % cache_small,
+      u'state.json': [['second', [cache_small, 3]]],
     }
     self.assertEqual(expected, actual)
     expected = {
       small_digest: small,
-      u'state.json':
-          '{"items":[["%s",[10,2]]],"version":2}' % small_digest,
+      u'integrity.journal': [small_digest],
+      os.path.join(u'locks', u'state.lock'): '',
+      u'state.json': [[small_digest, [10, 2]]],
     }
-    self.assertEqual(expected, genTree(ip))
+    self.assertEqual(expected, genTreeWithState(ip))
 
 
 class RunIsolatedTestRun(RunIsolatedTestBase):
@@ -994,7 +1017,7 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     ]
     isolated_in_json = json_dumps({'command': sub_cmd})
     isolated_in_hash = isolateserver_mock.hash_content(isolated_in_json)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, _presence_cache=None):
       return StorageFake({isolated_in_hash:isolated_in_json})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -611,6 +611,84 @@ class TaskChannelTest(unittest.TestCase):
         channel.pull()
 
 
+class MemoryBudgetTest(unittest.TestCase):
+  def test_fifo(self):
+    budget = threading_utils.MemoryBudget(100)
+    budget.acquire(60)
+    order = []
+    def acquire(name, size):
+      budget.acquire(size)
+      order.append(name)
+    with threading_utils.ThreadPool(2, 2, 0) as tp:
+      tp.add_task(0, acquire, 'large', 80)
+      # Wait for 'large' to be queued.
+      while not budget._waiters:
+        time.sleep(0.001)
+      tp.add_task(0, acquire, 'small', 10)
+      time.sleep(0.05)
+      # 'small' fits but doesn't get ahead of 'large'.
+      self.assertEqual([], order)
+      budget.release(60)
+      tp.join()
+    self.assertEqual(['large', 'small'], order)
+    self.assertEqual(90, budget.used)
+    self.assertEqual(90, budget.peak)
+    self.assertLess(0, budget.waited)
+
+  def test_oversized(self):
+    budget = threading_utils.MemoryBudget(100)
+    # Granted since nothing else is held.
+    with budget.reserve(1000):
+      self.assertEqual(1000, budget.used)
+      # Already in memory, accounted for without waiting.
+      with budget.reserve(10, wait=False):
+        self.assertEqual(1010, budget.used)
+    self.assertEqual(0, budget.used)
+    self.assertEqual(1010, budget.peak)
+
+
+class PipeTest(unittest.TestCase):
+  def test_stream(self):
+    pipe = threading_utils.Pipe(2)
+    def write():
+      for i in xrange(10):
+        pipe.put(i)
+        # Never more than 2 chunks are queued.
+        self.assertLessEqual(len(pipe._chunks), 2)
+      pipe.close()
+    with threading_utils.ThreadPool(1, 1, 0) as tp:
+      tp.add_task(0, write)
+      self.assertEqual(range(10), list(pipe))
+      tp.join()
+
+  def test_close_exception(self):
+    class CustomError(Exception):
+      pass
+    pipe = threading_utils.Pipe(10)
+    pipe.put(0)
+    try:
+      raise CustomError()
+    except CustomError:
+      pipe.close(sys.exc_info())
+    actual = []
+    with self.assertRaises(CustomError):
+      for chunk in pipe:
+        actual.append(chunk)
+    self.assertEqual([0], actual)
+
+  def test_abort(self):
+    pipe = threading_utils.Pipe(1)
+    pipe.put(0)
+    with threading_utils.ThreadPool(1, 1, 0) as tp:
+      channel = threading_utils.TaskChannel()
+      tp.add_task(0, channel.wrap_task(pipe.put), 1)
+      with self.assertRaises(threading_utils.TaskChannel.Timeout):
+        channel.pull(timeout=0.01)
+      pipe.abort()
+      with self.assertRaises(threading_utils.Pipe.Aborted):
+        channel.pull()
+
+
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
   logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Compares fetching a large item over one connection with fetching it in
+parallel ranges.
+
+Runs against the fake isolate server in tests/isolateserver_mock.py, so it
+measures the client side overhead more than the network.
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+
+from third_party.depot_tools import fix_encoding
+from utils import file_path
+from utils import tools
+
+import isolateserver
+import isolateserver_mock
+
+
+def fetch(storage, item, cache_dir):
+  """Fetches |item| into a new DiskCache and returns the time it took."""
+  policies = isolateserver.CachePolicies(0, 0, 0)
+  start = time.time()
+  with isolateserver.DiskCache(
+      cache_dir, policies, storage.hash_algo, trim=False) as cache:
+    queue = isolateserver.FetchQueue(storage, cache)
+    queue.add(item.digest, item.size)
+    queue.wait([item.digest])
+  return time.time() - start
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '-s', '--size', type='int', default=256,
+      help='Size of the item to fetch in mb, default: %default')
+  parser.add_option(
+      '-c', '--connections', type='int',
+      default=isolateserver.PARALLEL_FETCH_CONNECTIONS,
+      help='Number of parallel connections, default: %default')
+  parser.add_option(
+      '-r', '--range-size', type='int',
+      default=isolateserver.PARALLEL_FETCH_RANGE_SIZE / 1024 / 1024,
+      help='Size of each range in mb, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  isolateserver.RESUMABLE_FETCH_MIN_SIZE = 0
+  isolateserver.PARALLEL_FETCH_CONNECTIONS = options.connections
+  isolateserver.PARALLEL_FETCH_RANGE_SIZE = options.range_size * 1024 * 1024
+
+  server = isolateserver_mock.MockIsolateServer()
+  temp_dir = tempfile.mkdtemp(prefix=u'fetch_benchmark')
+  try:
+    storage = isolateserver.get_storage(server.url, 'default')
+    item = isolateserver.BufferItem(os.urandom(1024*1024) * options.size)
+    storage.upload_items([item])
+
+    isolateserver.PARALLEL_FETCH_MIN_SIZE = item.size + 1
+    single = fetch(storage, item, os.path.join(temp_dir, u'single'))
+    isolateserver.PARALLEL_FETCH_MIN_SIZE = 0
+    ranges = fetch(storage, item, os.path.join(temp_dir, u'ranges'))
+
+    print('Item size: %dmb' % options.size)
+    print('Single connection: %6.3fs' % single)
+    print('%d connections, %dmb ranges: %6.3fs' % (
+        options.connections, options.range_size, ranges))
+  finally:
+    file_path.rmtree(temp_dir)
+    server.close()
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Compares compressing a large item with zip_compress() with compressing it in
+parallel blocks with parallel_zip_compress().
+
+The data is generated to be about as compressible as an executable.
+"""
+
+import optparse
+import os
+import sys
+import time
+import zlib
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+from utils import threading_utils
+from utils import tools
+
+import isolateserver
+
+
+def gen_data(size):
+  """Returns |size| mb of data with about 5 bits of entropy per byte."""
+  block = ''.join(chr(ord(c) % 32) for c in os.urandom(1024*1024))
+  return block * size
+
+
+def chunks(data, chunk_size=1024*1024):
+  for i in xrange(0, len(data), chunk_size):
+    yield data[i:i+chunk_size]
+
+
+def measure(data, compress):
+  """Returns tuple(duration, compressed data) of compress(chunks(data))."""
+  start = time.time()
+  compressed = ''.join(compress(chunks(data)))
+  duration = time.time() - start
+  assert zlib.decompress(compressed) == data
+  return duration, compressed
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '-s', '--size', type='int', default=256,
+      help='Size of the item to compress in mb, default: %default')
+  parser.add_option(
+      '-l', '--level', type='int', default=7,
+      help='zlib compression level, default: %default')
+  parser.add_option(
+      '-b', '--block-size', type='int',
+      default=isolateserver.PARALLEL_COMPRESSION_BLOCK_SIZE / 1024,
+      help='Size of each parallel block in kb, default: %default')
+  parser.add_option(
+      '-t', '--threads', type='int',
+      default=threading_utils.num_processors(),
+      help='Number of threads, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  data = gen_data(options.size)
+  pool = threading_utils.ThreadPool(options.threads, options.threads, 0, 'zip')
+  try:
+    single, single_data = measure(
+        data, lambda c: isolateserver.zip_compress(c, options.level))
+    parallel, parallel_data = measure(
+        data, lambda c: isolateserver.parallel_zip_compress(
+            c, options.level, pool, options.block_size * 1024))
+  finally:
+    pool.close()
+
+  size = len(data) / 1024. / 1024.
+  print('Item size: %dmb, level %d' % (options.size, options.level))
+  print('zip_compress:          %6.3fs, %7.1fmb/s, %6.2f%%' % (
+      single, size / single, len(single_data) * 100. / len(data)))
+  print('parallel_zip_compress: %6.3fs, %7.1fmb/s, %6.2f%% (%d threads, %dkb '
+        'blocks)' % (
+      parallel, size / parallel, len(parallel_data) * 100. / len(data),
+      options.threads, options.block_size))
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
@@ -0,0 +1,130 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Exclusive locks on files, held across processes."""
+
+import errno
+import os
+import sys
+
+from utils import fs
+
+if sys.platform == 'win32':
+  import msvcrt  # pylint: disable=F0401
+else:
+  import fcntl  # pylint: disable=F0401
+
+
+# Offset of the byte locked on Windows. It is past the content of any file
+# locked, so other processes can still read the file while it is locked.
+_WIN_LOCK_OFFSET = 0x7ffffffe
+
+
+def _lock(f, blocking):
+  """Locks the open file |f|, returns False if it is locked elsewhere."""
+  if sys.platform == 'win32':
+    f.seek(_WIN_LOCK_OFFSET)
+    mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+    while True:
+      try:
+        msvcrt.locking(f.fileno(), mode, 1)
+        return True
+      except IOError as e:
+        if e.errno not in (errno.EACCES, errno.EDEADLK):
+          raise
+        if not blocking:
+          return False
+        # LK_LOCK gives up after 10 seconds, keep waiting.
+  flags = fcntl.LOCK_EX
+  if not blocking:
+    flags |= fcntl.LOCK_NB
+  try:
+    fcntl.flock(f.fileno(), flags)
+  except IOError as e:
+    if blocking or e.errno not in (errno.EACCES, errno.EAGAIN):
+      raise
+    return False
+  return True
+
+
+def _unlock(f):
+  if sys.platform == 'win32':
+    f.seek(_WIN_LOCK_OFFSET)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+  else:
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class FileLock(object):
+  """Exclusive lock on a file, across processes.
+
+  The file is created if it doesn't exist. It stays open until close() so the
+  lock can be taken again cheaply. The lock is released when the process dies.
+
+  Not thread safe. Can be used as a context manager, it then waits for the lock.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._f = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.release()
+    return False
+
+  @property
+  def file(self):
+    """The file opened in append mode, None before acquire()."""
+    return self._f
+
+  def acquire(self, blocking=True):
+    """Takes the lock.
+
+    Returns False if another process holds it and |blocking| is False.
+    """
+    while True:
+      if not self._f:
+        self._f = fs.open(self.path, 'ab')
+      if not _lock(self._f, blocking):
+        return False
+      if self._is_current():
+        return True
+      # The owner deleted the file in release() while this process was waiting
+      # for it, and another process may have locked a new file since.
+      self.close()
+
+  def release(self, delete=False):
+    """Releases the lock. If |delete|, also deletes the file and closes it."""
+    if delete and sys.platform != 'win32':
+      # Deleted before it is unlocked, so processes waiting for it notice.
+      try:
+        fs.remove(self.path)
+      except OSError:
+        pass
+    _unlock(self._f)
+    if delete:
+      self.close()
+      if sys.platform == 'win32':
+        # Fails if another process has it open, it then uses it.
+        try:
+          fs.remove(self.path)
+        except OSError:
+          pass
+
+  def close(self):
+    """Closes the file, which releases the lock if held."""
+    if self._f:
+      self._f.close()
+      self._f = None
+
+  def _is_current(self):
+    """Returns True if the open file is still the one at |path|."""
+    try:
+      return os.fstat(self._f.fileno()).st_ino == fs.stat(self.path).st_ino
+    except OSError:
+      return False
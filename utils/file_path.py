@@ -9,6 +9,7 @@ is running and thus it caches results of functions that depend on FS state.
 """
 
 import ctypes
+import errno
 import getpass
 import logging
 import os
@@ -27,8 +28,8 @@ from utils import tools
 
 
 # Types of action accepted by link_file().
-HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, SYMLINK_WITH_FALLBACK, COPY = range(
-    1, 6)
+(HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, SYMLINK_WITH_FALLBACK, COPY,
+ REFLINK_WITH_FALLBACK) = range(1, 7)
 
 
 ## OS-specific imports
@@ -42,6 +43,19 @@ if sys.platform == 'win32':
 elif sys.platform == 'darwin':
   import Carbon.File  #  pylint: disable=F0401
   import MacOS  # pylint: disable=F0401
+elif sys.platform.startswith('linux'):
+  import fcntl
+
+
+# ioctl() making a file share the data blocks of another one, from linux/fs.h.
+_FICLONE = 0x40049409
+
+# errno values meaning that a filesystem doesn't implement FICLONE.
+_REFLINK_UNSUPPORTED = (
+    errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP)
+
+# Whether reflink() works, keyed by the st_dev of the filesystem.
+_REFLINK_SUPPORT = {}
 
 
 if sys.platform == 'win32':
@@ -862,12 +876,86 @@ def hardlink(source, link_name):
     fs.link(source, link_name)
 
 
+def reflink(source, link_name):
+  """Makes |link_name| a copy-on-write clone of |source|, like fs.copy2().
+
+  Both files share their data blocks until one of them is modified. Only
+  supported on Linux, by filesystems implementing FICLONE like btrfs and XFS.
+  Raises OSError otherwise, |link_name| is not left behind.
+  """
+  assert isinstance(source, unicode), source
+  assert isinstance(link_name, unicode), link_name
+  if not sys.platform.startswith('linux'):
+    raise OSError(errno.EOPNOTSUPP, 'reflink is only supported on Linux')
+  with fs.open(source, 'rb') as src:
+    fd = os.open(
+        fs.extend(link_name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+      fcntl.ioctl(fd, _FICLONE, src.fileno())
+    except IOError as e:
+      os.close(fd)
+      fs.remove(link_name)
+      raise OSError(e.errno, e.strerror, link_name)
+    os.close(fd)
+    st = os.fstat(src.fileno())
+  fs.chmod(link_name, stat.S_IMODE(st.st_mode))
+  fs.utime(link_name, (st.st_atime, st.st_mtime))
+
+
+def can_reflink(path):
+  """Returns True if reflink() works for the files in directory |path|.
+
+  The filesystem is probed once by cloning a temporary file, so |path| must be
+  writable.
+  """
+  if not sys.platform.startswith('linux'):
+    return False
+  dev = fs.stat(path).st_dev
+  if dev not in _REFLINK_SUPPORT:
+    try:
+      handle, probe = tempfile.mkstemp(prefix=u'reflink', dir=path)
+    except OSError as e:
+      logging.warning('Failed to probe reflink in %s: %s', path, e)
+      return False
+    try:
+      os.write(handle, 'x')
+      os.close(handle)
+      _try_reflink(probe, probe + u'.clone', dev)
+    finally:
+      try_remove(probe)
+      try_remove(probe + u'.clone')
+  return _REFLINK_SUPPORT.get(dev, False)
+
+
+def _try_reflink(source, link_name, dev):
+  """Calls reflink() unless the filesystem |dev| is known not to support it.
+
+  Returns True on success. Records whether the filesystem supports it.
+  """
+  if _REFLINK_SUPPORT.get(dev) is False:
+    return False
+  try:
+    reflink(source, link_name)
+  except OSError as e:
+    if e.errno in _REFLINK_UNSUPPORTED:
+      _REFLINK_SUPPORT[dev] = False
+    else:
+      # EXDEV, the files are on two filesystems, says nothing about |dev|.
+      logging.debug('Failed to reflink %s to %s: %s', source, link_name, e)
+    return False
+  _REFLINK_SUPPORT[dev] = True
+  return True
+
+
 def readable_copy(outfile, infile):
   """Makes a copy of the file that is readable by everyone."""
   fs.copy2(infile, outfile)
+  _make_readable(outfile)
+
+
+def _make_readable(path):
   fs.chmod(
-      outfile,
-      fs.stat(outfile).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      path, fs.stat(path).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
 
 def set_read_only(path, read_only):
@@ -932,7 +1020,7 @@ def link_file(outfile, infile, action):
   Returns:
     True if the action was carried on, False if fallback was used.
   """
-  if action < 1 or action > COPY:
+  if action < 1 or action > REFLINK_WITH_FALLBACK:
     raise ValueError('Unknown mapping action %s' % action)
   # TODO(maruel): Skip these checks.
   if not fs.isfile(infile):
@@ -946,6 +1034,16 @@ def link_file(outfile, infile, action):
     readable_copy(outfile, infile)
     return True
 
+  if action == REFLINK_WITH_FALLBACK:
+    # The first clone on a filesystem tells if it supports it.
+    if sys.platform.startswith('linux') and _try_reflink(
+        infile, outfile, fs.stat(infile).st_dev):
+      _make_readable(outfile)
+      return True
+    # Signal caller that fallback copy was used.
+    readable_copy(outfile, infile)
+    return False
+
   if action in (SYMLINK, SYMLINK_WITH_FALLBACK):
     try:
       fs.symlink(infile, outfile)  # pylint: disable=E1101
@@ -1020,7 +1118,12 @@ def atomic_replace(path, body):
 def ensure_tree(path, perm=0777):
   """Ensures a directory exists."""
   if not fs.isdir(path):
-    fs.makedirs(path, perm)
+    try:
+      fs.makedirs(path, perm)
+    except OSError as e:
+      # Another thread or process may have created it meanwhile.
+      if e.errno != errno.EEXIST or not fs.isdir(path):
+        raise
 
 
 def make_tree_read_only(root):
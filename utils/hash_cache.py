@@ -0,0 +1,91 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Persistent cache of file digests, shared by all the processes of a machine.
+
+Files are identified by (device, inode, size, mtime in ns). When none of these
+changed since the file was last hashed, its content is assumed to be the same,
+the same way 'make' or 'git status' do. The cache is a json file that multiple
+processes can read and update concurrently.
+"""
+
+import threading
+import time
+
+from utils import fs
+from utils import shared_lru
+
+
+# Default maximum number of digests kept in the cache file.
+DEFAULT_MAX_ITEMS = 100000
+
+# Files modified less than this number of seconds before they were hashed are
+# not cached. Their mtime could be updated again within the file system
+# timestamp granularity without the file stats changing.
+RACY_DELAY = 2.
+
+
+def _stats_key(algo, stats):
+  """Returns the cache key of a file for the hashing algorithm |algo|."""
+  mtime_ns = getattr(stats, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(round(stats.st_mtime * 1000000000))
+  return '%s:%d:%d:%d:%d' % (
+      algo().name, stats.st_dev, stats.st_ino, stats.st_size, mtime_ns)
+
+
+class HashCache(object):
+  """Digests of files on the local disk, saved to a json file.
+
+  Thread safe. Can be used as a context manager, the new digests are then saved
+  on exit. See shared_lru.SharedLRUDict for how concurrent processes update it.
+  """
+
+  def __init__(self, path, max_items=DEFAULT_MAX_ITEMS):
+    self._digests = shared_lru.SharedLRUDict(path, max_items)
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  @property
+  def path(self):
+    return self._digests.path
+
+  def get(self, algo, stats):
+    """Returns the digest of the file with os.stat() result |stats| or None."""
+    digest = self._digests.get(_stats_key(algo, stats))
+    with self._lock:
+      if digest:
+        self.hits += 1
+      else:
+        self.misses += 1
+    return digest
+
+  def add(self, algo, filepath, stats, digest):
+    """Saves the |digest| of |filepath| that was computed after its |stats|.
+
+    Nothing is saved if the file changed while it was hashed or if it was
+    modified too recently for its stats to reliably identify its content.
+    """
+    try:
+      now = fs.stat(filepath)
+    except OSError:
+      return
+    key = _stats_key(algo, stats)
+    if _stats_key(algo, now) != key:
+      return
+    if time.time() - stats.st_mtime < RACY_DELAY:
+      return
+    self._digests.add(key, digest)
+
+  def save(self):
+    """Merges the new digests into the file at |path|."""
+    self._digests.save()
@@ -4,19 +4,43 @@
 
 """Defines a dictionary that can evict least recently used items."""
 
-import collections
+import array
+import itertools
 import json
+import os
+import sys
 import time
 
 
+# Suffix of the file next to a state file that logs the changes made since the
+# state file was written.
+JOURNAL_SUFFIX = u'.journal'
+
+# States with fewer items than this are rewritten as a whole when saved, it is
+# as cheap as appending to a journal.
+JOURNAL_MIN_ITEMS = 10000
+
+# Slot of no item, ends the linked list of items.
+_NONE = -1
+
+# Types of the values added to LRUDict.total.
+_NUMBERS = (int, long, float)
+
+
 class LRUDict(object):
   """Dictionary that can evict least recently used items.
 
-  Implemented as a wrapper around OrderedDict object. An OrderedDict stores
-  (key, (value, timestamp)) pairs in order they are
-  inserted and can effectively pop oldest items.
-
-  Can also store its state as *.json file on disk.
+  The items are a doubly linked list, oldest first. It is stored in parallel
+  arrays indexed by slot rather than as python objects per item, so a dict with
+  millions of items stays compact. Adding, touching and popping items and
+  getting the oldest one are O(1). So is the total of the values that are
+  numbers, e.g. sizes.
+
+  Can also store its state as *.json file on disk. Large states are not
+  rewritten every time they are saved, the changes are appended to a journal
+  file instead, as one json list per line. The state file is rewritten once the
+  journal has more records than the state has items, so loading stays linear
+  with the number of items.
   """
 
   # Used to determine current timestamp.
@@ -24,31 +48,59 @@ class LRUDict(object):
   time_fn = time.time
 
   def __init__(self):
-    # Ordered key -> (value, timestamp) mapping,
-    # newest items at the bottom.
-    self._items = collections.OrderedDict()
+    # key -> slot of the item.
+    self._slots = {}
+    # Per slot: the key, value and timestamp of the item and the slots of the
+    # previous (older) and next (newer) items.
+    self._keys = []
+    self._values = []
+    self._timestamps = array.array('d')
+    self._prev = array.array('l')
+    self._next = array.array('l')
+    # Slots freed by pop(), reused by add().
+    self._free = []
+    # Slots of the oldest and newest items.
+    self._oldest = _NONE
+    self._newest = _NONE
+    # Sum of the values that are numbers.
+    self._total = 0
     # True if was modified after loading.
     self._dirty = True
+    # Changes since loading or saving, as journal records: ('a', key, value,
+    # timestamp), ('t', key, timestamp) or ('p', key).
+    self._changes = []
+    # The state file last loaded or saved, the id that pairs it with its
+    # journal and the number of records in the journal, None if there is no
+    # valid journal.
+    self._state_file = None
+    self._journal_id = None
+    self._journal_records = None
 
   def __nonzero__(self):
     """False if dict is empty."""
-    return bool(self._items)
+    return bool(self._slots)
 
   def __iter__(self):
-    """Iterate over the keys."""
-    return self._items.__iter__()
+    """Iterate over the keys, oldest first."""
+    for key, _ in self.iteritems():
+      yield key
 
   def __len__(self):
     """Number of items in the dict."""
-    return len(self._items)
+    return len(self._slots)
 
   def __contains__(self, key):
     """True if |key| is in the dict."""
-    return key in self._items
+    return key in self._slots
 
   def __getitem__(self, key):
     """Returns value for |key| or raises KeyError if not found."""
-    return self._items[key][0]
+    return self._values[self._slots[key]]
+
+  @property
+  def total(self):
+    """Sum of the values that are numbers."""
+    return self._total
 
   @classmethod
   def load(cls, state_file):
@@ -68,12 +120,11 @@ class LRUDict(object):
         if not isinstance(pair, (list, tuple)) or len(pair) != 2:
           raise ValueError(
               'Broken state file %s, expecting pairs: %s' % (state_file, pair))
-        lru._items[pair[0]] = (pair[1], 0)
-
-      # Check for duplicate keys.
-      if len(lru) != len(state):
-        raise ValueError(
-            'Broken state file %s, found duplicate keys' % (state_file,))
+        # Check for duplicate keys.
+        if pair[0] in lru:
+          raise ValueError(
+              'Broken state file %s, found duplicate keys' % (state_file,))
+        lru._link(pair[0], pair[1], 0)
 
     elif isinstance(state, dict):  # New format.
       state_ver = state.get('version')
@@ -81,10 +132,15 @@ class LRUDict(object):
         raise ValueError(
             'Broken state file %s, version %r is not an integer' % (
               state_file, state_ver))
-      if state_ver > 2:
+      if state_ver > 3:
         raise ValueError(
             'Unsupported state file %s, version is %d. '
-            'Latest supported is 2' % (state_file, state_ver))
+            'Latest supported is 3' % (state_file, state_ver))
+      if state_ver == 3:
+        lru = cls._load_columns(state_file, state)
+        lru._replay_journal(state_file)
+        lru._dirty = False
+        return lru
       state_items = state.get('items')
       if not isinstance(state_items, list):
         raise ValueError(
@@ -103,12 +159,11 @@ class LRUDict(object):
           raise ValueError(
               'Broken state file %s, expecting second item of the second item '
               'to be a number: %s' % (state_file, item))
-        lru._items[item[0]] = item[1]
-
-      # Check for duplicate keys.
-      if len(lru) != len(state_items):
-        raise ValueError(
-            'Broken state file %s, found duplicate keys' % (state_file,))
+        # Check for duplicate keys.
+        if item[0] in lru:
+          raise ValueError(
+              'Broken state file %s, found duplicate keys' % (state_file,))
+        lru._link(item[0], item[1][0], item[1][1])
 
     else:
       raise ValueError(
@@ -118,49 +173,217 @@ class LRUDict(object):
     lru._dirty = False
     return lru
 
+  @classmethod
+  def _load_columns(cls, state_file, state):
+    """Returns the LRUDict of a version 3 state.
+
+    The keys, values and timestamps are in separate lists, in the order of the
+    slots, so the arrays are filled without running python code for each item.
+    """
+    columns = [state.get(k) for k in ('keys', 'values', 'timestamps')]
+    if (not all(isinstance(c, list) for c in columns) or
+        len(set(len(c) for c in columns)) != 1):
+      raise ValueError(
+          'Broken state file %s, expecting keys, values and timestamps lists '
+          'of the same length' % (state_file,))
+    lru = cls()
+    keys, values, timestamps = columns
+    try:
+      lru._timestamps = array.array('d', timestamps)
+    except TypeError:
+      raise ValueError(
+          'Broken state file %s, timestamps should be numbers' % (state_file,))
+    lru._slots = dict(itertools.izip(keys, xrange(len(keys))))
+    # Check for duplicate keys.
+    if len(lru) != len(keys):
+      raise ValueError(
+          'Broken state file %s, found duplicate keys' % (state_file,))
+    lru._keys = keys
+    lru._values = values
+    lru._prev = array.array('l', xrange(_NONE, len(keys) - 1))
+    lru._next = array.array('l', xrange(1, len(keys) + 1))
+    if keys:
+      lru._next[-1] = _NONE
+      lru._oldest = 0
+      lru._newest = len(keys) - 1
+    try:
+      lru._total = sum(values)
+    except TypeError:
+      lru._total = sum(v for v in values if isinstance(v, _NUMBERS))
+    lru._state_file = state_file
+    lru._journal_id = state.get('journal')
+    return lru
+
+  def _replay_journal(self, state_file):
+    """Applies the changes logged in the journal of |state_file|."""
+    if not self._journal_id:
+      return
+    try:
+      with open(state_file + JOURNAL_SUFFIX, 'rb') as f:
+        lines = f.read().split('\n')
+    except IOError:
+      return
+    try:
+      header = json.loads(lines[0])
+    except ValueError:
+      return
+    # A journal left by a crash right after the state file was rewritten has
+    # the previous id, its changes are already in the state file.
+    if not isinstance(header, dict) or header.get('journal') != self._journal_id:
+      return
+    records = []
+    for line in lines[1:]:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # A record cut short by a crash, the ones after it are fine.
+        continue
+      if (isinstance(record, list) and record and
+          len(record) == {'a': 4, 't': 3, 'p': 2}.get(record[0])):
+        records.append(record)
+    self.apply_changes(records)
+    self._changes = []
+    self._journal_records = len(records)
+
   def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+    """Saves cache state to a file if it was modified.
+
+    Appends the changes to the journal if the state was loaded from or saved to
+    |state_file| and it is large enough, otherwise rewrites |state_file|. Either
+    way, a crash while saving leaves the previous state intact. The state file
+    must not have been saved by another LRUDict since.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'wb') as f:
-      contents = {
-        'version': 2,
-        'items': self._items.items(),
-      }
-      json.dump(contents, f, separators=(',',':'))
-
+    if (self._journal_id and state_file == self._state_file and
+        len(self) >= JOURNAL_MIN_ITEMS and
+        (self._journal_records or 0) + len(self._changes) <= len(self)):
+      self._append_journal(state_file)
+    else:
+      self._write_state(state_file)
+    self._changes = []
     self._dirty = False
     return True
 
-  def add(self, key, value):
-    """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
-    self._items[key] = (value, self.time_fn())
+  def _append_journal(self, state_file):
+    lines = [
+      json.dumps(record, separators=(',',':')) for record in self._changes
+    ]
+    path = state_file + JOURNAL_SUFFIX
+    if self._journal_records is None:
+      # There is no journal for this state file yet.
+      mode = 'wb'
+      lines.insert(
+          0, json.dumps({'journal': self._journal_id}, separators=(',',':')))
+      self._journal_records = 0
+    else:
+      mode = 'ab'
+      with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+          f.seek(-1, os.SEEK_END)
+          if f.read(1) != '\n':
+            # Ends with a record cut short by a crash, leave it on its own line.
+            lines.insert(0, '')
+    with open(path, mode) as f:
+      f.write('\n'.join(lines) + '\n')
+    self._journal_records += len(self._changes)
+
+  def _write_state(self, state_file):
+    """Rewrites |state_file| and drops its journal."""
+    self._journal_id = os.urandom(8).encode('hex')
+    items = list(self.iteritems())
+    contents = {
+      'version': 3,
+      'journal': self._journal_id,
+      'keys': [k for k, _ in items],
+      'values': [v for _, (v, _) in items],
+      'timestamps': [t for _, (_, t) in items],
+    }
+    # Written to a temporary file first so a crash doesn't leave a partial
+    # state file.
+    tmp = state_file + u'.tmp'
+    with open(tmp, 'wb') as f:
+      json.dump(contents, f, separators=(',',':'))
+    if sys.platform == 'win32' and os.path.isfile(state_file):
+      # os.rename() doesn't replace an existing file on Windows.
+      os.remove(state_file)
+    os.rename(tmp, state_file)
+    try:
+      os.remove(state_file + JOURNAL_SUFFIX)
+    except OSError:
+      pass
+    self._state_file = state_file
+    self._journal_records = None
+
+  def get_changes(self):
+    """Returns the changes made since the state was loaded or saved."""
+    return self._changes[:]
+
+  def apply_changes(self, changes):
+    """Makes the changes returned by get_changes() of another LRUDict.
+
+    Touching or popping a key that is not in the dict is ignored.
+    """
+    for change in changes:
+      if change[0] == 'a':
+        self.add(change[1], change[2], change[3])
+      elif change[1] in self._slots:
+        if change[0] == 't':
+          self.touch(change[1], change[2])
+        else:
+          self.pop(change[1])
+
+  def add(self, key, value, timestamp=None):
+    """Adds or replaces a |value| for |key|, marks it as most recently used.
+
+    The time of use is |timestamp|, or now if None.
+    """
+    if timestamp is None:
+      timestamp = self.time_fn()
+    slot = self._slots.get(key)
+    if slot is None:
+      self._link(key, value, timestamp)
+    else:
+      old = self._values[slot]
+      if isinstance(old, _NUMBERS):
+        self._total -= old
+      if isinstance(value, _NUMBERS):
+        self._total += value
+      self._values[slot] = value
+      self._timestamps[slot] = timestamp
+      self._move_to_newest(slot)
+    self._changes.append(('a', key, value, timestamp))
     self._dirty = True
 
   def keys_set(self):
     """Set of keys of items in this dict."""
-    return set(self._items)
+    return set(self._slots)
 
   def get(self, key, default=None):
     """Returns value for |key| or |default| if not found."""
-    item = self._items.get(key)
-    return item[0] if item is not None else default
+    slot = self._slots.get(key)
+    return self._values[slot] if slot is not None else default
 
   def get_timestamp(self, key):
     """Returns timestamp of last use of |key|.
 
     Raises KeyError if |key| is not in the dict.
     """
-    return self._items[key][1]
+    return self._timestamps[self._slots[key]]
 
-  def touch(self, key):
-    """Marks |key| as most recently used.
+  def touch(self, key, timestamp=None):
+    """Marks |key| as most recently used, at |timestamp| or now if None.
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = (self._items.pop(key)[0], self.time_fn())
+    if timestamp is None:
+      timestamp = self.time_fn()
+    slot = self._slots[key]
+    self._timestamps[slot] = timestamp
+    self._move_to_newest(slot)
+    self._changes.append(('t', key, timestamp))
     self._dirty = True
 
   def pop(self, key):
@@ -168,29 +391,105 @@ class LRUDict(object):
 
     Raises KeyError if |key| is not in the dict.
     """
-    item = self._items.pop(key)
+    item = self._unlink(self._slots[key])
+    self._changes.append(('p', key))
     self._dirty = True
-    return item[0]
+    return item[1][0]
 
   def get_oldest(self):
     """Returns oldest item as tuple (key, (value, timestamp)).
 
     Raises KeyError if dict is empty.
     """
-    for item in self._items.iteritems():
-      return item
-    raise KeyError('dictionary is empty')
+    if self._oldest == _NONE:
+      raise KeyError('dictionary is empty')
+    slot = self._oldest
+    return (
+        self._keys[slot], (self._values[slot], self._timestamps[slot]))
 
   def pop_oldest(self):
     """Removes oldest item and returns it as (key, (value, timestamp)).
 
     Raises KeyError if dict is empty.
     """
-    item = self._items.popitem(last=False)
+    if self._oldest == _NONE:
+      raise KeyError('dictionary is empty')
+    item = self._unlink(self._oldest)
+    self._changes.append(('p', item[0]))
     self._dirty = True
     return item
 
+  def iteritems(self):
+    """Iterator over (key, (value, timestamp)) pairs, oldest first."""
+    slot = self._oldest
+    while slot != _NONE:
+      yield self._keys[slot], (self._values[slot], self._timestamps[slot])
+      slot = self._next[slot]
+
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
-    for val, _ in self._items.itervalues():
-      yield val
+    for _, (value, _) in self.iteritems():
+      yield value
+
+  def _link(self, key, value, timestamp):
+    """Stores a new item as the newest one."""
+    if self._free:
+      slot = self._free.pop()
+      self._keys[slot] = key
+      self._values[slot] = value
+      self._timestamps[slot] = timestamp
+      self._prev[slot] = self._newest
+      self._next[slot] = _NONE
+    else:
+      slot = len(self._keys)
+      self._keys.append(key)
+      self._values.append(value)
+      self._timestamps.append(timestamp)
+      self._prev.append(self._newest)
+      self._next.append(_NONE)
+    if self._newest == _NONE:
+      self._oldest = slot
+    else:
+      self._next[self._newest] = slot
+    self._newest = slot
+    self._slots[key] = slot
+    if isinstance(value, _NUMBERS):
+      self._total += value
+
+  def _unlink(self, slot):
+    """Removes the item in |slot|, returns it as (key, (value, timestamp))."""
+    prev = self._prev[slot]
+    next_ = self._next[slot]
+    if prev == _NONE:
+      self._oldest = next_
+    else:
+      self._next[prev] = next_
+    if next_ == _NONE:
+      self._newest = prev
+    else:
+      self._prev[next_] = prev
+    key = self._keys[slot]
+    value = self._values[slot]
+    del self._slots[key]
+    self._keys[slot] = None
+    self._values[slot] = None
+    self._free.append(slot)
+    if isinstance(value, _NUMBERS):
+      self._total -= value
+    return key, (value, self._timestamps[slot])
+
+  def _move_to_newest(self, slot):
+    """Moves the item in |slot| to the end of the list."""
+    if slot == self._newest:
+      return
+    prev = self._prev[slot]
+    next_ = self._next[slot]
+    if prev == _NONE:
+      self._oldest = next_
+    else:
+      self._next[prev] = next_
+    self._prev[next_] = prev
+    self._prev[slot] = self._newest
+    self._next[slot] = _NONE
+    self._next[self._newest] = slot
+    self._newest = slot
@@ -4,6 +4,7 @@
 
 """Classes and functions for generic network communication over HTTP."""
 
+import contextlib
 import cookielib
 import httplib
 import itertools
@@ -17,6 +18,7 @@ import socket
 import ssl
 import threading
 import time
+import types
 import urllib
 import urlparse
 
@@ -40,6 +42,21 @@ URL_OPEN_TIMEOUT = 6*60.
 # Default timeout when reading from open HTTP connection.
 URL_READ_TIMEOUT = 60
 
+# Initial and maximum number of concurrent requests to a single host. The limit
+# is adapted to the errors and latency of the host, see ConcurrencyLimit.
+CONCURRENCY_INITIAL_LIMIT = 16
+CONCURRENCY_MAX_LIMIT = 64
+
+# A request is considered slow when it takes more than this many times the
+# lowest latency observed on its host, and at least CONCURRENCY_SLOW_LATENCY
+# seconds.
+CONCURRENCY_SLOW_FACTOR = 4.
+CONCURRENCY_SLOW_LATENCY = 1.
+
+# Minimum number of idle connections kept open per host. The connection pools
+# are sized to the next power of two above the concurrency limit.
+MIN_POOL_SIZE = 4
+
 # Content type for url encoded POST body.
 URL_ENCODED_FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
 # Content type for JSON body.
@@ -299,6 +316,8 @@ class HttpService(object):
     self.urlhost = urlhost
     self.engine = engine
     self.authenticator = authenticator
+    self.concurrency = ConcurrencyLimit()
+    self._resize_pool()
 
   @staticmethod
   def is_transient_http_error(code, retry_404, retry_50x, suburl, content_type):
@@ -321,12 +340,21 @@ class HttpService(object):
     # Retry >= 500 error only if allowed by the caller.
     return retry_50x
 
+  @staticmethod
+  def is_streamed_body(body):
+    """Returns True if |body| is a generator of pre-encoded str chunks."""
+    return isinstance(body, types.GeneratorType)
+
   @staticmethod
   def encode_request_body(body, content_type):
     """Returns request body encoded according to its content type."""
     # No body or it is already encoded.
     if body is None or isinstance(body, str):
       return body
+    # Streamed bodies are sent as is, chunk by chunk.
+    if HttpService.is_streamed_body(body):
+      assert content_type, 'Streamed body, but no content type'
+      return body
     # Any body should have content type set.
     assert content_type, 'Request has body, but no content type'
     encoder = CONTENT_ENCODERS.get(content_type)
@@ -378,9 +406,15 @@ class HttpService(object):
     |data| can be either:
       - None for a GET request
       - str for pre-encoded data
+      - generator of str chunks for pre-encoded data to stream
       - list for data to be form-encoded
       - dict for data to be form-encoded
 
+    A streamed |data| is sent with chunked transfer encoding so it is never
+    held in memory as a whole. Since a generator can't be rewound, the request
+    is attempted only once; the caller is responsible for retrying with a new
+    generator.
+
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
       number of retries.
@@ -432,7 +466,11 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = len(body)
+      if self.is_streamed_body(body):
+        # The stream is consumed by the first attempt.
+        max_attempts = 1
+      else:
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -453,7 +491,8 @@ class HttpService(object):
             headers, read_timeout, stream, follow_redirects)
         if self.authenticator:
           self.authenticator.authorize(request)
-        response = self.engine.perform_request(request)
+        response = self._perform_request(
+            request, not self.is_streamed_body(body))
         response._timeout_exc_classes = self.engine.timeout_exception_classes()
         logging.debug('Request %s succeeded', request.get_full_url())
         return response
@@ -514,6 +553,52 @@ class HttpService(object):
         self._format_error(last_error, verbose=True))
     return None
 
+  def _perform_request(self, request, measure_latency):
+    """Sends |request| once a request slot to the host is available.
+
+    Connection errors, timeouts and 5xx errors lower the concurrency limit of
+    the host. The latency is only meaningful when the body is not streamed,
+    otherwise it includes the upload.
+
+    The slot of a streamed response is held until its body is read or the
+    response is closed, so the limit covers the transfer and its errors.
+    """
+    start = self.concurrency.acquire()
+    def done(succeeded, latency=None):
+      try:
+        self.concurrency.record(start, succeeded, measure_latency, latency)
+      finally:
+        self.concurrency.release()
+      self._resize_pool()
+
+    try:
+      response = self.engine.perform_request(request)
+    except (ConnectionError, TimeoutError):
+      done(False)
+      raise
+    except HttpError as e:
+      # Other 4xx errors say nothing about the load of the server.
+      done(False if e.code in (408, 429) or e.code >= 500 else None)
+      raise
+    except Exception:
+      done(None)
+      raise
+    if not request.stream:
+      done(True)
+      return response
+    # The latency is the time to the headers, it shouldn't depend on the size
+    # of the body.
+    latency = time.time() - start
+    response._on_done = lambda failed: done(not failed, latency)
+    return response
+
+  def _resize_pool(self):
+    """Sizes the connection pool of the engine to the concurrency limit."""
+    # Not all the engines have connection pools.
+    set_pool_size = getattr(self.engine, 'set_pool_size', None)
+    if set_pool_size:
+      set_pool_size(self.concurrency.limit)
+
   def json_request(self, urlpath, data=None, **kwargs):
     """Sends JSON request to the server and parses JSON response it get back.
 
@@ -569,6 +654,112 @@ class HttpService(object):
     return exc.verbose_info
 
 
+class ConcurrencyLimit(object):
+  """Limits the number of concurrent requests to a host.
+
+  It is an AIMD (additive increase, multiplicative decrease) controller: the
+  limit grows by about one per round of |limit| requests that succeed while the
+  limit is reached, and is halved on connection errors, timeouts and 5xx
+  errors. A degraded server thus gets fewer requests, and fewer retries, instead
+  of being flooded. Slow requests stop the growth of the limit, without lowering
+  it, since some requests are slow regardless of the load of the server.
+
+  Requests that were started before the limit was last lowered don't lower it
+  again, so a burst of errors only halves it once.
+
+  Thread safe.
+  """
+
+  def __init__(
+      self, initial=CONCURRENCY_INITIAL_LIMIT, maximum=CONCURRENCY_MAX_LIMIT):
+    self._cond = threading.Condition()
+    self._limit = float(initial)
+    self._maximum = maximum
+    self._in_flight = 0
+    # Lowest latency observed, slowly drifting toward the recent latencies.
+    self._min_latency = None
+    self._last_decrease = None
+    self.requests = 0
+    self.failures = 0
+    self.slow = 0
+
+  @property
+  def limit(self):
+    """Maximum number of requests to have in flight."""
+    return int(self._limit)
+
+  @property
+  def in_flight(self):
+    return self._in_flight
+
+  @contextlib.contextmanager
+  def slot(self):
+    """Waits for a request slot and holds it for the duration of the body.
+
+    Yields the time the request started, to pass to record() before the slot is
+    released.
+    """
+    start = self.acquire()
+    try:
+      yield start
+    finally:
+      self.release()
+
+  def acquire(self):
+    """Waits for a request slot, returns the time the request started.
+
+    The slot must be released with release().
+    """
+    with self._cond:
+      while self._in_flight >= int(self._limit):
+        self._cond.wait()
+      self._in_flight += 1
+    return time.time()
+
+  def release(self):
+    """Releases a slot returned by acquire()."""
+    with self._cond:
+      self._in_flight -= 1
+      self._cond.notify_all()
+
+  def record(self, start, succeeded, measure_latency, latency=None):
+    """Updates the limit with the result of a request started at |start|.
+
+    |succeeded| is None when the result says nothing about the server load.
+    |latency| defaults to the time since |start|.
+    """
+    if succeeded is None:
+      return
+    now = time.time()
+    duration = now - start if latency is None else latency
+    with self._cond:
+      self.requests += 1
+      slow = False
+      if succeeded and measure_latency:
+        if self._min_latency is None or duration < self._min_latency:
+          self._min_latency = duration
+        slow = duration > max(
+            CONCURRENCY_SLOW_LATENCY,
+            CONCURRENCY_SLOW_FACTOR * self._min_latency)
+        if not slow:
+          self._min_latency += (duration - self._min_latency) / 64.
+      if not succeeded:
+        self.failures += 1
+        if self._last_decrease is None or start >= self._last_decrease:
+          self._limit = max(1., self._limit / 2)
+          self._last_decrease = now
+          logging.debug(
+              'Lowered the concurrency limit to %d', int(self._limit))
+      elif slow:
+        self.slow += 1
+      elif self._in_flight >= int(self._limit):
+        # Only grow when the limit was actually reached, fewer concurrent
+        # requests don't tell if more would succeed too.
+        self._limit = min(
+            float(self._maximum), self._limit + 1. / self._limit)
+        self._cond.notify_all()
+
+
 class HttpRequest(object):
   """Request to HttpService."""
 
@@ -579,7 +770,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or generator of str)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket
@@ -618,9 +809,28 @@ class HttpResponse(object):
     self._url = url
     self._headers = get_case_insensitive_dict(headers)
     self._timeout_exc_classes = ()
+    # Called with True if reading the body failed, once it is read or closed.
+    self._on_done = None
+
+  def __del__(self):
+    # A response that is dropped without being read still frees its slot.
+    self._done(False)
+
+  def close(self):
+    """Releases the connection, for a body that won't be read."""
+    close = getattr(self._response, 'close', None)
+    if close:
+      close()
+    self._done(False)
+
+  def _done(self, failed):
+    on_done, self._on_done = self._on_done, None
+    if on_done:
+      on_done(failed)
 
   def iter_content(self, chunk_size):
     assert all(issubclass(e, Exception) for e in self._timeout_exc_classes)
+    failed = False
     try:
       read = 0
       if hasattr(self._response, 'iter_content'):
@@ -637,12 +847,17 @@ class HttpResponse(object):
           read += len(buf)
           yield buf
     except self._timeout_exc_classes as e:
+      failed = True
       logging.error('Timeout while reading from %s, read %d of %s: %s',
           self._url, read, self.get_header('Content-Length'), e)
       raise TimeoutError(e)
+    finally:
+      # Also when the caller stops iterating early.
+      self._done(failed)
 
   def read(self):
     assert all(issubclass(e, Exception) for e in self._timeout_exc_classes)
+    failed = False
     try:
       if hasattr(self._response, 'content'):
         # request.Response.
@@ -650,9 +865,12 @@ class HttpResponse(object):
       # File-like object.
       return self._response.read()
     except self._timeout_exc_classes as e:
+      failed = True
       logging.error('Timeout while reading from %s, expected %s bytes: %s',
           self._url, self.get_header('Content-Length'), e)
       raise TimeoutError(e)
+    finally:
+      self._done(failed)
 
   def get_header(self, header):
     """Returns response header (as str) or None if no such header."""
@@ -692,13 +910,38 @@ class RequestsLibEngine(object):
     # Configure session.
     self.session.trust_env = False
     self.session.verify = tools.get_cacerts_bundle()
-    # Configure connection pools.
+    # Configure connection pools. They are resized by set_pool_size().
+    self._lock = threading.Lock()
+    self._pool_size = CONCURRENCY_MAX_LIMIT
+    self._adapters = []
     for protocol in ('https://', 'http://'):
-      self.session.mount(protocol, adapters.HTTPAdapter(
+      adapter = adapters.HTTPAdapter(
           pool_connections=64,
-          pool_maxsize=64,
+          pool_maxsize=self._pool_size,
           max_retries=0,
-          pool_block=False))
+          pool_block=False)
+      self.session.mount(protocol, adapter)
+      self._adapters.append(adapter)
+
+  def set_pool_size(self, connections):
+    """Keeps up to about |connections| idle connections open per host.
+
+    The size is rounded up to a power of two so the pools are not recreated
+    every time the concurrency limit changes. The connections are not limited
+    by the pools, the surplus ones are closed once used.
+    """
+    size = MIN_POOL_SIZE
+    while size < min(connections, CONCURRENCY_MAX_LIMIT):
+      size *= 2
+    with self._lock:
+      if size == self._pool_size:
+        return
+      self._pool_size = size
+      for adapter in self._adapters:
+        # The old pools are not cleared, other threads may still be using
+        # them. They drain as their requests complete, and their connections
+        # are closed once they are garbage collected.
+        adapter.init_poolmanager(64, size, block=False)
 
   def perform_request(self, request):
     """Sends a HttpRequest to the server and reads back the response.
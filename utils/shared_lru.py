@@ -0,0 +1,101 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""LRUDict saved to a json file that concurrent processes can update."""
+
+import collections
+import logging
+import os
+import threading
+
+from utils import file_lock
+from utils import fs
+from utils import lru
+
+
+class SharedLRUDict(object):
+  """Dictionary backed by a json file shared by multiple processes.
+
+  Thread safe. The file is only read when the instance is created and when it
+  is saved. Saving merges the keys added or used since with what other processes
+  saved in the meantime, under a file lock, and evicts the least recently used
+  keys above |max_items|.
+
+  Can be used as a context manager, it is then saved on exit.
+  """
+
+  def __init__(self, path, max_items):
+    self.path = path
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    self._file_lock = file_lock.FileLock(path + u'.lock')
+    # State loaded from |path| plus the keys added since.
+    self._lru = self._load()
+    # Keys added or used since the state was loaded, to merge when saving.
+    self._added = collections.OrderedDict()
+    self._used = set()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  def __len__(self):
+    return len(self._lru)
+
+  def get(self, key, default=None):
+    """Returns the value for |key| and marks it as recently used."""
+    with self._lock:
+      if key not in self._lru:
+        return default
+      self._used.add(key)
+      return self._lru[key]
+
+  def add(self, key, value):
+    """Adds or replaces the |value| for |key|."""
+    with self._lock:
+      self._lru.add(key, value)
+      self._added.pop(key, None)
+      self._added[key] = value
+
+  def save(self):
+    """Merges the keys added or used into the file at |path|.
+
+    Errors are logged but not raised, the file is only a cache.
+    """
+    with self._lock:
+      if not self._added and not self._used:
+        return
+      try:
+        parent = os.path.dirname(self.path)
+        if parent and not fs.isdir(parent):
+          fs.makedirs(parent)
+        with self._file_lock:
+          state = self._load()
+          for key in self._used:
+            if key in state:
+              state.touch(key)
+          for key, value in self._added.iteritems():
+            state.add(key, value)
+          while len(state) > self.max_items:
+            state.pop_oldest()
+          state.save(self.path)
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save %s: %s', self.path, e)
+        return
+      self._lru = state
+      self._added = collections.OrderedDict()
+      self._used = set()
+
+  def _load(self):
+    """Returns the LRUDict saved at |path|, or an empty one."""
+    if not fs.isfile(self.path):
+      return lru.LRUDict()
+    try:
+      return lru.LRUDict.load(self.path)
+    except ValueError as e:
+      logging.warning('Ignoring %s: %s', self.path, e)
+      return lru.LRUDict()
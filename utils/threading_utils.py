@@ -4,6 +4,8 @@
 
 """Classes and functions related to threading."""
 
+import collections
+import contextlib
 import functools
 import inspect
 import logging
@@ -118,6 +120,12 @@ class ThreadPool(object):
     for _ in range(initial_threads):
       self._add_worker()
 
+  @property
+  def added_tasks(self):
+    """Number of tasks added since the pool was created."""
+    with self._num_of_added_tasks_lock:
+      return self._num_of_added_tasks
+
   def _add_worker(self):
     """Adds one worker thread if there isn't too many. Thread-safe."""
     with self._lock:
@@ -794,6 +802,132 @@ class TaskChannel(object):
     return wrapped
 
 
+class MemoryBudget(object):
+  """Limits the number of bytes that concurrent threads hold in memory.
+
+  acquire() waits until the bytes requested fit in |max_size|. Requests are
+  granted in FIFO order, so a large one is not starved by a stream of smaller
+  ones. A request larger than |max_size| is granted once nothing else is held.
+
+  Thread safe. Keeps the maximum number of bytes held at once in |peak| and the
+  total number of seconds spent waiting in |waited|.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._cond = threading.Condition()
+    # One object per thread waiting in acquire(), in order.
+    self._waiters = collections.deque()
+    self.used = 0
+    self.peak = 0
+    self.waited = 0.
+
+  def acquire(self, size, wait=True):
+    """Reserves |size| bytes.
+
+    Arguments:
+      size: number of bytes to reserve.
+      wait: if False, the bytes are reserved even if over the budget, e.g.
+          because they are already in memory. They still delay the next
+          requests.
+    """
+    with self._cond:
+      ticket = object()
+      self._waiters.append(ticket)
+      start = time.time()
+      while wait and (
+          self._waiters[0] is not ticket or
+          (self.used and self.used + size > self.max_size)):
+        self._cond.wait()
+      self._waiters.remove(ticket)
+      self.used += size
+      self.peak = max(self.peak, self.used)
+      self.waited += time.time() - start
+      # The next waiter may fit too.
+      self._cond.notifyAll()
+
+  def release(self, size):
+    """Gives back |size| bytes reserved with acquire()."""
+    with self._cond:
+      self.used -= size
+      assert self.used >= 0, self.used
+      self._cond.notifyAll()
+
+  @contextlib.contextmanager
+  def reserve(self, size, wait=True):
+    """Holds |size| bytes while in the context, see acquire()."""
+    self.acquire(size, wait)
+    try:
+      yield
+    finally:
+      self.release(size)
+
+
+class Pipe(object):
+  """Bounded queue streaming chunks of data from one thread to another.
+
+  The writer put()s chunks then close()s it, optionally with an exception that
+  the reader gets once it read everything before. The reader iterates over it.
+  A reader that stops before the end must abort() it, so a writer blocked in
+  put() raises Pipe.Aborted instead of waiting forever.
+  """
+
+  class Aborted(Exception):
+    """Raised by 'put' once the reader aborted the pipe."""
+
+  def __init__(self, max_size):
+    assert max_size > 0, max_size
+    self._max_size = max_size
+    self._cond = threading.Condition()
+    self._chunks = collections.deque()
+    self._closed = False
+    self._exc_info = None
+    self._aborted = False
+
+  def put(self, chunk):
+    """Enqueues |chunk|, waiting while the pipe is full."""
+    with self._cond:
+      while len(self._chunks) >= self._max_size and not self._aborted:
+        self._cond.wait()
+      if self._aborted:
+        raise Pipe.Aborted()
+      assert not self._closed
+      self._chunks.append(chunk)
+      self._cond.notifyAll()
+
+  def close(self, exc_info=None):
+    """Marks the end of the data.
+
+    Arguments:
+      exc_info: optional 3-tuple returned by sys.exc_info() to raise to the
+          reader instead of ending the iteration normally.
+    """
+    with self._cond:
+      self._closed = True
+      self._exc_info = exc_info
+      self._cond.notifyAll()
+
+  def abort(self):
+    """Discards the data, a writer blocked in 'put' raises Pipe.Aborted."""
+    with self._cond:
+      self._aborted = True
+      self._chunks.clear()
+      self._cond.notifyAll()
+
+  def __iter__(self):
+    while True:
+      with self._cond:
+        while not self._chunks and not self._closed:
+          self._cond.wait()
+        if not self._chunks:
+          if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+          return
+        chunk = self._chunks.popleft()
+        self._cond.notifyAll()
+      yield chunk
+
+
 def num_processors():
   """Returns the number of processors.
 
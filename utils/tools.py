@@ -302,6 +302,20 @@ def is_headless():
   return any(get_bool_env_var(key) for key in headless_env_keys)
 
 
+def get_peak_rss():
+  """Returns the maximum resident set size of this process in bytes, or None if
+  unknown.
+  """
+  try:
+    import resource
+  except ImportError:
+    # Windows.
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # It is in bytes on OSX, kilobytes elsewhere.
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
 def get_cacerts_bundle():
   """Returns path to a file with CA root certificates bundle.
 